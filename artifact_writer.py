@@ -0,0 +1,253 @@
+"""
+撮影画像・結果画像・結果CSV・データベースの結果行の保存をバックグラウンドのスレッドで行う
+JPEGへの圧縮とファイル・データベースへの書き込みをカウント処理から切り離し、
+前のシートの保存中に次のシートのカウントを始められるようにする
+エンコード・書き込みの処理時間は、その処理をしている間にstage_timerで記録中のシートに加える
+(writer_encode, writer_write, writer_db。前のシートの保存は次のシートのカウントと並行して行われる)
+"""
+from collections import deque
+from datetime import datetime
+import os
+import queue
+import threading
+import traceback
+
+import cv2
+
+from db_manage import DatabaseManage
+from stage_timer import stage_timer
+from write_csv import make_csv_file
+
+
+fsync_policies = ["none", "flush", "always"]  # none: OSに任せる flush: flush時にまとめて always: 1ファイルごと
+
+
+class ArtifactWriter:
+    def __init__(self, db_file=None, max_queue=8, fsync_policy="flush", error_log=None):
+        """
+        保存処理を1つのスレッドで順番に行うクラス
+        保存待ちがmax_queueに達した場合、追加する側は空きができるまで待つ(撮影画像1枚で約30MB)
+        保存前のファイルを読み込む・移動する・削除する前にはflushで保存が終わるのを待つ
+        保存に失敗した場合はpop_errorsで取り出せるように保持し、error_logにも追記する
+
+        Args:
+            db_file (str or None): 結果行を書き込むデータベースファイル。スレッド内で別に接続する
+            max_queue (int): 保存待ちの最大数
+            fsync_policy (str): "none", "flush" or "always"
+            error_log (str or None): 保存に失敗したときに追記するファイル
+        """
+        self.db_file = db_file
+        self.fsync_policy = fsync_policy
+        self.error_log = error_log
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._cond = threading.Condition()
+        self._pending = {}  # {(種類, パス): 保存待ちの数}
+        self._pending_results = {}  # {(管理No, シートNo): 保存待ちの数}。データベースへの書き込み前の重複確認用
+        self._unsynced = set()  # fsync_policy="flush"のとき、まだfsyncしていないファイル
+        self._errors = deque()  # 保存に失敗したパスとエラー内容 (path, str)
+        self._db = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="artifact_writer", daemon=True)
+        self._thread.start()
+
+    def write_image(self, path, img):
+        """
+        画像をファイルの拡張子の形式でエンコードして保存する。呼び出し後にimgを書き換えないこと
+
+        Args:
+            path (str): 保存先(日本語を含んでもよい)
+            img (img_bgr): 保存する画像
+        """
+        self._put("file", path, self._write_image, (path, img))
+
+    def write_encoded(self, path, buf):
+        """
+        cv2.imencodeでエンコード済みのデータをそのまま保存する
+
+        Args:
+            path (str): 保存先(日本語を含んでもよい)
+            buf (np.ndarray): cv2.imencodeの出力
+        """
+        self._put("file", path, self._write_bytes, (path, buf))
+
+    def write_csv(self, path, **kwargs):
+        """
+        write_csv.make_csv_fileで結果のCSVファイルを作成する
+
+        Args:
+            path (str): 作成するCSVファイルのパス
+            **kwargs: CSVファイルのヘッダーと値
+        """
+        self._put("file", path, self._write_csv, (path, kwargs))
+
+    def write_with(self, path, fn, *args):
+        """
+        fn(*args)でpathに保存する処理を、他の保存と同じ順番で行う(設定ファイルなど)
+
+        Args:
+            path (str): 保存先。flushで待つときに使う
+            fn (function): 保存する関数
+            *args: fnの引数。保存が終わるまで書き換えないこと
+        """
+        self._put("file", path, fn, args)
+
+    def write_result_row(self, dir_name, *args):
+        """
+        データベースのresultテーブルに1行書き込む
+
+        Args:
+            dir_name (str): 結果のディレクトリ。flushで待つときに使う
+            *args: DatabaseManage.write_rowのカラム名と値のタプル。control_No, sheet_Noを含むこと
+        """
+        columns = dict(args)
+        result_key = (columns.get("control_No"), columns.get("sheet_No"))
+        with self._cond:
+            self._pending_results[result_key] = self._pending_results.get(result_key, 0) + 1
+        self._put("db", dir_name, self._write_result_row, (result_key, args))
+
+    def is_result_pending(self, control_no, sheet_no):
+        """この管理No, シートNoの結果行がデータベースへの書き込み待ちかどうか"""
+        with self._cond:
+            return (control_no, sheet_no) in self._pending_results
+
+    def flush(self, dir_name=None, kind=None):
+        """
+        保存待ちの処理が終わるまで待つ。fsync_policy="flush"のときは保存したファイルをfsyncする
+
+        Args:
+            dir_name (str or None): このディレクトリ以下の保存だけ待つ。Noneのときすべて
+            kind (str or None): "file"(ファイル) or "db"(データベース)の保存だけ待つ。Noneのときどちらも
+        """
+        def is_done():
+            return not any((kind is None or pending_kind == kind) and (dir_name is None or path.startswith(dir_name))
+                           for pending_kind, path in self._pending)
+
+        with self._cond:
+            self._cond.wait_for(is_done)
+            unsynced = [path for path in self._unsynced if dir_name is None or path.startswith(dir_name)]
+            self._unsynced.difference_update(unsynced)
+        for path in unsynced:
+            self._fsync(path)
+
+    def pop_errors(self):
+        """
+        保存に失敗したパスとエラー内容を取り出す
+
+        Returns:
+            list[(str, str)]: (パス, エラー内容)のリスト
+        """
+        errors = []
+        while self._errors:
+            errors.append(self._errors.popleft())
+        return errors
+
+    def get_queue_size(self):
+        """保存待ちの数"""
+        return self._queue.qsize()
+
+    def close(self):
+        """保存待ちをすべて保存してからスレッドを終了する。終了時に呼び出す"""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _put(self, kind, path, fn, args):
+        """保存待ちに追加する。保存待ちがいっぱいのときは空くまで待つ"""
+        if self._closed:
+            raise RuntimeError("ArtifactWriter is closed")
+        with self._cond:
+            self._pending[(kind, path)] = self._pending.get((kind, path), 0) + 1
+        with stage_timer.stage("writer_wait"):
+            self._queue.put((kind, path, fn, args))
+
+    def _run(self):
+        """保存待ちを順番に処理する"""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            kind, path, fn, args = job
+            try:
+                fn(*args)
+            except Exception as err:
+                self._add_error(path, err)
+            finally:
+                with self._cond:
+                    self._pending[(kind, path)] -= 1
+                    if self._pending[(kind, path)] == 0:
+                        del self._pending[(kind, path)]
+                    self._cond.notify_all()
+        if self._db is not None:
+            self._db.close_sql()
+
+    def _write_image(self, path, img):
+        """画像をエンコードして保存する"""
+        with stage_timer.stage("writer_encode"):
+            ext = os.path.splitext(path)[1]  # 日本語を含むファイル名を扱う
+            result_encode, buf = cv2.imencode(ext, img)  # 画像をエンコード
+        self._write_bytes(path, buf)
+
+    def _write_bytes(self, path, buf):
+        """エンコード済みのデータを保存する"""
+        with stage_timer.stage("writer_write"):
+            with open(path, mode="w+b") as f:
+                buf.tofile(f)
+                if self.fsync_policy == "always":
+                    f.flush()
+                    os.fsync(f.fileno())
+        self._after_write(path)
+
+    def _write_csv(self, path, kwargs):
+        """結果のCSVファイルを作成する"""
+        with stage_timer.stage("writer_write"):
+            make_csv_file(path, **kwargs)
+            if self.fsync_policy == "always":
+                self._fsync(path)
+        self._after_write(path)
+
+    def _write_result_row(self, result_key, args):
+        """データベースに結果行を書き込む。sqlite3の接続はスレッドをまたげないので、このスレッドで接続する"""
+        try:
+            with stage_timer.stage("writer_db"):
+                if self._db is None:
+                    self._db = DatabaseManage(self.db_file)
+                self._db.write_row("result", *args)
+        finally:
+            with self._cond:
+                self._pending_results[result_key] -= 1
+                if self._pending_results[result_key] == 0:
+                    del self._pending_results[result_key]
+
+    def _after_write(self, path):
+        """fsync_policy="flush"のとき、flushでfsyncするファイルとして記録する"""
+        if self.fsync_policy == "flush":
+            with self._cond:
+                self._unsynced.add(path)
+
+    def _fsync(self, path):
+        """ファイルをディスクに書き出す"""
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:  # 保存後に移動・削除された場合
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _add_error(self, path, err):
+        """保存の失敗を記録する"""
+        message = "{}: {}".format(type(err).__name__, err)
+        self._errors.append((path, message))
+        if self.error_log is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.error_log), exist_ok=True)
+            with open(self.error_log, "a", encoding="utf-8") as f:
+                f.write("{0:%Y/%m/%d %H:%M:%S} {1}\n".format(datetime.now(), path))
+                traceback.print_exception(type(err), err, err.__traceback__, file=f)
+        except OSError:
+            pass
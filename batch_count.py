@@ -0,0 +1,334 @@
+"""
+保存済みの結果フォルダを一括で再カウントする。
+
+count/result/<日付>/<製品名>/<管理No>/<シートNo>/frame.jpg を探索し、
+MainWindowを立ち上げずに、プロセスプールで全シートをカウントする。
+カウントが終わったシートから順に結果を出力し、最後に処理速度(シート/秒)を表示する。
+
+使い方:
+    python batch_count.py
+    python batch_count.py count/result/20220906 --method contours --workers 4 --csv recount.csv
+    python batch_count.py --mode full --compare pyramid --tolerance 1  # 2つのマッチング方法のカウント数の差を確認する
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+from multiprocessing import freeze_support
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from count_contours import count_contours
+from db_manage import DatabaseManage
+from hls_range import HLSRange
+from matching_pattern import matching_modes, PatternImage
+from pattern_store import PatternStore
+from preprocessing import deskew_modes, Preprocess
+from setting_count import load_deskew_setting, load_matching_setting, load_setting_file
+from stage_timer import stage_timer, StageTimer
+
+
+db_file = "./count/count.db"  # データベースファイルパス
+pattern_dirs = "./count/pattern/"  # パターン画像を保存するディレクトリ
+result_dirs = "./count/result/"  # 結果を保存するディレクトリ
+setting_dir = "./count/setting/"  # 検出アルゴリズムの設定ファイルを保存するディレクトリ
+
+frame_name = "frame.jpg"  # カウント対象の画像名
+
+_preprocess_dict = {}  # ワーカープロセスごとに、画像サイズをキーとしてPreprocessを保持する
+_pattern_store = PatternStore()  # ワーカープロセスごとに、パターン画像を保持する
+
+
+class SheetInfo:
+    def __init__(self, path, date, product_name, control_no, sheet_no):
+        """
+        再カウントする1シート分の情報
+
+        Args:
+            path (str): frame.jpgのパス
+            date (str): 日付フォルダ名
+            product_name (str): 製品名
+            control_no (str): 管理No
+            sheet_no (str): シートNo
+        """
+        self.path = path
+        self.date = date
+        self.product_name = product_name
+        self.control_no = control_no
+        self.sheet_no = sheet_no
+
+
+def find_sheets(root_dir, dates=None, products=None):
+    """
+    結果フォルダを探索し、frame.jpgを持つシートの一覧を返す
+    root_dirにはcount/result/、もしくは日付フォルダを指定できる
+
+    Args:
+        root_dir (str): 探索するディレクトリ
+        dates (list[str] or None): 対象とする日付フォルダ名。Noneのときすべて
+        products (list[str] or None): 対象とする製品名。Noneのときすべて
+
+    Returns:
+        list[SheetInfo]: 見つかったシートのリスト
+    """
+    root_dir = os.path.normpath(root_dir)
+    if _is_date_dir(root_dir):
+        date_dirs = [root_dir]  # 日付フォルダが直接指定された場合
+    else:
+        date_dirs = [os.path.join(root_dir, name) for name in sorted(os.listdir(root_dir))]
+
+    sheets = []
+    for date_dir in date_dirs:
+        date = os.path.basename(date_dir)
+        if not os.path.isdir(date_dir) or (dates and date not in dates):
+            continue
+        for product_name in _sorted_dirs(date_dir):
+            if products and product_name not in products:
+                continue
+            product_dir = os.path.join(date_dir, product_name)
+            for control_no in _sorted_dirs(product_dir):
+                control_dir = os.path.join(product_dir, control_no)
+                for sheet_no in _sorted_dirs(control_dir):
+                    path = os.path.join(control_dir, sheet_no, frame_name)
+                    if os.path.isfile(path):
+                        sheets.append(SheetInfo(path, date, product_name, control_no, sheet_no))
+    return sheets
+
+
+def _is_date_dir(path):
+    """ディレクトリ名が8桁の日付かどうか"""
+    name = os.path.basename(path)
+    return len(name) == 8 and name.isdigit()
+
+
+def _sorted_dirs(path):
+    """path直下のディレクトリ名を名前順で返す"""
+    return [name for name in sorted(os.listdir(path)) if os.path.isdir(os.path.join(path, name))]
+
+
+def load_product_conditions(product_names, matching_threshold=None, matching_mode=None, pyramid_levels=None,
+                            deskew_mode=None):
+    """
+    製品ごとのパターン画像ディレクトリと設定値を取得する
+    データベースに製品が登録されていない場合は、製品登録時と同じディレクトリ名を使う
+
+    Args:
+        product_names (set[str]): 製品名
+        matching_threshold (float or None): 指定した場合、設定ファイルの閾値の代わりに使う
+        matching_mode (str or None): 指定した場合、設定ファイルのマッチング方法の代わりに使う
+        pyramid_levels (int or None): 指定した場合、設定ファイルの縮小回数の代わりに使う
+        deskew_mode (str or None): 指定した場合、設定ファイルの回転角の求め方の代わりに使う
+
+    Returns:
+        dict[str, dict]: 製品名をキーとした、pattern_dir, matching_threshold, erode_size, dilate_size, thresh_area,
+                         matching_mode, pyramid_levels, deskew_mode
+    """
+    db = DatabaseManage(db_file) if os.path.exists(db_file) else None
+    conditions = {}
+    for product_name in product_names:
+        pattern_dir = pattern_dirs + product_name + "/"
+        if db is not None:
+            response = db.select_row("product", False, "dir_name", product_name=product_name)
+            if response[0][1]:
+                pattern_dir = response[0][1][0]
+
+        if os.path.exists(setting_dir + product_name + ".pkl"):
+            _matching_threshold, erode_size, dilate_size, thresh_area, _, _, _ = \
+                load_setting_file(setting_dir, product_name)
+        else:  # Control.change_settingと同じ初期値
+            _matching_threshold, erode_size, dilate_size, thresh_area = 0.85, 5, 3, 100
+        if matching_threshold is not None:
+            _matching_threshold = matching_threshold
+        _matching_mode, _pyramid_levels = load_matching_setting(setting_dir, product_name)
+        if matching_mode is not None:
+            _matching_mode = matching_mode
+        if pyramid_levels is not None:
+            _pyramid_levels = pyramid_levels
+        _deskew_mode = deskew_mode if deskew_mode is not None else load_deskew_setting(setting_dir, product_name)
+
+        conditions[product_name] = {"pattern_dir": pattern_dir,
+                                    "matching_threshold": _matching_threshold,
+                                    "erode_size": erode_size,
+                                    "dilate_size": dilate_size,
+                                    "thresh_area": thresh_area,
+                                    "matching_mode": _matching_mode,
+                                    "pyramid_levels": _pyramid_levels,
+                                    "deskew_mode": _deskew_mode}
+    if db is not None:
+        db.close_sql()
+    return conditions
+
+
+def count_sheet(arg):
+    """
+    1シート分の画像を読み込んでカウントする。ワーカープロセスで実行される
+    compare_modeを指定した場合は、前処理後の同じ画像をそのマッチング方法でもカウントする
+
+    Args:
+        arg ((int, SheetInfo, str, dict, str or None)): シートの番号、シート情報、手法("pattern" or "contours")、
+                                                        製品の設定値、比較するマッチング方法
+
+    Returns:
+        int, int or None, int or None, float, str or None, dict or None: シートの番号、カウント数、
+                                                                         比較したマッチング方法でのカウント数、処理時間、
+                                                                         エラー内容、段階ごとの処理時間
+    """
+    index, sheet, method, condition, compare_mode = arg
+    start = time.perf_counter()
+    compare_count = None
+    stage_timer.begin("/".join([sheet.date, sheet.product_name, sheet.control_no, sheet.sheet_no]))
+    try:
+        n = np.fromfile(sheet.path, dtype=np.uint8)  # 日本語を含むファイルを扱う
+        frame = cv2.imdecode(n, cv2.IMREAD_COLOR)
+        if method == "pattern":
+            pre = _get_preprocess(frame)
+            img_rot = pre.preprocessing(frame, 500, 500, deskew_mode=condition["deskew_mode"],
+                                        reuse_output=True)  # 射影変換などの前処理
+            is_count = _count_pattern(img_rot, condition, condition["matching_mode"])
+            if compare_mode is not None:
+                compare_count = _count_pattern(img_rot, condition, compare_mode)
+        else:
+            _, is_count = count_contours(frame, condition["erode_size"], condition["dilate_size"],
+                                         condition["thresh_area"])
+        error = None
+    except Exception as err:
+        is_count, error = None, "{}: {}".format(type(err).__name__, err)
+    return index, is_count, compare_count, time.perf_counter() - start, error, stage_timer.end()
+
+
+def _count_pattern(img_rot, condition, matching_mode):
+    """前処理後の画像をパターンマッチングでカウントする"""
+    pat = PatternImage(15, condition["matching_threshold"], _pattern_store, matching_mode, condition["pyramid_levels"])
+    _, is_count, _, _, _, _, _ = pat.get_result_and_count(img_rot, condition["pattern_dir"],
+                                                          condition["matching_threshold"], HLSRange())
+    return is_count
+
+
+def _get_preprocess(frame):
+    """画像サイズに合ったPreprocessを返す。同じサイズであれば使いまわす"""
+    height, width = frame.shape[:2]
+    if (width, height) not in _preprocess_dict:
+        _preprocess_dict[(width, height)] = Preprocess(width, height)
+    return _preprocess_dict[(width, height)]
+
+
+def batch_count(sheets, method="pattern", workers=None, matching_threshold=None, csv_path=None, out=sys.stdout,
+                matching_mode=None, pyramid_levels=None, compare_mode=None, tolerance=0, profile=False,
+                deskew_mode=None):
+    """
+    シートをプロセスプールでカウントし、終わったものから結果を出力する
+
+    Args:
+        sheets (list[SheetInfo]): カウントするシート
+        method (str): "pattern"(パターン検出) or "contours"(輪郭検出)
+        workers (int or None): プロセス数。Noneのときコア数
+        matching_threshold (float or None): パターンマッチングの閾値。Noneのとき製品の設定ファイルの値
+        csv_path (str or None): 結果を書き出すCSVファイルのパス
+        out: 結果の出力先
+        matching_mode (str or None): マッチング方法。Noneのとき製品の設定ファイルの値
+        pyramid_levels (int or None): pyramidのときの縮小回数。Noneのとき製品の設定ファイルの値
+        compare_mode (str or None): 指定した場合、このマッチング方法でもカウントしてカウント数の差を出力する
+        tolerance (int): compare_modeでのカウント数の差の許容値
+        profile (bool): Trueのとき、段階ごとの処理時間の平均と最大を出力する
+        deskew_mode (str or None): 前処理の回転角の求め方。Noneのとき製品の設定ファイルの値
+
+    Returns:
+        list[int or None], int: sheetsと同じ順番のカウント数(エラーになったシートはNone)、
+                                カウント数の差が許容値を超えたシートの数
+    """
+    if method != "pattern":
+        compare_mode = None
+    conditions = load_product_conditions({sheet.product_name for sheet in sheets}, matching_threshold,
+                                         matching_mode, pyramid_levels, deskew_mode)
+    args = [(i, sheet, method, conditions[sheet.product_name], compare_mode) for i, sheet in enumerate(sheets)]
+    counts = [None] * len(sheets)
+    rows = []
+    error_num = 0
+    max_diff = 0
+    over_tolerance_num = 0
+
+    start = time.perf_counter()
+    initializer = stage_timer.enable if profile else None
+    profile_timer = StageTimer(max(len(sheets), 1))  # ワーカープロセスから返ってきた記録を全シート分集める
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as executor:
+        futures = [executor.submit(count_sheet, arg) for arg in args]
+        for done_num, future in enumerate(as_completed(futures), 1):
+            index, is_count, compare_count, elapsed, error, stage_record = future.result()
+            if stage_record is not None:
+                profile_timer.records.append(stage_record)
+            sheet = sheets[index]
+            counts[index] = is_count
+            if error is not None:
+                error_num += 1
+            result_str = error if error is not None else str(is_count)
+            diff = None
+            if compare_mode is not None and error is None:
+                diff = compare_count - is_count
+                max_diff = max(max_diff, abs(diff))
+                if abs(diff) > tolerance:
+                    over_tolerance_num += 1
+                result_str += "\t{}={}\tdiff={:+d}".format(compare_mode, compare_count, diff)
+            print("[{}/{}] {}\t{}\t{}\t{}\t{}\t{:.2f}s".format(done_num, len(sheets), sheet.date, sheet.product_name,
+                                                              sheet.control_no, sheet.sheet_no, result_str, elapsed),
+                  file=out, flush=True)
+            rows.append({"date": sheet.date, "product_name": sheet.product_name, "control_No": sheet.control_no,
+                         "sheet_No": sheet.sheet_no, "good_count": is_count, "compare_count": compare_count,
+                         "diff": diff, "elapsed": round(elapsed, 3), "error": error or ""})
+    total = time.perf_counter() - start
+
+    sheets_per_sec = len(sheets) / total if total > 0 else 0.0
+    print("{} sheets, {} errors, {:.1f}s, {:.2f} sheets/s".format(len(sheets), error_num, total, sheets_per_sec),
+          file=out, flush=True)
+    if compare_mode is not None:
+        print("compare {}: max |diff| {}, {} sheets over tolerance {}".format(compare_mode, max_diff,
+                                                                             over_tolerance_num, tolerance),
+              file=out, flush=True)
+    if profile:
+        for name, (mean, max_time, num) in sorted(profile_timer.get_summary().items(), key=lambda item: -item[1][0]):
+            print("{:<24}mean {:.3f}s\tmax {:.3f}s\t({} sheets)".format(name, mean, max_time, num),
+                  file=out, flush=True)
+
+    if csv_path is not None:
+        with open(csv_path, "w", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, ["date", "product_name", "control_No", "sheet_No", "good_count",
+                                               "compare_count", "diff", "elapsed", "error"])
+            writer.writeheader()
+            writer.writerows(rows)
+    return counts, over_tolerance_num
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存済みのframe.jpgを一括で再カウントする")
+    parser.add_argument("root", nargs="?", default=result_dirs, help="count/result/ もしくは日付フォルダ")
+    parser.add_argument("--method", choices=["pattern", "contours"], default="pattern", help="カウント手法")
+    parser.add_argument("--workers", type=int, default=None, help="プロセス数(初期値: コア数)")
+    parser.add_argument("--date", nargs="*", default=None, help="対象とする日付フォルダ名")
+    parser.add_argument("--product", nargs="*", default=None, help="対象とする製品名")
+    parser.add_argument("--threshold", type=float, default=None, help="パターンマッチングの閾値を上書きする")
+    parser.add_argument("--csv", default=None, help="結果を書き出すCSVファイル")
+    parser.add_argument("--mode", choices=matching_modes, default=None, help="マッチング方法を上書きする")
+    parser.add_argument("--levels", type=int, default=None, help="pyramidのときの縮小回数を上書きする")
+    parser.add_argument("--compare", choices=matching_modes, default=None,
+                        help="このマッチング方法でもカウントしてカウント数の差を出力する")
+    parser.add_argument("--tolerance", type=int, default=0, help="--compareでのカウント数の差の許容値")
+    parser.add_argument("--profile", action="store_true", help="段階ごとの処理時間の平均と最大を出力する")
+    parser.add_argument("--deskew", choices=deskew_modes, default=None, help="前処理の回転角の求め方を上書きする")
+    args = parser.parse_args(argv)
+
+    sheets = find_sheets(args.root, args.date, args.product)
+    if not sheets:
+        print("カウント対象のframe.jpgが見つかりません: {}".format(args.root))
+        return 1
+    counts, over_tolerance_num = batch_count(sheets, args.method, args.workers, args.threshold, args.csv,
+                                             matching_mode=args.mode, pyramid_levels=args.levels,
+                                             compare_mode=args.compare, tolerance=args.tolerance,
+                                             profile=args.profile, deskew_mode=args.deskew)
+    return 0 if None not in counts and over_tolerance_num == 0 else 1
+
+
+if __name__ == "__main__":
+    freeze_support()
+    sys.exit(main())
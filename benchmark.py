@@ -0,0 +1,725 @@
+"""
+計数処理のベンチマーク
+
+固定したシート(コーパス)と合成画像に対して、前処理・パターンマッチング・輪郭検出・イレギュラー検知・
+データベース操作を実行し、処理時間のパーセンタイル、ピークメモリ、カウント数を出力する。
+基準値のJSON(ベースライン)と比較して、処理時間が遅くなった場合やカウント数がずれた場合は終了コード1で終了する。
+
+コーパスは結果フォルダのframe.jpgのパスとハッシュ値、製品の設定値、正解のカウント数を保存したJSON。
+正解のカウント数はデータベースの確認後のカウント数(correct_count)、無ければ作成時のカウント数を使う。
+画像が書き換えられていた場合はベンチマークを行わない。
+
+使い方:
+    python benchmark.py freeze count/result/20220906 --corpus bench_corpus.json  # コーパスを作成する
+    python benchmark.py run --corpus bench_corpus.json --baseline bench_baseline.json --update-baseline  # 基準値を保存する
+    python benchmark.py run --corpus bench_corpus.json --baseline bench_baseline.json  # 基準値と比較する
+    python benchmark.py run --synthetic 2  # コーパス無しで合成画像だけで測定する
+    python benchmark.py hdr count/result/20220906  # 保存されたexp-4.jpg/exp-5.jpgでHDR合成の方法を比べる
+    python benchmark.py deskew count/result/20220906  # 保存されたframe.jpgで回転角の求め方を比べる
+    python benchmark.py matching count/result/20220906  # 保存されたframe.jpgでマッチング方法を比べる
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from batch_count import find_sheets, load_product_conditions, result_dirs
+from count_contours import count_contours
+from db_manage import DatabaseManage
+from fft_matching import FFTCorrelator
+from hdr import hdr_modes, HDRMerger
+from hls_range import HLSRange
+from irregular_detection import irregular_detection
+from matching_pattern import matching_modes, PatternImage
+from pattern_store import pattern_names, PatternStore
+from preprocessing import deg_cache_check_scale, deg_cache_min_ratio, deskew_modes, Preprocess
+from setting_count import new_pattern_history
+
+
+db_file = "./count/count.db"  # データベースファイルパス
+
+cam_width = 3856  # 合成画像の幅(VideoCapture4DFKの初期値)
+cam_height = 2764  # 合成画像の高さ
+synthetic_threshold = 0.7  # 合成画像のパターンマッチングの閾値。射影変換を2回通してぼやけるので低めにする
+db_row_num = 200  # データベース操作の測定で書き込む行数
+
+time_tolerance = 0.2  # 基準値よりこの割合以上遅くなったら失敗
+min_time_diff = 0.005  # 短い処理のばらつきで失敗しないように、この秒数未満の差は無視する
+percentiles = [50, 90, 95]
+deskew_tolerance = 0.5  # houghとの回転角の差がこれ[°]を超えたら失敗
+deskew_scales = [0.5, 0.25]  # 回転角を縮小画像で求めたときの精度を確かめる縮小率
+# 回転角のキャッシュを確かめる処理に、houghの回転角からずらして渡す角度[°]。許容値を超えるずれを使ったら誤り
+deg_cache_check_offsets = [0, -0.25, 0.25, -0.5, 0.5, -1.0, 1.0, -2.0, 2.0]
+
+
+def freeze_corpus(root_dir, corpus_path, dates=None, products=None, synthetic_num=2):
+    """
+    結果フォルダのシートからコーパスを作成する
+
+    Args:
+        root_dir (str): count/result/ もしくは日付フォルダ
+        corpus_path (str): 保存するJSONファイルのパス
+        dates (list[str] or None): 対象とする日付フォルダ名
+        products (list[str] or None): 対象とする製品名
+        synthetic_num (int): 合成画像の枚数
+
+    Returns:
+        dict: コーパス
+    """
+    sheets = find_sheets(root_dir, dates, products)
+    conditions = load_product_conditions({sheet.product_name for sheet in sheets})
+    correct_counts = _load_correct_counts(sheets)
+    pattern_store = PatternStore()
+    pre_dict = {}
+    corpus_sheets = []
+    for sheet in sheets:
+        condition = conditions[sheet.product_name]
+        frame = _imread(sheet.path)
+        expected = correct_counts.get(sheet.path)
+        if expected is None:  # 確認前のシートは現在のカウント数を正解とする
+            img_rot = _get_preprocess(pre_dict, frame).preprocessing(frame, 500, 500,
+                                                                     deskew_mode=condition["deskew_mode"])
+            pat = PatternImage(15, condition["matching_threshold"], pattern_store, condition["matching_mode"],
+                               condition["pyramid_levels"])
+            _, expected, _, _, _, _, _ = pat.get_result_and_count(img_rot, condition["pattern_dir"],
+                                                                  condition["matching_threshold"], HLSRange())
+        corpus_sheets.append({"name": "/".join([sheet.date, sheet.product_name, sheet.control_no, sheet.sheet_no]),
+                              "path": sheet.path,
+                              "sha256": _sha256(sheet.path),
+                              "condition": condition,
+                              "expected": expected})
+        print("{}\t{}".format(corpus_sheets[-1]["name"], expected), flush=True)
+    corpus = {"sheets": corpus_sheets, "synthetic": {"num": synthetic_num, "seed": 0}}
+    with open(corpus_path, "w", encoding="utf-8") as f:
+        json.dump(corpus, f, ensure_ascii=False, indent=2)
+    return corpus
+
+
+def make_synthetic_sheet(pre, seed, pattern_dir):
+    """
+    製品を格子状に並べた、少し傾いた合成画像を作成する
+    射影変換後の座標で並べてから逆変換するので、前処理を通すと元の並びに戻る
+
+    Args:
+        pre (Preprocess): 合成画像のサイズのPreprocess
+        seed (int): 乱数のシード値
+        pattern_dir (str): パターン画像4枚を保存するディレクトリ(末尾に/を含む)
+
+    Returns:
+        img_bgr, int: 合成画像、並べた製品の数
+    """
+    rng = np.random.default_rng(seed)
+    width, height = pre.perspective.width, pre.perspective.height
+    background = (40, 120, 40)
+    scene = np.full((height, width, 3), background, np.uint8)
+
+    tile = np.full((120, 180, 3), (200, 200, 210), np.uint8)
+    cv2.circle(tile, (40, 60), 20, (0, 0, 200), -1)
+    cv2.rectangle(tile, (100, 20), (160, 100), (0, 160, 220), -1)
+    tile_h, tile_w = tile.shape[:2]
+    pitch_x, pitch_y = tile_w + 20, tile_h + 40
+    cols = int(width * 0.6) // pitch_x
+    rows = int(height * 0.6) // pitch_y
+    x0 = (width - cols * pitch_x) // 2
+    y0 = (height - rows * pitch_y) // 2
+    for r in range(rows):
+        for c in range(cols):
+            x, y = x0 + c * pitch_x, y0 + r * pitch_y
+            scene[y:y + tile_h, x:x + tile_w] = tile
+    scene = cv2.add(scene, rng.integers(0, 20, scene.shape, dtype=np.uint8))
+
+    deg = rng.uniform(-3, 3)
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), deg, 1)
+    scene = cv2.warpAffine(scene, matrix, (width, height), borderValue=background)
+    frame = pre.perspective.inverse_transform(scene, cam_width, cam_height, border_value=background)
+
+    # パターン画像は製品の周りに背景を少し含める
+    pattern = cv2.copyMakeBorder(tile, 3, 3, 3, 3, cv2.BORDER_CONSTANT, value=background)
+    for name in pattern_names:
+        cv2.imwrite(pattern_dir + name, pattern)
+        pattern = np.ascontiguousarray(pattern.transpose(1, 0, 2)[:, ::-1])  # 90°回転
+    return frame, rows * cols
+
+
+def run_benchmark(corpus, repeat=1, synthetic_num=None):
+    """
+    コーパスと合成画像で各処理を測定する
+
+    Args:
+        corpus (dict): freeze_corpusで作成したコーパス。Noneのとき合成画像のみ
+        repeat (int): 1枚あたりの測定回数
+        synthetic_num (int or None): 合成画像の枚数。Noneのときコーパスの値
+
+    Returns:
+        dict: stages({処理名: {p50, p90, p95, max, n}}), counts({画像名: {expected, pattern, contours}}), peak_rss_mb
+    """
+    corpus = corpus or {"sheets": [], "synthetic": {"num": 2, "seed": 0}}
+    if synthetic_num is None:
+        synthetic_num = corpus["synthetic"]["num"]
+    times = {}
+    counts = {}
+    pattern_store = PatternStore()
+    pre_dict = {}
+    temp_dir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        images = []  # (画像名, 画像, 設定値, 正解)
+        for sheet in corpus["sheets"]:
+            if _sha256(sheet["path"]) != sheet["sha256"]:
+                raise RuntimeError("コーパスの画像が変更されています: {}".format(sheet["path"]))
+            images.append((sheet["name"], _imread(sheet["path"]), sheet["condition"], sheet["expected"]))
+        for i in range(synthetic_num):
+            pattern_dir = os.path.join(temp_dir, "synthetic{}".format(i)) + "/"
+            os.makedirs(pattern_dir)
+            frame, expected = make_synthetic_sheet(_get_preprocess(pre_dict, _blank_frame()),
+                                                   corpus["synthetic"]["seed"] + i, pattern_dir)
+            condition = {"pattern_dir": pattern_dir, "matching_threshold": synthetic_threshold,
+                         "erode_size": 5, "dilate_size": 3, "thresh_area": 100,
+                         "matching_mode": "full", "pyramid_levels": 2, "deskew_mode": "hough"}
+            images.append(("synthetic{}".format(i), frame, condition, expected))
+
+        for name, frame, condition, expected in images:
+            for _ in range(repeat):
+                pattern_count, contours_count = _run_image(times, pre_dict, pattern_store, frame, condition)
+            counts[name] = {"expected": expected, "pattern": pattern_count, "contours": contours_count}
+            print("{}\texpected {}\tpattern {}\tcontours {}".format(name, expected, pattern_count, contours_count),
+                  flush=True)
+
+        for _ in range(repeat):
+            _run_db(times, os.path.join(temp_dir, "bench.db"))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {"stages": {name: _summarize(values) for name, values in times.items()},
+            "counts": counts,
+            "peak_rss_mb": get_peak_rss_mb()}
+
+
+def compare_hdr(root_dir, dates=None, products=None, repeat=1):
+    """
+    結果フォルダに保存された露出違いの2枚(exp-4.jpg, exp-5.jpg)で、HDR合成の方法ごとの処理時間とカウント数を比べる
+    legacyは変更前の処理(毎回MergeMertensを作成する)
+
+    Args:
+        root_dir (str): count/result/ もしくは日付フォルダ
+        dates (list[str] or None): 対象とする日付フォルダ名
+        products (list[str] or None): 対象とする製品名
+        repeat (int): 1組あたりの測定回数
+
+    Returns:
+        dict: stages({方法: {p50, p90, p95, max, n}}), counts({シート名: {方法: パターンマッチングのカウント数}})
+    """
+    sheets = [sheet for sheet in find_sheets(root_dir, dates, products)
+              if all(os.path.exists(os.path.join(os.path.dirname(sheet.path), name))
+                     for name in ["exp-4.jpg", "exp-5.jpg"])]
+    conditions = load_product_conditions({sheet.product_name for sheet in sheets})
+    mergers = {"legacy": _legacy_hdr}
+    mergers.update({mode: HDRMerger(mode).process for mode in hdr_modes})
+    pattern_store = PatternStore()
+    pre_dict = {}
+    times = {}
+    counts = {}
+    for sheet in sheets:
+        sheet_dir = os.path.dirname(sheet.path)
+        imgs = [_imread(os.path.join(sheet_dir, name)) for name in ["exp-4.jpg", "exp-5.jpg"]]
+        condition = conditions[sheet.product_name]
+        name = "/".join([sheet.date, sheet.product_name, sheet.control_no, sheet.sheet_no])
+        counts[name] = {}
+        for mode, merge in mergers.items():
+            for _ in range(repeat):
+                frame = _measure(times, mode, merge, imgs)
+            img_rot = _get_preprocess(pre_dict, frame).preprocessing(frame, 500, 500,
+                                                                     deskew_mode=condition["deskew_mode"])
+            pat = PatternImage(15, condition["matching_threshold"], pattern_store, condition["matching_mode"],
+                               condition["pyramid_levels"])
+            _, counts[name][mode], _, _, _, _, _ = pat.get_result_and_count(img_rot, condition["pattern_dir"],
+                                                                         condition["matching_threshold"],
+                                                                         HLSRange())
+        print(name + "".join("\t{} {}".format(mode, count) for mode, count in counts[name].items()), flush=True)
+    return {"stages": {mode: _summarize(values) for mode, values in times.items()}, "counts": counts}
+
+
+def print_hdr_report(report, out=sys.stdout):
+    """HDR合成の方法ごとの処理時間と、legacyとカウント数が異なるシートを出力する"""
+    print("{:<10}{:>6}{:>10}{:>10}{:>10}".format("mode", "n", "p50[ms]", "p95[ms]", "max[ms]"), file=out)
+    for mode, stage in report["stages"].items():
+        print("{:<10}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            mode, stage["n"], stage["p50"] * 1000, stage["p95"] * 1000, stage["max"] * 1000), file=out)
+    for mode in hdr_modes:
+        diffs = ["{} ({} -> {})".format(name, c["legacy"], c[mode]) for name, c in report["counts"].items()
+                 if c[mode] != c["legacy"]]
+        print("{}: {} / {} sheets differ from legacy{}".format(
+            mode, len(diffs), len(report["counts"]), "".join("\n  " + diff for diff in diffs)), file=out)
+    out.flush()
+
+
+def compare_deskew(root_dir, dates=None, products=None, tolerance=deskew_tolerance, scales=None):
+    """
+    結果フォルダのframe.jpgで、回転角の求め方ごとの処理時間と回転角を比べる。元の解像度で求めたhoughを基準とする
+    hough@0.5などは縮小率0.5の画像で回転角を求めたもの
+    hough_cachedはhough(縮小率はdeskew_analysis_scale)に製品ごとの回転角のキャッシュを使ったもの。
+    キャッシュはシートの順番に使っていく
+    またhoughの回転角をdeg_cache_check_offsetsだけずらして、キャッシュを確かめる処理が使うかどうかを、
+    回転角を求める画像の縮小率とdeg_cache_check_scaleの両方で調べる
+
+    Args:
+        root_dir (str): count/result/ もしくは日付フォルダ
+        dates (list[str] or None): 対象とする日付フォルダ名
+        products (list[str] or None): 対象とする製品名
+        tolerance (float): houghとの回転角の差の許容値[°]
+        scales (list[float] or None): 回転角を求める画像の縮小率。Noneのときdeskew_scales
+
+    Returns:
+        dict: stages({方法: {p50, p90, p95, max, n}}), degs({シート名: {方法: 回転角 or None}}),
+              mismatches(許容値を超えたシート名のリスト), cache_stats(Preprocess.get_deg_cache_stats),
+              cache_checks({縮小率: {ずらした角度: [使ったかどうか(bool), ...]}})
+    """
+    scales = deskew_scales if scales is None else scales
+    pre_dict = {}
+    times = {}
+    degs = {}
+    mismatches = []
+    cache_checks = {}
+    for sheet in find_sheets(root_dir, dates, products):
+        frame = _imread(sheet.path)
+        pre = _get_preprocess(pre_dict, frame, 1.0)
+        name = "/".join([sheet.date, sheet.product_name, sheet.control_no, sheet.sheet_no])
+        degs[name] = {mode: _measure(times, mode, pre.get_deg, frame, 500, 500, mode) for mode in deskew_modes}
+        for scale in scales:
+            pre = _get_preprocess(pre_dict, frame, scale)
+            for mode in deskew_modes:
+                label = "{}@{:g}".format(mode, scale)
+                degs[name][label] = _measure(times, label, pre.get_deg, frame, 500, 500, mode)
+        pre = _get_preprocess(pre_dict, frame)
+        degs[name]["hough_cached"] = _measure(times, "hough_cached", pre.get_deg, frame, 500, 500, "hough",
+                                              cache_key=sheet.product_name)
+        base = degs[name]["hough"]
+        cache = pre.deg_cache.get(sheet.product_name)
+        if base is not None and cache is not None:
+            _check_deg_cache(cache_checks, pre, frame, base, cache)
+        for mode, deg in degs[name].items():
+            if (deg is None) != (base is None) or (deg is not None and abs(deg - base) > tolerance):
+                mismatches.append(name)
+                break
+        print(name + "".join("\t{} {}".format(mode, "None" if deg is None else "{:.2f}".format(deg))
+                             for mode, deg in degs[name].items()), flush=True)
+    return {"stages": {mode: _summarize(values) for mode, values in times.items()},
+            "degs": degs,
+            "mismatches": mismatches,
+            "cache_stats": _merge_deg_cache_stats(pre_dict.values()),
+            "cache_checks": cache_checks}
+
+
+def _check_deg_cache(cache_checks, pre, frame, base, cache):
+    """houghの回転角baseをずらした角度を、キャッシュを確かめる処理が使うかどうかをcache_checksに追加する"""
+    # キャッシュの閾値・最小直線距離は縮小率での値なので、元の解像度に戻して渡す
+    min_length = round(cache["min_length"] / pre.analysis_scale)
+    threshold = round(cache["threshold"] / pre.analysis_scale)
+    for check_scale in sorted({pre.analysis_scale, deg_cache_check_scale}, reverse=True):
+        for offset in deg_cache_check_offsets:
+            ratio = pre.get_horizontal_ratio(frame, base + offset, min_length, threshold, check_scale)
+            accepted = ratio is not None and ratio >= deg_cache_min_ratio
+            cache_checks.setdefault(check_scale, {}).setdefault(offset, []).append(accepted)
+
+
+def _merge_deg_cache_stats(pres):
+    """画像サイズごとのPreprocessの回転角のキャッシュの使用状況を合計する"""
+    stats = {"hit_num": 0, "miss_num": 0, "saved_seconds": 0.0}
+    for pre in pres:
+        for key, value in pre.get_deg_cache_stats().items():
+            if key in stats:
+                stats[key] += value
+    total = stats["hit_num"] + stats["miss_num"]
+    stats["hit_rate"] = stats["hit_num"] / total if total else None
+    return stats
+
+
+def print_deskew_report(report, tolerance=deskew_tolerance, out=sys.stdout):
+    """回転角の求め方ごとの処理時間と、houghとの回転角の差の最大を出力する"""
+    print("{:<14}{:>6}{:>10}{:>10}{:>10}{:>12}".format("mode", "n", "p50[ms]", "p95[ms]", "max[ms]", "max|diff|"),
+          file=out)
+    for mode, stage in report["stages"].items():
+        diffs = [abs(d[mode] - d["hough"]) for d in report["degs"].values()
+                 if d[mode] is not None and d["hough"] is not None]
+        print("{:<14}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.2f}".format(
+            mode, stage["n"], stage["p50"] * 1000, stage["p95"] * 1000, stage["max"] * 1000, max(diffs, default=0)),
+            file=out)
+    print("{} / {} sheets differ from hough by more than {} deg".format(
+        len(report["mismatches"]), len(report["degs"]), tolerance), file=out)
+    for name in report["mismatches"]:
+        print("  " + name, file=out)
+    cache_stats = report["cache_stats"]
+    print("hough_cached: hit {} / {} sheets, saved {:.2f} s".format(
+        cache_stats["hit_num"], cache_stats["hit_num"] + cache_stats["miss_num"], cache_stats["saved_seconds"]),
+        file=out)
+    # キャッシュを確かめる処理が、ずらした回転角を使った割合。許容値を超えるずれを使ったものは誤り
+    offsets = deg_cache_check_offsets
+    print("cache check accepted [%] by offset from hough [deg]", file=out)
+    print("{:<14}".format("check_scale") + "".join("{:>7g}".format(offset) for offset in offsets)
+          + "{:>16}".format("wrong accepts"), file=out)
+    for check_scale, checks in report["cache_checks"].items():
+        wrong = sum(sum(checks[offset]) for offset in offsets if abs(offset) > tolerance)
+        total = sum(len(checks[offset]) for offset in offsets if abs(offset) > tolerance)
+        print("{:<14g}".format(check_scale)
+              + "".join("{:>7.0f}".format(100 * sum(checks[offset]) / len(checks[offset])) for offset in offsets)
+              + "{:>16}".format("{} / {}".format(wrong, total)), file=out)
+    out.flush()
+
+
+def compare_matching(root_dir, dates=None, products=None, repeat=1):
+    """
+    結果フォルダのframe.jpgで、マッチング方法ごとの処理時間とカウント数を比べる
+    fftはcv2.matchTemplate(TM_CCOEFF_NORMED)とのマッチング結果の差も求める
+    historyはfullに製品ごとのパターン画像の採用履歴を使ったもの。履歴はシートの順番に溜めていく(最初の数枚は4枚でマッチングする)
+    roiはfullを縮小画像で求めた製品の範囲だけで行ったもの
+
+    Args:
+        root_dir (str): count/result/ もしくは日付フォルダ
+        dates (list[str] or None): 対象とする日付フォルダ名
+        products (list[str] or None): 対象とする製品名
+        repeat (int): 1枚あたりの測定回数
+
+    Returns:
+        dict: stages({方法: {p50, p90, p95, max, n}}), counts({シート名: {方法: カウント数}}),
+              fft_diffs({シート名: {max_diff, flipped}}) max_diff: マッチング結果の差の最大、flipped: 閾値の判定が変わった点の数
+              histories({製品名: 採用履歴}), roi_skipped({シート名: roiで省いた画素の割合})
+    """
+    sheets = find_sheets(root_dir, dates, products)
+    conditions = load_product_conditions({sheet.product_name for sheet in sheets})
+    pattern_store = PatternStore()
+    pre_dict = {}
+    times = {}
+    counts = {}
+    fft_diffs = {}
+    histories = {product_name: new_pattern_history() for product_name in conditions}
+    roi_skipped = {}
+    for sheet in sheets:
+        condition = conditions[sheet.product_name]
+        frame = _imread(sheet.path)
+        img_rot = _get_preprocess(pre_dict, frame).preprocessing(frame, 500, 500,
+                                                                 deskew_mode=condition["deskew_mode"])
+        name = "/".join([sheet.date, sheet.product_name, sheet.control_no, sheet.sheet_no])
+        counts[name] = {}
+        for mode in matching_modes:
+            pat = PatternImage(15, condition["matching_threshold"], pattern_store, mode, condition["pyramid_levels"])
+            for _ in range(repeat):
+                _, counts[name][mode], _, _, _, _, _ = _measure(
+                    times, mode, pat.get_result_and_count, img_rot, condition["pattern_dir"],
+                    condition["matching_threshold"], HLSRange())
+        pat = PatternImage(15, condition["matching_threshold"], pattern_store, "full", condition["pyramid_levels"],
+                           history=histories[sheet.product_name])
+        _, counts[name]["history"], _, _, _, _, _ = _measure(
+            times, "history", pat.get_result_and_count, img_rot, condition["pattern_dir"],
+            condition["matching_threshold"], HLSRange())
+        pat = PatternImage(15, condition["matching_threshold"], pattern_store, "full", condition["pyramid_levels"],
+                           tray_roi=True)
+        _, counts[name]["roi"], _, _, _, _, _ = _measure(
+            times, "roi", pat.get_result_and_count, img_rot, condition["pattern_dir"],
+            condition["matching_threshold"], HLSRange())
+        roi_skipped[name] = pat.roi_skipped
+
+        img_rot_gray = cv2.cvtColor(img_rot, cv2.COLOR_BGR2GRAY)
+        correlator = FFTCorrelator(img_rot_gray)
+        max_diff, flipped = 0.0, 0
+        for pattern in pattern_store.get(condition["pattern_dir"]):
+            expected = cv2.matchTemplate(img_rot_gray, pattern.gray, cv2.TM_CCOEFF_NORMED)
+            res = correlator.match(pattern)
+            max_diff = max(max_diff, float(np.abs(res - expected).max()))
+            flipped += int(np.count_nonzero((res >= condition["matching_threshold"])
+                                            != (expected >= condition["matching_threshold"])))
+        fft_diffs[name] = {"max_diff": max_diff, "flipped": flipped}
+        print(name + "".join("\t{} {}".format(mode, count) for mode, count in counts[name].items())
+              + "\tfft max|diff| {:.2e} flipped {}".format(max_diff, flipped)
+              + "\troi skipped {:.1%}".format(roi_skipped[name]), flush=True)
+    return {"stages": {mode: _summarize(values) for mode, values in times.items()},
+            "counts": counts,
+            "fft_diffs": fft_diffs,
+            "histories": histories,
+            "roi_skipped": roi_skipped}
+
+
+def print_matching_report(report, out=sys.stdout):
+    """マッチング方法ごとの処理時間と、fullとカウント数が異なるシートの数を出力する"""
+    print("{:<10}{:>6}{:>10}{:>10}{:>10}".format("mode", "n", "p50[ms]", "p95[ms]", "max[ms]"), file=out)
+    for mode, stage in report["stages"].items():
+        print("{:<10}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            mode, stage["n"], stage["p50"] * 1000, stage["p95"] * 1000, stage["max"] * 1000), file=out)
+    for mode in matching_modes[1:] + ["history", "roi"]:
+        diff_num = sum(1 for c in report["counts"].values() if c[mode] != c["full"])
+        print("{}: {} / {} sheets differ from full".format(mode, diff_num, len(report["counts"])), file=out)
+    print("fft vs TM_CCOEFF_NORMED: max|diff| {:.2e}, flipped points {}".format(
+        max((d["max_diff"] for d in report["fft_diffs"].values()), default=0),
+        sum(d["flipped"] for d in report["fft_diffs"].values())), file=out)
+    for product_name, history in report["histories"].items():
+        print("history {}: fast path {} / {} wins {}".format(
+            product_name, history["fast_num"], history["count_num"], history["wins"]), file=out)
+    skipped = list(report["roi_skipped"].values())
+    if skipped:
+        print("roi skipped pixels: mean {:.1%} min {:.1%} max {:.1%}".format(
+            sum(skipped) / len(skipped), min(skipped), max(skipped)), file=out)
+    out.flush()
+
+
+def _legacy_hdr(imgs):
+    """変更前のDFK.get_hdrと同じ処理"""
+    res_mertens = cv2.createMergeMertens().process(imgs)
+    return np.clip(res_mertens * 255, 0, 255).astype("uint8")
+
+
+def _run_image(times, pre_dict, pattern_store, frame, condition):
+    """1枚の画像で前処理・パターンマッチング・イレギュラー検知・輪郭検出を1回ずつ測定する"""
+    pre = _get_preprocess(pre_dict, frame)
+    img_rot = _measure(times, "preprocessing", pre.preprocessing, frame, 500, 500,
+                       deskew_mode=condition.get("deskew_mode", "hough"))  # 項目追加前のコーパスはhough
+    pat = PatternImage(15, condition["matching_threshold"], pattern_store, condition["matching_mode"],
+                       condition["pyramid_levels"])
+    result, pattern_count, img_trim, _, _, pattern_img, black = _measure(
+        times, "pattern_matching", pat.get_result_and_count, img_rot, condition["pattern_dir"],
+        condition["matching_threshold"], HLSRange())
+    _measure(times, "irregular_detection", irregular_detection, img_trim, black, pattern_img, result.copy())
+    _, contours_count = _measure(times, "count_contours", count_contours, frame, condition["erode_size"],
+                                 condition["dilate_size"], condition["thresh_area"])
+    return pattern_count, contours_count
+
+
+def _run_db(times, db_path):
+    """一時的なデータベースファイルで、結果の書き込み・検索・更新・削除を測定する"""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = DatabaseManage(db_path)
+    for i in range(db_row_num):
+        _measure(times, "db_write_row", db.write_row, "result",
+                 ("worker_name", "bench"), ("date", "2022/09/06 12:00:00"),
+                 ("file_dir", "./count/result/20220906/bench/{}/{}/".format(i // 10, i % 10)),
+                 ("figure_No", "0"), ("product_name", "bench"), ("control_No", str(i // 10)),
+                 ("sheet_No", str(i % 10)), ("theoretical_amount", 100), ("good_count", 100), ("marking_count", 0),
+                 ("no_piece", 0), ("correct_count", 100), ("false_detection", 0), ("not_detected", 0),
+                 ("count_error", 0))
+    for i in range(db_row_num):
+        _measure(times, "db_select_row", db.select_row, "result", True, control_No=str(i // 10),
+                 sheet_No=str(i % 10))
+        _measure(times, "db_update_row", db.update_row, "result", ("correct_count", 99),
+                 control_No=str(i // 10), sheet_No=str(i % 10))
+    _measure(times, "db_delete_row", db.delete_row, "result", product_name="bench")
+    db.close_sql()
+
+
+def compare_with_baseline(report, baseline, tolerance=time_tolerance):
+    """
+    基準値と比較して、遅くなった処理とカウント数がずれた画像を返す
+
+    Args:
+        report (dict): run_benchmarkの返り値
+        baseline (dict): 基準値として保存したrun_benchmarkの返り値
+        tolerance (float): 処理時間の許容する増加の割合
+
+    Returns:
+        list[str]: 基準値より悪くなった項目の説明。空のとき問題なし
+    """
+    regressions = []
+    for name, base in baseline["stages"].items():
+        current = report["stages"].get(name)
+        if current is None:
+            continue
+        for key in ["p50", "p95"]:
+            if current[key] > base[key] * (1 + tolerance) and current[key] - base[key] > min_time_diff:
+                regressions.append("time   {} {}: {:.4f}s -> {:.4f}s (+{:.0%})".format(
+                    name, key, base[key], current[key], current[key] / base[key] - 1 if base[key] > 0 else 0))
+    for name, base in baseline["counts"].items():
+        current = report["counts"].get(name)
+        if current is None:
+            continue
+        for key in ["pattern", "contours"]:
+            base_error = abs(base[key] - base["expected"])
+            error = abs(current[key] - current["expected"])
+            if error > base_error:
+                regressions.append("count  {} {}: {} -> {} (expected {})".format(
+                    name, key, base[key], current[key], current["expected"]))
+    return regressions
+
+
+def print_report(report, out=sys.stdout):
+    """処理時間のパーセンタイル、カウント数、ピークメモリを表形式で出力する"""
+    print("{:<22}{:>6}{:>10}{:>10}{:>10}{:>10}".format("stage", "n", "p50[ms]", "p90[ms]", "p95[ms]", "max[ms]"),
+          file=out)
+    for name, stage in report["stages"].items():
+        print("{:<22}{:>6}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            name, stage["n"], stage["p50"] * 1000, stage["p90"] * 1000, stage["p95"] * 1000, stage["max"] * 1000),
+            file=out)
+    pattern_error = sum(abs(c["pattern"] - c["expected"]) for c in report["counts"].values())
+    print("count error (sum of |count - expected|): pattern {}, contours {}".format(
+        pattern_error, sum(abs(c["contours"] - c["expected"]) for c in report["counts"].values())), file=out)
+    if report["peak_rss_mb"] is not None:
+        print("peak RSS: {:.1f} MB".format(report["peak_rss_mb"]), file=out)
+    out.flush()
+
+
+def get_peak_rss_mb():
+    """
+    このプロセスのピークメモリ使用量を返す。取得できない環境ではNone
+    Linux/macOSはresource、Windowsはpsutilがインストールされていれば使う
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024  # macOSはbyte、LinuxはKB
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+    except (ImportError, AttributeError):
+        return None
+
+
+def _measure(times, name, fn, *args, **kwargs):
+    """fnを実行して処理時間をtimes[name]に追加し、返り値を返す"""
+    start = time.perf_counter()
+    ret = fn(*args, **kwargs)
+    times.setdefault(name, []).append(time.perf_counter() - start)
+    return ret
+
+
+def _summarize(values):
+    """処理時間のリストからパーセンタイルと最大値を計算する"""
+    summary = {"p{}".format(p): float(np.percentile(values, p)) for p in percentiles}
+    summary["max"] = float(np.max(values))
+    summary["n"] = len(values)
+    return summary
+
+
+def _load_correct_counts(sheets):
+    """データベースから確認後のカウント数を取得する。{frame.jpgのパス: correct_count}"""
+    correct_counts = {}
+    if not os.path.exists(db_file):
+        return correct_counts
+    db = DatabaseManage(db_file)
+    for sheet in sheets:
+        file_dir = result_dirs + "/".join([sheet.date, sheet.product_name, sheet.control_no, sheet.sheet_no]) + "/"
+        response = db.select_row("result", False, "correct_count", file_dir=file_dir)
+        if response[0][1] and response[0][1][-1] is not None:
+            correct_counts[sheet.path] = response[0][1][-1]
+    db.close_sql()
+    return correct_counts
+
+
+def _get_preprocess(pre_dict, frame, analysis_scale=None):
+    """画像サイズと回転角を求める画像の縮小率に合ったPreprocessを返す。同じであれば使いまわす"""
+    height, width = frame.shape[:2]
+    key = (width, height, analysis_scale)
+    if key not in pre_dict:
+        pre_dict[key] = Preprocess(width, height, analysis_scale)
+    return pre_dict[key]
+
+
+def _blank_frame():
+    """合成画像のサイズの空の画像(Preprocessの取得用)"""
+    return np.empty((cam_height, cam_width, 3), np.uint8)
+
+
+def _imread(path):
+    """ファイル名に日本語が含まれている場合を考慮して、デコードして画像を読み込む"""
+    n = np.fromfile(path, dtype=np.uint8)
+    return cv2.imdecode(n, cv2.IMREAD_COLOR)
+
+
+def _sha256(path):
+    """ファイルのハッシュ値"""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="計数処理のベンチマーク")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_freeze = subparsers.add_parser("freeze", help="結果フォルダのシートからコーパスを作成する")
+    parser_freeze.add_argument("root", nargs="?", default=result_dirs, help="count/result/ もしくは日付フォルダ")
+    parser_freeze.add_argument("--corpus", default="bench_corpus.json", help="保存するコーパスのJSONファイル")
+    parser_freeze.add_argument("--date", nargs="*", default=None, help="対象とする日付フォルダ名")
+    parser_freeze.add_argument("--product", nargs="*", default=None, help="対象とする製品名")
+    parser_freeze.add_argument("--synthetic", type=int, default=2, help="合成画像の枚数")
+
+    parser_run = subparsers.add_parser("run", help="ベンチマークを実行する")
+    parser_run.add_argument("--corpus", default=None, help="コーパスのJSONファイル。無い場合は合成画像のみ")
+    parser_run.add_argument("--baseline", default=None, help="基準値のJSONファイル")
+    parser_run.add_argument("--update-baseline", action="store_true", help="結果を基準値として保存する")
+    parser_run.add_argument("--repeat", type=int, default=1, help="1枚あたりの測定回数")
+    parser_run.add_argument("--synthetic", type=int, default=None, help="合成画像の枚数を上書きする")
+    parser_run.add_argument("--tolerance", type=float, default=time_tolerance, help="処理時間の許容する増加の割合")
+    parser_run.add_argument("--json", default=None, help="結果を書き出すJSONファイル")
+
+    parser_hdr = subparsers.add_parser("hdr", help="保存されたexp-4.jpg/exp-5.jpgでHDR合成の方法を比べる")
+    parser_hdr.add_argument("root", nargs="?", default=result_dirs, help="count/result/ もしくは日付フォルダ")
+    parser_hdr.add_argument("--date", nargs="*", default=None, help="対象とする日付フォルダ名")
+    parser_hdr.add_argument("--product", nargs="*", default=None, help="対象とする製品名")
+    parser_hdr.add_argument("--repeat", type=int, default=1, help="1組あたりの測定回数")
+
+    parser_deskew = subparsers.add_parser("deskew", help="保存されたframe.jpgで回転角の求め方を比べる")
+    parser_deskew.add_argument("root", nargs="?", default=result_dirs, help="count/result/ もしくは日付フォルダ")
+    parser_deskew.add_argument("--date", nargs="*", default=None, help="対象とする日付フォルダ名")
+    parser_deskew.add_argument("--product", nargs="*", default=None, help="対象とする製品名")
+    parser_deskew.add_argument("--tolerance", type=float, default=deskew_tolerance, help="houghとの回転角の差の許容値[°]")
+    parser_deskew.add_argument("--scale", type=float, nargs="*", default=None,
+                               help="回転角を求める画像の縮小率(初期値: {})".format(deskew_scales))
+
+    parser_matching = subparsers.add_parser("matching", help="保存されたframe.jpgでマッチング方法を比べる")
+    parser_matching.add_argument("root", nargs="?", default=result_dirs, help="count/result/ もしくは日付フォルダ")
+    parser_matching.add_argument("--date", nargs="*", default=None, help="対象とする日付フォルダ名")
+    parser_matching.add_argument("--product", nargs="*", default=None, help="対象とする製品名")
+    parser_matching.add_argument("--repeat", type=int, default=1, help="1枚あたりの測定回数")
+    args = parser.parse_args(argv)
+
+    if args.command == "freeze":
+        freeze_corpus(args.root, args.corpus, args.date, args.product, args.synthetic)
+        return 0
+    if args.command == "hdr":
+        report = compare_hdr(args.root, args.date, args.product, args.repeat)
+        print_hdr_report(report)
+        return 1 if any(len(set(c.values())) > 1 for c in report["counts"].values()) else 0
+    if args.command == "deskew":
+        report = compare_deskew(args.root, args.date, args.product, args.tolerance, args.scale)
+        print_deskew_report(report, args.tolerance)
+        return 1 if report["mismatches"] else 0
+    if args.command == "matching":
+        report = compare_matching(args.root, args.date, args.product, args.repeat)
+        print_matching_report(report)
+        return 1 if any(c["fft"] != c["full"] or c["roi"] != c["full"] for c in report["counts"].values()) else 0
+
+    corpus = None
+    if args.corpus is not None:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = json.load(f)
+    report = run_benchmark(corpus, args.repeat, args.synthetic)
+    print_report(report)
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline is None:
+        return 0
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print("baseline saved: {}".format(args.baseline))
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(report, baseline, args.tolerance)
+    if regressions:
+        print("REGRESSION against {}:".format(args.baseline), file=sys.stderr)
+        for regression in regressions:
+            print("  " + regression, file=sys.stderr)
+        return 1
+    print("OK: no regression against {}".format(args.baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
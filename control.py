@@ -1,9 +1,9 @@
 from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
 import os
-import pickle
 import re
 import shutil
+import time
 import tkinter.filedialog as tkfd
 import webbrowser
 
@@ -12,16 +12,21 @@ import numpy as np
 from PIL import Image, ImageTk
 
 import translate_word
+from artifact_writer import ArtifactWriter
 from count_contours import count_contours
 from db_manage import DatabaseManage
+from frame_buffer import share, writable
 from hls_range import HLSRange
-from matching_pattern import PatternImage
+from matching_pattern import MatchingCancelled, PatternImage
 from output_html import output_html, LabelHTMLWriter
+from pattern_store import PatternStore
 from preprocessing import Preprocess
 from qr_code import QRCodeBase64Generator
-from setting_count import load_setting_file
-from write_csv import make_csv_file
-from dfk4tk import VideoCapture4DFK
+from setting_count import load_deskew_setting, load_matching_setting, load_pattern_history, load_setting_file, \
+    new_pattern_history, pattern_history_filename, save_pattern_history
+from stage_timer import stage_timer
+from dfk4tk import open_camera
+from worker_pool import WorkerPool
 
 
 db_file = "./count/count.db"  # データベースファイルパス
@@ -31,10 +36,24 @@ result_dirs = "./count/result/"  # 結果を保存するディレクトリ
 log_dirs = "./count/log/"  # ログファイルを保存するディレクトリ
 excel_dirs = "./count/report/"  # 出力したエクセルを保存するディレクトリ
 setting_dir = "./count/setting/"  # 検出アルゴリズムの設定ファイルを保存するディレクトリ
+worker_num = 4  # パターンマッチング・イレギュラー検知で共有するスレッド数
+writer_queue_size = 8  # 保存待ちの最大数。いっぱいになるとカウント側が待つ
+fsync_policy = "flush"  # 保存したファイルをfsyncするタイミング "none", "flush" or "always"
+frame_round_trip = True  # Trueのとき、frame.jpgに保存される画像と同じJPEG圧縮後の画像でカウントする(メモリ上で行う)
+use_pattern_history = True  # Trueのとき、製品ごとにいつも採用されるパターン画像だけで確かめて、4枚のマッチングを省く
+# 採用履歴は変わってからこの秒数以上保存していない場合だけ、採用履歴のファイルにバックグラウンドで保存する。終了時には必ず保存する
+pattern_history_save_interval = 60.0
+use_deg_cache = True  # Trueのとき、同じ製品で前回求めた回転角を1回の直線検出で確かめ、正しければ回転角の探索を省く
+use_tray_roi = True  # Trueのとき、縮小画像で求めた製品が並んでいる範囲だけでマッチング・計数を行う
+stage_timing = False  # Trueのとき、計数処理の段階ごとの処理時間を結果の日付ディレクトリのstage_time.csvに記録する
 
 fTyp = [("画像ファイル", "*.jpg;*.png")]  # 参照ファイルのファイル形式と拡張子
 
 
+class CountCancelled(Exception):
+    """run_countが中止されたときに送出する"""
+
+
 class Control(object):
     def __init__(self, iDir=None):
         # ディレクトリの初期設定
@@ -71,6 +90,9 @@ class Control(object):
         self.erode = 5
         self.dilate = 3
         self.thresh_area = 100
+        self.matching_mode = "full"  # パターンマッチングの方法 "full", "pyramid" or "fft"
+        self.pyramid_levels = 2  # pyramidのときの縮小回数
+        self.deskew_mode = "hough"  # 前処理の回転角の求め方 "hough" or "profile"
         self.yield_rate_limit = 80
         self.hls_range = HLSRange()
         # 製品情報がない場合は、初期設定として、comboboxに"製品情報を登録してください"のメッセージを表示
@@ -84,8 +106,87 @@ class Control(object):
         self.test = False
         self.label_html_writer = LabelHTMLWriter()
         self.qr_code_generator = QRCodeBase64Generator()
-        self.cap = VideoCapture4DFK()
+        self.cap = open_camera()
+        stage_timer.enable(stage_timing)
+        self.pool = WorkerPool(worker_num)  # 計数処理で共有するスレッドプール。終了時にshutdownで止める
         self.pre = Preprocess(self.cap.w, self.cap.h)
+        # 撮影画像・結果画像・結果CSV・データベースの結果行をバックグラウンドで保存する
+        self.writer = ArtifactWriter(db_file, writer_queue_size, fsync_policy, log_dirs + "write_error.txt")
+        self.pattern_store = PatternStore()  # 製品ごとのパターン画像を保持する
+        self.pattern_histories = {}  # {製品名: パターン画像の採用履歴}。設定ファイルから読み込んだものを更新していく
+        self._history_saved_time = {}  # {製品名: 採用履歴を最後に保存(もしくは読み込み)した時刻}
+        self._history_unsaved = set()  # 採用履歴が変わってから保存していない製品名
+        self.roi_skipped = None  # 直前のシートで、製品の範囲の外側として省いた画素の割合。輪郭検出のときはNone
+
+    def get_pool_stats(self, reset_max_queued=False):
+        """
+        計数処理のスレッドプールの待ち行列の長さや処理時間の合計を返す
+
+        Args:
+            reset_max_queued (bool): Trueのとき、待ち行列の長さの最大値を戻す(次のシートの最大値を取る)
+
+        Returns:
+            dict: WorkerPool.get_statsの返り値
+        """
+        return self.pool.get_stats(reset_max_queued)
+
+    def shutdown(self):
+        """
+        ウィンドウを閉じるときに呼び出し、採用履歴と画像の保存が終わるのを待ってからスレッドプールを終了する
+        """
+        for product_name in list(self._history_unsaved):
+            self._save_pattern_history(product_name, self.pattern_histories[product_name])
+        self.writer.close()
+        self.pool.shutdown()
+
+    def get_matching_stats(self, product_name):
+        """
+        製品のパターン画像の採用履歴と、4枚のマッチングを省けた割合を返す
+
+        Returns:
+            dict: wins({パターン画像名: 採用回数}), fast_num, count_num, fast_rate(count_numが0のときNone)
+        """
+        history = self._get_pattern_history(product_name)
+        stats = dict(history, wins=dict(history["wins"]))
+        stats["fast_rate"] = history["fast_num"] / history["count_num"] if history["count_num"] else None
+        return stats
+
+    def get_deskew_stats(self):
+        """
+        回転角のキャッシュの使用状況を返す
+
+        Returns:
+            dict: hit_num, miss_num, hit_rate(hit_numとmiss_numが0のときNone), saved_seconds(省けた時間の見積もり[s])
+        """
+        return self.pre.get_deg_cache_stats()
+
+    def _get_pattern_history(self, product_name):
+        """製品のパターン画像の採用履歴。初めて使う製品は設定ファイルから読み込む"""
+        if product_name not in self.pattern_histories:
+            self.pattern_histories[product_name] = load_pattern_history(setting_dir, product_name)
+            self._history_saved_time[product_name] = time.perf_counter()
+        return self.pattern_histories[product_name]
+
+    def _pattern_history_changed(self, product_name):
+        """
+        採用履歴を更新したときに呼び出す。保存してからpattern_history_save_interval以上経っていれば保存する
+        毎シート設定ファイルを書き直さないように、それまでは保存しないままにする
+        """
+        self._history_unsaved.add(product_name)
+        if time.perf_counter() - self._history_saved_time.get(product_name, 0.0) >= pattern_history_save_interval:
+            self._save_pattern_history(product_name, self.pattern_histories[product_name])
+
+    def _save_pattern_history(self, product_name, history):
+        """
+        採用履歴をファイルに保存する。画像の保存と同じスレッドで順番に行うので、カウントを待たせない
+        :param history: new_pattern_historyの形式、Noneのとき履歴を消す
+        """
+        # 保存するまでにカウントのスレッドが書き換えないように、その時点の内容を渡す
+        snapshot = None if history is None else dict(history, wins=dict(history["wins"]))
+        self.writer.write_with(pattern_history_filename(setting_dir, product_name), save_pattern_history,
+                               setting_dir, product_name, snapshot)
+        self._history_unsaved.discard(product_name)
+        self._history_saved_time[product_name] = time.perf_counter()
 
     def set_hls_range(self, h_range_width, l_range_width, s_range_width):
         """
@@ -122,13 +223,16 @@ class Control(object):
             h_range = 30
             l_range = 30
             s_range = 30
+        self.matching_mode, self.pyramid_levels = load_matching_setting(setting_dir, product_name)
+        self.deskew_mode = load_deskew_setting(setting_dir, product_name)
         self.set_hls_range(h_range, l_range, s_range)  # 設定が変更されたら変更する
 
-    def file_open(self, parent, preprocess):
+    def file_open(self, parent, preprocess, product_name=None):
         """
         ダイアログからファイルを呼び出して、画像の配列を返す
         :param parent: ファイル参照する親ウィンドウ parentを指定しなかった場合、ダイアログを呼び出すと、rootウィンドウが上にくる
         :param preprocess: 呼び出した画像に前処理をするかどうか
+        :param product_name: 前処理の回転角の求め方を設定ファイルから読み込む製品名。Noneのときは選択中の製品の求め方
         :return: 呼び出した画像の配列
         """
         filename = tkfd.askopenfilename(filetypes=fTyp, initialdir=self.iDir, parent=parent)
@@ -138,7 +242,8 @@ class Control(object):
         # 初期設定のディレクトリを開いたディレクトリで上書きする
         self.iDir = os.path.dirname(filename)
         if preprocess == 1:  # 前処理をする場合
-            frame = self.pre.preprocessing(frame, 500, 500)
+            deskew_mode = self.deskew_mode if product_name is None else load_deskew_setting(setting_dir, product_name)
+            frame = self.pre.preprocessing(frame, 500, 500, deskew_mode=deskew_mode)
         return frame
 
     def start_regi(self):
@@ -202,6 +307,7 @@ class Control(object):
               h_range=None, l_range=None, s_range=None,
               erode_size=None, dilate_size=None, thresh_area=None):
         """
+        prepare_countとrun_countを続けて行う
         :param num: 手法を決める数値
         :param product_name: str
         :param control_no: str
@@ -218,90 +324,180 @@ class Control(object):
         :param thresh_area: 除外面積
         :return: result または エラーがある場合False,None
         """
+        prepared = self.prepare_count(product_name, control_no, sheet_no)
+        if prepared is None or prepared is False:
+            return prepared
+        dir_name, pattern_dir = prepared
+        return self.run_count(num, product_name, control_no, sheet_no, dir_name, pattern_dir, dialog, cap, frame,
+                              matching_threshold, erode_size=erode_size, dilate_size=dilate_size,
+                              thresh_area=thresh_area)
+
+    def prepare_count(self, product_name, control_no, sheet_no):
+        """
+        データベースから製品情報を取得し、結果を保存するディレクトリを作成する
+        データベースはスレッドをまたいで使えないので、run_countを別スレッドで行う場合もこちらはTkのスレッドで呼び出す
+        :param product_name: str
+        :param control_no: str
+        :param sheet_no: str
+        :return: (結果のディレクトリ, パターン画像のディレクトリ)
+                 または 製品情報がない場合None, この管理No, シートNoの結果が既に存在する場合False
+        """
         # 製品情報の取得
         response = self.db.select_row("product", False, "marking", "figure_No", "theoretical_amount", "dir_name",
                                       "yield_rate_limit", product_name=product_name)
         if not response[0][1]:  # 製品情報がない場合
             return None
-        else:
-            # 製品情報がある場合
-            self.check_result_dir_day_exists()  # 日付が変わっていたら、新しい日付フォルダを作成する
-            product_dir_name = self.result_dir_day + product_name + "/"
-            exist_product_dir = os.path.exists(product_dir_name)
-            if exist_product_dir is False:
-                os.makedirs(product_dir_name, exist_ok=True)
-            self.figure_no = response[1][1][0]
-            self.theoretical_amount = response[2][1][0]
-            self.yield_rate_limit = response[4][1][0]
-            pattern_dir = response[3][1][0]
-            dirs_name = product_dir_name + control_no + "/"
-            dirs_exist = os.path.exists(dirs_name)  # 管理Noのついたファイルがあるかどうか確認
-            if dirs_exist is False:
-                os.makedirs(dirs_name, exist_ok=True)  # ない場合作成
-            dir_name = dirs_name + sheet_no + "/"
-            # この管理No, シートNoを持つ製品が過去に存在しないかどうか確認する
-            response = self.db.select_row("result", True, control_No=control_no, sheet_No=sheet_no)
-            if not response[0][1]:  # 存在しない場合 response = [("marking", []), ("figureNo", []),...]となっているはず
-                os.makedirs(dir_name, exist_ok=True)
-                path = dir_name + "frame.jpg"
-                # 画像を撮影した場合
-                if dialog is False:
-                    img1 = cap.set_exp_and_get_image(-4)  # 露光の高い画像を取得
-                    path1 = dir_name + "exp-4.jpg"
-                    ext = os.path.splitext(path1)[1]  # 日本語を含むファイル名を扱う
-                    result_encode, n = cv2.imencode(ext, img1)  # 画像をエンコード
-                    with open(path1, mode='w+b') as f:
-                        n.tofile(f)  # 撮影画像の保存
-                    img2 = cap.set_exp_and_get_image(-5)  # 露光の低い画像を取得
-                    path2 = dir_name + "exp-5.jpg"
-                    ext = os.path.splitext(path2)[1]  # 日本語を含むファイル名を扱う
-                    result_encode, n = cv2.imencode(ext, img2)  # 画像をエンコード
-                    with open(path2, mode='w+b') as f:
-                        n.tofile(f)  # 撮影画像の保存
-                    frame = cap.get_hdr(img1, img2)  # HDRを使用して画像を合成
-                ext = os.path.splitext(path)[1]  # 日本語を含むファイル名を扱う
-                result_encode, n = cv2.imencode(ext, frame)  # 画像をエンコード
-                with open(path, mode='w+b') as f:
-                    n.tofile(f)  # 撮影画像の保存
-                # 保存した画像を呼び出してからカウント開始する
-                n = np.fromfile(path, dtype=np.uint8)
-                frame = cv2.imdecode(n, cv2.IMREAD_COLOR)
-                if num == 0:
-                    img_rot = self.pre.preprocessing(frame, 500, 500)  # 射影変換などの前処理
-                    pat = PatternImage(15, self.matching_threshold)
-                    # パターンマッチング
+        # 製品情報がある場合
+        self.check_result_dir_day_exists()  # 日付が変わっていたら、新しい日付フォルダを作成する
+        product_dir_name = self.result_dir_day + product_name + "/"
+        exist_product_dir = os.path.exists(product_dir_name)
+        if exist_product_dir is False:
+            os.makedirs(product_dir_name, exist_ok=True)
+        self.figure_no = response[1][1][0]
+        self.theoretical_amount = response[2][1][0]
+        self.yield_rate_limit = response[4][1][0]
+        pattern_dir = response[3][1][0]
+        dirs_name = product_dir_name + control_no + "/"
+        dirs_exist = os.path.exists(dirs_name)  # 管理Noのついたファイルがあるかどうか確認
+        if dirs_exist is False:
+            os.makedirs(dirs_name, exist_ok=True)  # ない場合作成
+        dir_name = dirs_name + sheet_no + "/"
+        # この管理No, シートNoを持つ製品が過去に存在しないかどうか確認する
+        response = self.db.select_row("result", True, control_No=control_no, sheet_No=sheet_no)
+        # 存在しない場合 response = [("marking", []), ("figureNo", []),...]となっているはず
+        # データベースへの書き込み待ちの結果も存在するものとして扱う
+        if response[0][1] or self.writer.is_result_pending(control_no, sheet_no):
+            return False  # 既に存在している場合、エラーを返す
+        os.makedirs(dir_name, exist_ok=True)
+        return dir_name, pattern_dir
+
+    def run_count(self, num, product_name, control_no, sheet_no, dir_name, pattern_dir, dialog, cap, frame,
+                  matching_threshold=None, erode_size=None, dilate_size=None, thresh_area=None,
+                  progress=None, cancel_event=None):
+        """
+        撮影・HDR合成・前処理・カウントを行う。データベースは使わないので、Tkとは別のスレッドで実行できる
+        :param num: 手法を決める数値
+        :param product_name: str
+        :param control_no: str
+        :param sheet_no: str
+        :param dir_name: prepare_countで作成した結果のディレクトリ
+        :param pattern_dir: prepare_countで取得したパターン画像のディレクトリ
+        :param dialog: True or False
+        :param cap: dfk4tk.VideoCapture4DFK()
+        :param frame: カウントする画像
+        :param matching_threshold: パターンマッチングの閾値
+        :param erode_size: 収縮量
+        :param dilate_size: 膨張量
+        :param thresh_area: 除外面積
+        :param progress: 処理の段階が変わるごとに呼び出す関数 progress(段階の番号, 段階の数, 段階名)
+        :param cancel_event: threading.Event setされると次の段階に進む前(マッチング中はパターン画像ごと)にCountCancelledを送出する
+        :return: result
+        """
+        step_num = 5 if dialog is False else 3
+
+        def report(step, text):
+            """中止されていないか確認してから、進み具合を知らせる"""
+            if cancel_event is not None and cancel_event.is_set():
+                raise CountCancelled()
+            if progress is not None:
+                progress(step, step_num, text)
+
+        stage_timer.begin(product_name + "/" + control_no + "/" + sheet_no)
+        try:
+            path = dir_name + "frame.jpg"
+            step = 0
+            # 画像を撮影した場合
+            if dialog is False:
+                step += 1
+                report(step, "撮影")
+                img1, img2 = cap.get_bracket([-4, -5])  # 露光の高い画像と低い画像を続けて取得
+                self.writer.write_image(dir_name + "exp-4.jpg", img1)  # 撮影画像の保存
+                self.writer.write_image(dir_name + "exp-5.jpg", img2)  # 撮影画像の保存
+                step += 1
+                report(step, "HDR合成")
+                frame = cap.get_hdr(img1, img2)  # HDRを使用して画像を合成
+            if frame_round_trip:
+                # 保存した画像を読み込んだときと同じ画像でカウントする。ディスクへの書き込みはバックグラウンドで行う
+                with stage_timer.stage("jpeg_encode"):
+                    ext = os.path.splitext(path)[1]  # 日本語を含むファイル名を扱う
+                    result_encode, n = cv2.imencode(ext, frame)  # 画像をエンコード
+                self.writer.write_encoded(path, n)  # 撮影画像の保存
+                with stage_timer.stage("jpeg_decode"):
+                    frame = cv2.imdecode(n, cv2.IMREAD_COLOR)
+            else:
+                frame = share(frame)  # 保存が終わるまで書き換えない
+                self.writer.write_image(path, frame)  # 撮影画像の保存
+            if num == 0:
+                step += 1
+                report(step, "前処理")
+                with stage_timer.stage("preprocessing"):
+                    # 前処理後の画像はこの関数の中でしか使わないので、前回の配列に上書きする
+                    img_rot = self.pre.preprocessing(frame, 500, 500, cancel_event, self.deskew_mode, reuse_output=True,
+                                                     cache_key=product_name if use_deg_cache else None)  # 射影変換などの前処理
+                deskew_stats = self.get_deskew_stats()
+                if use_deg_cache and deskew_stats["hit_rate"] is not None:
+                    # シートごとのdeg_cache_hit, deg_cache_savedはPreprocessが記録する。ここでは起動してからの合計
+                    stage_timer.set_value("deg_cache_hit_rate", round(deskew_stats["hit_rate"], 4))
+                    stage_timer.set_value("deg_cache_saved_total", round(deskew_stats["saved_seconds"], 4))
+                step += 1
+                report(step, "マッチング")
+                history = self._get_pattern_history(product_name) if use_pattern_history else None
+                pat = PatternImage(15, self.matching_threshold, self.pattern_store,
+                                   self.matching_mode, self.pyramid_levels, self.pool, history, use_tray_roi)
+                # パターンマッチング。時間がかかるので、パターン画像ごとに中止されていないか確認する
+                should_cancel = cancel_event.is_set if cancel_event is not None else None
+                try:
                     if matching_threshold is None:
-                        result, is_count, _, _, _, _, _ = pat.get_result_and_count(img_rot, pattern_dir, self.matching_threshold, self.hls_range)
+                        result, is_count, _, _, _, _, _ = pat.get_result_and_count(img_rot, pattern_dir, self.matching_threshold, self.hls_range, should_cancel)
                     else:
-                        result, is_count, _, _, _, _, _ = pat.get_result_and_count(img_rot, pattern_dir, matching_threshold, self.hls_range)
-                else:
-                    binary = pickle.dumps(frame)
-                    pickle_copy = pickle.loads(binary)
+                        result, is_count, _, _, _, _, _ = pat.get_result_and_count(img_rot, pattern_dir, matching_threshold, self.hls_range, should_cancel)
+                except MatchingCancelled:
+                    raise CountCancelled()
+                if history is not None:
+                    self._pattern_history_changed(product_name)
+                    # 採用履歴のパターン画像だけで確かめられたか(1 or 0)と、製品ごとのその割合
+                    stage_timer.set_value("history_fast", int(pat.history_fast))
+                    # マッチング中に採用履歴が消されても失敗しないように、このマッチングで使った履歴から求める
+                    if history["count_num"]:
+                        stage_timer.set_value("history_fast_rate", round(history["fast_num"] / history["count_num"], 4))
+                self.roi_skipped = pat.roi_skipped
+                if use_tray_roi:
+                    stage_timer.set_value("roi_skipped", round(pat.roi_skipped, 4))  # 製品の範囲の外側として省いた画素の割合
+            else:
+                self.roi_skipped = None
+                step += 1
+                report(step, "輪郭検出")
+                # 輪郭を描き込むので、保存中・表示中の画像と共有している場合だけ複製する
+                img = writable(frame)
+                with stage_timer.stage("count_contours"):
                     if erode_size is None:
-                        result, is_count = count_contours(pickle_copy, self.erode, self.dilate, self.thresh_area)
+                        result, is_count = count_contours(img, self.erode, self.dilate, self.thresh_area)
                     else:
-                        result, is_count = count_contours(pickle_copy, erode_size, dilate_size, thresh_area)
-                img_draw = result
-                # 結果画像の保存
-                path = dir_name + "result.jpg"
-                ext = os.path.splitext(path)[1]  # 日本語を含むファイル名を扱う
-                result_encode, n = cv2.imencode(ext, img_draw)  # ファイル名のエンコード
-                with open(path, mode='w+b') as f:
-                    n.tofile(f)  # 結果画像の保存
-                self.product_name = product_name
-                self.control_no = control_no
-                self.sheet_no = sheet_no
-                result = (dir_name, self.figure_no, self.product_name, self.control_no, self.sheet_no,
-                          self.theoretical_amount, self.yield_rate_limit, is_count, img_draw)
-                self.test = True
-                return result
-            # 既に存在している場合、エラーを返す
-            else:
-                return False
+                        result, is_count = count_contours(img, erode_size, dilate_size, thresh_area)
+            step += 1
+            report(step, "結果保存")
+            img_draw = result
+            # 結果画像の保存
+            self.writer.write_image(dir_name + "result.jpg", img_draw)  # 結果画像の保存
+            # スレッドプールが足りているかを、このシートの待ち行列の長さの最大値と起動してからの稼働率で記録する
+            pool_stats = self.get_pool_stats(reset_max_queued=True)
+            stage_timer.set_value("pool_max_queued", pool_stats["max_queued"])
+            stage_timer.set_value("pool_utilization", round(pool_stats["utilization"], 4))
+            stage_timer.end(self.result_dir_day)
+        finally:
+            stage_timer.end()  # 例外・中止で途中になった記録を閉じる(記録済みのときは何もしない)
+        self.product_name = product_name
+        self.control_no = control_no
+        self.sheet_no = sheet_no
+        result = (dir_name, self.figure_no, self.product_name, self.control_no, self.sheet_no,
+                  self.theoretical_amount, self.yield_rate_limit, is_count, img_draw)
+        self.test = True
+        return result
 
     def save_result(self, dir_name, worker_name, str_now, figure_no, product_name, control_no, sheet_no,
                     theoretical_amount, is_count, correct_count, false_detection, not_detected,
                     new_control_no, new_sheet_no):
+        self.writer.flush(dir_name)  # ディレクトリ名を変更する前に画像の保存を終わらせる
         try:
             # カウントボタンを押したときと、管理Noが変わった場合
             if new_control_no != control_no:
@@ -328,7 +524,7 @@ class Control(object):
             else:
                 count_error = 0
             # CSVファイルの作成
-            make_csv_file(csv_name,
+            self.writer.write_csv(csv_name,
                           worker_name=worker_name,
                           date=str_now,
                           file_dir=dir_name,
@@ -344,23 +540,23 @@ class Control(object):
                           count_error=count_error
                           )
             # SQLのresultテーブルに結果を記入
-            self.db.write_row("result",
-                              ("worker_name", worker_name),
-                              ("date", str_now),
-                              ("file_dir", dir_name),
-                              ("figure_No", figure_no),
-                              ("product_name", product_name),
-                              ("control_No", control_no),
-                              ("sheet_No", sheet_no),
-                              ("theoretical_amount", theoretical_amount),
-                              ("good_count", is_count),
-                              ("marking_count", 0),
-                              ("no_piece", 0),
-                              ("correct_count", correct_count),
-                              ("false_detection", false_detection),
-                              ("not_detected", not_detected),
-                              ("count_error", count_error)
-                              )
+            self.writer.write_result_row(dir_name,
+                                         ("worker_name", worker_name),
+                                         ("date", str_now),
+                                         ("file_dir", dir_name),
+                                         ("figure_No", figure_no),
+                                         ("product_name", product_name),
+                                         ("control_No", control_no),
+                                         ("sheet_No", sheet_no),
+                                         ("theoretical_amount", theoretical_amount),
+                                         ("good_count", is_count),
+                                         ("marking_count", 0),
+                                         ("no_piece", 0),
+                                         ("correct_count", correct_count),
+                                         ("false_detection", false_detection),
+                                         ("not_detected", not_detected),
+                                         ("count_error", count_error)
+                                         )
             return True
         # 存在しているファイルに名前を変更しようとした場合
         except FileExistsError:
@@ -372,6 +568,7 @@ class Control(object):
         作成したディレクトリの削除
         """
         dir_name = self.result_dir_day + product_name + "/" + control_no + "/" + sheet_no + "/"
+        self.writer.flush(dir_name)
         shutil.rmtree(dir_name)
 
     def open_result(self, control_no, sheet_no, product_name):
@@ -380,6 +577,7 @@ class Control(object):
         :return: result または False
         """
         # 結果の参照
+        self.writer.flush(kind="db")  # 書き込み待ちの結果を反映してから参照する
         response = self.db.select_row("result", False, "file_dir", "good_count", "correct_count", "false_detection",
                                       "not_detected", "date", "theoretical_amount",
                                       product_name=product_name, control_No=control_no, sheet_No=sheet_no)
@@ -396,6 +594,7 @@ class Control(object):
             date = response[5][1][0]
             theoretical_amount = response[6][1][0]
             path = dir_name + "result.jpg"
+            self.writer.flush(dir_name)
             n = np.fromfile(path, dtype=np.uint8)  # 日本語を含むファイルを扱う
             img_draw = cv2.imdecode(n, cv2.IMREAD_COLOR)  # ファイルのデコード
             result = (is_count, correct_count, false_detection, not_detected, dir_name, img_draw,
@@ -410,6 +609,7 @@ class Control(object):
         """
         try:
             # 結果の参照
+            self.writer.flush(kind="db")  # 書き込み待ちの結果を反映してから参照する
             response = self.db.select_row("result", False, "file_dir", "correct_count", "false_detection",
                                           "not_detected", date=date)
             dir_name = response[0][1][0]  # 結果から情報を取り出す ここでもエラーになる可能性がある-->Exception
@@ -424,6 +624,7 @@ class Control(object):
             if dir_exist is False:
                 os.makedirs(new_dir_names, exist_ok=True)  # ない場合作成
             new_dir_name = new_dir_names + sheet_no + "/"
+            self.writer.flush(dir_name)
             # 保存先ディレクトリ名を変更する
             if dir_name != new_dir_name:
                 os.rename(dir_name, new_dir_name)  # ファイルのリネーム ここでエラーになる可能性がある-->FileExistError
@@ -444,28 +645,31 @@ class Control(object):
         またその結果が保存されているディレクトリも削除する
         :return: True　またはエラーの場合False
         """
+        self.writer.flush(kind="db")  # 書き込み待ちの結果を反映してから参照する
         response = self.db.select_row("result", False, "file_dir", date=date)  # 結果の参照
         dir_name = response[0][1][0]
         try:
+            self.writer.flush(dir_name)
             shutil.rmtree(dir_name)  # ディレクトリごと削除
             self.db.delete_row("result", date=date)  # データベースからも結果情報の削除する
             return True
         except Exception:
             return False
 
-    def shutter(self, cap, frame, dialog):
+    def shutter(self, cap, frame, dialog, product_name):
         """
         dialog=Falseの場合、画像処理画像を2回撮影してHDR画像を作成。前処理を行って上下左右反転した画像を返す。
         dialog=Trueの場合、前処理のみを行った画像を返す。
+        前処理の回転角の求め方は、カウントのときと同じように製品の設定ファイルから読み込む
         :param cap: dfk4tk.VideoCapture4dFK()
         :param frame: dialog=Trueの場合に使用
         :param dialog: True or False
+        :param product_name: 登録する製品名。設定ファイルが無い場合は初期値の求め方
         :return: 処理後の画像の配列
         """
         # 撮影ボタンが押された場合
         if dialog is False:
-            img1 = cap.set_exp_and_get_image(-4)  # 露光の高い画像を取得
-            img2 = cap.set_exp_and_get_image(-5)  # 露光の低い画像を取得
+            img1, img2 = cap.get_bracket([-4, -5])  # 露光の高い画像と低い画像を続けて取得
             frame = cap.get_hdr(img1, img2)  # HDR画像を作成
         file_name = "_.jpg"
         ext = os.path.splitext(file_name)[1]  # 日本語を含むファイル名を扱う
@@ -474,7 +678,8 @@ class Control(object):
             n.tofile(f)  # 撮影画像の保存
         n = np.fromfile(file_name, dtype=np.uint8)
         frame = cv2.imdecode(n, cv2.IMREAD_COLOR)
-        frame2 = self.pre.preprocessing(frame, 500, 500)  # 前処理した画像の取得
+        deskew_mode = load_deskew_setting(setting_dir, product_name)
+        frame2 = self.pre.preprocessing(frame, 500, 500, deskew_mode=deskew_mode)  # 前処理した画像の取得
         if dialog is False:
             frame2 = cv2.flip(frame2, -1)  # 画像の180°回転
         os.remove(file_name)
@@ -612,6 +817,11 @@ class Control(object):
             result_encode, n = cv2.imencode(ext, pattern)  # 画像をエンコード
             with open(file_name, mode='w+b') as f:
                 n.tofile(f)  # 撮影画像の保存
+        self.pattern_store.invalidate(dir_name)  # 更新日時が変わらない場合もあるので、保持しているパターン画像を破棄する
+        # パターン画像が変わったので、前のパターン画像の採用履歴は使わない
+        # 保存待ちの古い履歴の後に消すように、同じ順番で保存する
+        self.pattern_histories[product_name] = new_pattern_history()
+        self._save_pattern_history(product_name, None)
 
     def save(self, figure_no, product_name, theoretical_amount, yield_rate_limit, marking, pattern):
         """
@@ -644,6 +854,9 @@ class Control(object):
                 result_encode, n = cv2.imencode(ext, pattern)  # 画像をエンコード
                 with open(file_name, mode='w+b') as f:
                     n.tofile(f)  # 撮影画像の保存
+            self.pattern_store.invalidate(dir_name)  # 同じディレクトリのパターン画像を保持していれば破棄する
+            self.pattern_histories[product_name] = new_pattern_history()  # 同じ製品名で残っていた採用履歴は使わない
+            self._save_pattern_history(product_name, None)
             # データベースへの書き込み
             self.db.write_row("product",
                               ("figure_No", figure_no),
@@ -692,6 +905,7 @@ class Control(object):
         :param control_no: 管理No
         :return: 製品図番、製品名、作業者名、カウント結果 or 結果がない場合False
         """
+        self.writer.flush(kind="db")  # 書き込み待ちの結果を反映してから参照する
         try:
             db_result = self.db.select_row("result", False, "figure_No", "date", "worker_name",
                                            "sheet_No", "correct_count",
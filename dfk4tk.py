@@ -2,21 +2,37 @@
 アルゴ社のカメラDFK33UX183用のVideoCapture。
 別途カメラ用のドライバーをインストールする必要あり。
 
-set_exp_and_get_imageで露出を引数に明るさを変えて撮影した画像が得られる。
+set_exp_and_get_imageで露出を引数に明るさを変えて撮影した画像が得られる。get_bracketで複数の露出を続けて撮影する。
 get_hdrで2枚の画像からHDR画像を作成。
+映像用の画像は別スレッドで読み込み続け、get_frame_for_tkは最新の1枚だけを受け取る。
+映像は低い解像度(preview_size)で読み込み、撮影のときだけ撮影用の解像度に切り替える。
+環境変数COUNT_FAKE_CAMERAを設定すると、open_cameraはカメラの代わりにFakeVideoCapture4DFKを返す。
 使用レンズは松電社25mmレンズSM2520-MP20
 """
 
+from collections import deque
 from cv2 import VideoCapture
 import cv2
 import numpy as np
-import pickle
+import os
+import threading
+import time
 
-from load_config import load_config
-from tisgrabber import TIS_CAM
+from frame_buffer import share
+from hdr import HDRMerger
+from stage_timer import stage_timer
 
 
 config_file_path = "camera_config.xml"
+preview_size = (1928, 1382)  # 映像用の解像度(撮影用の縦横1/2)。Noneのとき映像も撮影用の解像度で読み込む
+exposure_max_reads = 4  # 露出の変更が反映されるのを待つ最大の読み込み数(以前は捨て読み3回+1回で固定)
+settle_discard_reads = 1  # 解像度・露出を切り替えた直後に、明るさに関係なく捨てる読み込み数(切り替え途中のフレーム)
+exposure_settle_ratio = 0.75  # 予想される明るさの変化のこの割合以上変化したフレームを、新しい露出のフレームとする
+brightness_step = 16  # 明るさを比べるときに間引く画素の間隔
+fake_camera_env = "COUNT_FAKE_CAMERA"  # 偽のカメラを使う場合に設定する環境変数。値は表示する画像のパス(空なら市松模様)
+grabber_idle_time = 1.0  # get_frame_for_tkがこの秒数呼ばれなければ、映像用の読み込みを休止する
+fps_window = 30  # FPSを計算する直近のフレーム数
+hdr_mode = "full"  # HDR合成の方法。"full"(MergeMertens) or "fast"(縮小画像で混ぜる割合を求める)。hdr.py参照
 
 
 class VideoCapture4DFK(VideoCapture):
@@ -28,10 +44,17 @@ class VideoCapture4DFK(VideoCapture):
         :param w: 横幅
         :param h: 高さ
         """
+        # cam_refreshで呼び直された場合は、映像用の読み込みを止めてから接続し直す
+        if getattr(self, "_grabber", None) is not None:
+            self.stop_grabber()
         self.d = d
         self.w = w
         self.h = h
 
+        # 実機用のDLLを読み込むので、偽のカメラでは使わないようにここでimportする
+        from load_config import load_config
+        from tisgrabber import TIS_CAM
+
         # tisgrabberで設定読込
         cam = TIS_CAM()
         devices = cam.GetDevices()
@@ -51,23 +74,106 @@ class VideoCapture4DFK(VideoCapture):
         self.set(6, cv2.VideoWriter_fourcc(*"YUY2"))  # ピクセルフォーマットをYUV 4:2:2に。
 
         self.exp = self.get(cv2.CAP_PROP_EXPOSURE)
+        self._init_state()
+
+    def _init_state(self):
+        """撮影・映像の読み込みで使う状態を初期化する"""
+        self.mode = "full"  # "full"(撮影用の解像度) or "preview"(映像用の解像度)
+        self.preview_size = preview_size
+        self.mode_switch_num = 0  # 解像度を切り替えた回数
+        self.mode_switch_time = 0.0  # 解像度の切り替えにかかった時間の合計[s]
+        self.last_bracket = None  # 直前のget_bracketの(読み込み数, 以前の方法での読み込み数, 短縮できた時間[s])
+        self.hdr = HDRMerger(hdr_mode)
+        # カウント用の撮影を別スレッドで行うので、撮影中に映像用のreadが割り込まないようにする
+        self.lock = threading.Lock()
+        # 映像用の最新フレーム。読み込みスレッドが上書きし、古いフレームは捨てる
+        self._slot_lock = threading.Lock()
+        self._latest = None
+        self._latest_id = 0
+        self._shown_id = 0
+        self._requested = time.perf_counter()
+        self._wanted = threading.Event()
+        self._stopped = threading.Event()
+        self._grabber = None
+        self._capture_times = deque(maxlen=fps_window)
+        self._display_times = deque(maxlen=fps_window)
 
     def get_frame_for_tk(self, first_width, first_height, ratio):
         """
-        呼び出されるとカメラから一枚画像を読み込む。cap.read()。
-        tkinter用に色変換。BGR　->　RGB
-        :return: numpy配列のRGB画像
-        """
-        try:
-            ret, frame = self.read()
-            binary = pickle.dumps(frame)
-            pickle_copy = pickle.loads(binary)
-            pickle_copy = cv2.resize(pickle_copy, (int(first_width * ratio), int(first_height * ratio)))
-            return pickle_copy, frame
-        except cv2.error:
-            self.__del__()
+        読み込みスレッドが取得した最新の画像を受け取る。cap.read()を待たない。
+        前回から新しい画像が届いていない場合(カウント用の撮影中など)はNone, Noneを返す
+        :return: リサイズした画像, オリジナル画像(書き換え不可。書き換える場合はframe_buffer.writableで複製する)
+        """
+        self._requested = time.perf_counter()
+        if not self.isOpened():
             blank = np.zeros((int(first_height * ratio), int(first_width * ratio), 3), np.uint8)
             return blank, blank
+        self.start_grabber()
+        with self._slot_lock:
+            frame, frame_id = self._latest, self._latest_id
+        if frame is None or frame_id == self._shown_id:
+            return None, None
+        self._shown_id = frame_id
+        self._display_times.append(time.perf_counter())
+        resized = cv2.resize(frame, (int(first_width * ratio), int(first_height * ratio)))
+        return resized, frame
+
+    def start_grabber(self):
+        """映像用の読み込みスレッドを開始する。既に動いている場合は休止を解除する"""
+        self._wanted.set()
+        if self._grabber is not None and self._grabber.is_alive():
+            return
+        self._stopped.clear()
+        self._grabber = threading.Thread(target=self._grab_loop, name="frame_grabber", daemon=True)
+        self._grabber.start()
+
+    def stop_grabber(self):
+        """映像用の読み込みスレッドを終了する"""
+        self._stopped.set()
+        self._wanted.set()
+        if self._grabber is not None and self._grabber is not threading.current_thread():
+            self._grabber.join()
+        self._grabber = None
+
+    def get_fps(self):
+        """
+        直近fps_windowフレームのFPS
+        :return: (カメラから読み込めたFPS, get_frame_for_tkで表示に渡したFPS)
+        """
+        return self._fps(self._capture_times), self._fps(self._display_times)
+
+    @staticmethod
+    def _fps(times):
+        times = list(times)
+        if len(times) < 2 or times[-1] == times[0]:
+            return 0.0
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def _grab_loop(self):
+        """
+        読み込みスレッド。最新のフレームだけをスロットに保持する
+        get_frame_for_tkがgrabber_idle_time秒呼ばれなければ、次に呼ばれるまで休止する
+        """
+        while not self._stopped.is_set():
+            if time.perf_counter() - self._requested > grabber_idle_time:
+                self._wanted.clear()
+                self._wanted.wait()
+                continue
+            with self.lock:  # カウント用の撮影中は待つ
+                if not self.isOpened():
+                    break
+                try:
+                    self._set_mode("preview")
+                    ret, frame = self.read()
+                except cv2.error:
+                    ret, frame = False, None
+                if ret is False or frame is None:  # カメラとの接続不良
+                    self.__del__()
+                    break
+            with self._slot_lock:
+                self._latest = share(frame)
+                self._latest_id += 1
+            self._capture_times.append(time.perf_counter())
 
     def __del__(self):
         """
@@ -77,33 +183,235 @@ class VideoCapture4DFK(VideoCapture):
         if self.isOpened() is True:
             self.release()
 
+    def release(self):
+        """映像用の読み込みスレッドを止めてからカメラデバイスを解放する"""
+        if getattr(self, "_grabber", None) is not None and self._grabber is not threading.current_thread():
+            self.stop_grabber()
+        super(VideoCapture4DFK, self).release()
+
+    def _set_mode(self, mode):
+        """
+        映像用と撮影用の解像度を切り替える。self.lockを持った状態で呼び出す
+        カメラが映像用の解像度に対応していない場合は、以降は撮影用の解像度のまま読み込む
+        :param mode: "full" or "preview"
+        :return: 解像度を切り替えた場合True
+        """
+        if mode == "preview" and self.preview_size is None:
+            mode = "full"
+        if mode == self.mode:
+            return False
+        width, height = (self.w, self.h) if mode == "full" else self.preview_size
+        start = time.perf_counter()
+        with stage_timer.stage("mode_switch"):
+            self.set(3, width)  # 幅
+            self.set(4, height)  # 高さ
+        self.mode_switch_time += time.perf_counter() - start
+        self.mode_switch_num += 1
+        self.mode = mode
+        if mode == "preview" and (int(self.get(3)), int(self.get(4))) != tuple(self.preview_size):
+            self.preview_size = None
+            self._set_mode("full")
+        return True
+
+    def get_mode_stats(self):
+        """
+        :return: (現在の解像度のモード, 解像度を切り替えた回数, 切り替えにかかった平均時間[s])
+        """
+        average = self.mode_switch_time / self.mode_switch_num if self.mode_switch_num else 0.0
+        return self.mode, self.mode_switch_num, average
+
     def set_exp_and_get_image(self, exp):
         """
         設定した露光で画像撮影。
-        パラメータ変更直後、すぐにはカメラに反映されないので、無駄にreadする必要がある。
         撮影後は元の露出設定に戻る。
 
         :param exp: 露出
         :return: 設定した露出で撮影した画像
         """
-        self.set(15, exp)
-        for i in range(3):
-            self.read()
-        _, img = self.read()
-        self.set(15, self.exp)
-        return img
+        return self.get_bracket([exp])[0]
+
+    def get_bracket(self, exps):
+        """
+        露出を変えながら1枚ずつ撮影する。撮影後は元の露出設定に戻る。
+        パラメータ変更直後はすぐにはカメラに反映されないので、読み込んだフレームの明るさが
+        新しい露出で予想される明るさに近づくまで読み込む(最大exposure_max_reads回)。
+        現在と同じ露出の場合は待たずに次のフレームを使う。
+        解像度か露出を切り替えた直後のsettle_discard_reads枚は、切り替え途中のフレームかもしれないので使わない。
+
+        :param exps: 露出のリスト
+        :return: 露出ごとの画像のリスト
+        """
+        imgs = []
+        read_num = 0
+        read_time = 0.0
+        with self.lock:
+            switched = self._set_mode("full")  # 映像用の読み込みが次に始まるまでは撮影用の解像度のまま
+            current = self.exp  # 映像を読み込んでいた露出
+            reference = self._latest_brightness_sample()  # 現在の露出で撮影されたフレームの間引き画像
+            for exp in exps:
+                discard = settle_discard_reads if switched or exp != current else 0
+                with stage_timer.stage("exposure_switch"):
+                    if exp != current:
+                        if reference is None:  # 比べるフレームがない場合は1枚読み込む
+                            start = time.perf_counter()
+                            _, frame = self.read()
+                            read_time += time.perf_counter() - start
+                            read_num += 1
+                            reference = self._brightness_sample(frame)
+                        self.set(15, exp)
+                        expected = self._expected_change(reference, exp - current)
+                with stage_timer.stage("capture"):
+                    reads = max(exposure_max_reads, discard + 1) if exp != current else discard + 1
+                    for i in range(reads):
+                        start = time.perf_counter()
+                        _, img = self.read()
+                        read_time += time.perf_counter() - start
+                        read_num += 1
+                        if i < discard:  # 切り替え直後のフレームは使わない
+                            continue
+                        if exp == current:
+                            break
+                        sample = self._brightness_sample(img)
+                        # 予想される変化が小さすぎて判定できない場合は、以前と同じ回数読み込む
+                        if expected >= 1.0 and abs(sample.mean() - reference.mean()) >= exposure_settle_ratio * expected:
+                            break
+                imgs.append(img)
+                switched = False
+                current = exp
+                reference = self._brightness_sample(img)
+            if current != self.exp:
+                self.set(15, self.exp)
+        # 以前の方法(露出ごとに4回読み込む)と比べて、読み込まずに済んだ時間
+        if read_num:
+            saved = (exposure_max_reads * len(exps) - read_num) * read_time / read_num
+            stage_timer.add("bracket_saved", saved)
+            self.last_bracket = (read_num, exposure_max_reads * len(exps), saved)
+        return imgs
+
+    def _latest_brightness_sample(self):
+        """映像用に読み込んだ最新のフレーム(現在の露出)の間引き画像。なければNone"""
+        with self._slot_lock:
+            frame = self._latest
+        if frame is None:
+            return None
+        return self._brightness_sample(frame)
+
+    @staticmethod
+    def _brightness_sample(img):
+        """明るさを比べるために、解像度によらず同じくらいの画素数に間引いたグレースケール画像"""
+        step = max(1, brightness_step * img.shape[1] // 3856)
+        return cv2.cvtColor(img[::step, ::step], cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+    @staticmethod
+    def _expected_change(reference, exp_diff):
+        """
+        露出をexp_diff段変えたときに予想される平均の明るさの変化量。白飛びする画素は255で止まるとする
+        露出の値は1段ごとに露光時間が2倍になる
+        """
+        predicted = np.clip(reference * (2.0 ** exp_diff), 0, 255)
+        return abs(float(predicted.mean()) - float(reference.mean()))
 
+    @stage_timer.timed("hdr")
     def get_hdr(self, img1, img2):
         """
         明暗を変えて撮った画像を合成しハイダイナミックレンジ画像を作成。
         入力できる画像の枚数は2枚に限定した。
-        クラスにする必要ないかも。
+        合成の方法はhdr_modeで切り替える。
+        """
+        return self.hdr.process([img1, img2])
+
+
+class FakeVideoCapture4DFK(VideoCapture4DFK):
+    def __init__(self, d=0, w=3856, h=2764, image_path=None, fps=14.0, switch_time=0.3, exposure_delay=3):
+        """
+        カメラがなくても動作を確認できるように、VideoCapture4DFKと同じ使い方ができる偽のカメラ
+        image_pathの画像(Noneなら市松模様)を現在の解像度・露出に合わせて返す
+        実機と同じように、読み込みには画素数に比例した時間がかかり、解像度の切り替えにはswitch_time秒かかる
+        露出の変更はexposure_delay回読み込んだ後のフレームから反映される
+
+        :param d: デバイス番号(使わない)
+        :param w: 撮影用の横幅
+        :param h: 撮影用の高さ
+        :param image_path: 返す画像のパス
+        :param fps: 撮影用の解像度で読み込むときのFPS
+        :param switch_time: 解像度の切り替えにかかる時間[s]
+        :param exposure_delay: 露出の変更が反映されるまでに読み込むフレームの数
         """
-        img_list = [img1, img2]
-        merge_mertens = cv2.createMergeMertens()
-        res_mertens = merge_mertens.process(img_list)
-        res_mertens_8bit = np.clip(res_mertens * 255, 0, 255).astype("uint8")
-        return res_mertens_8bit
+        if getattr(self, "_grabber", None) is not None:
+            self.stop_grabber()
+        VideoCapture.__init__(self)  # デバイスには接続しない
+        self.d = d
+        self.w = w
+        self.h = h
+        self.fps = fps
+        self.switch_time = switch_time
+        self.exposure_delay = exposure_delay
+        if image_path:
+            n = np.fromfile(image_path, dtype=np.uint8)  # 日本語を含むファイルを扱う
+            self._source = cv2.imdecode(n, cv2.IMREAD_COLOR)
+        elif getattr(self, "_source", None) is not None:  # cam_refreshで呼び直された場合は同じ画像を使う
+            pass
+        else:
+            tile = 64
+            yy, xx = np.mgrid[0:h, 0:w]
+            board = (((yy // tile) + (xx // tile)) % 2 * 120 + 60).astype(np.uint8)
+            self._source = cv2.cvtColor(board, cv2.COLOR_GRAY2BGR)
+        self._opened = True
+        self._props = {3: float(w), 4: float(h), cv2.CAP_PROP_EXPOSURE: -4.0}
+        self._exposure = self._props[cv2.CAP_PROP_EXPOSURE]  # 現在のフレームに反映されている露出
+        self._exposure_countdown = 0
+        self._frames = {}  # {(幅, 高さ, 露出): 画像}
+        self.read_num = 0  # readが呼ばれた回数
+        self.exp = self.get(cv2.CAP_PROP_EXPOSURE)
+        self._init_state()
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        if self._grabber is not None and self._grabber is not threading.current_thread():
+            self.stop_grabber()
+        self._opened = False
+
+    def get(self, prop_id):
+        return self._props.get(prop_id, 0.0)
+
+    def set(self, prop_id, value):
+        if prop_id in (3, 4) and self._props.get(prop_id) != float(value):
+            time.sleep(self.switch_time / 2)  # 幅と高さで半分ずつ
+        if prop_id == cv2.CAP_PROP_EXPOSURE and self._props.get(prop_id) != float(value):
+            self._exposure_countdown = self.exposure_delay
+        self._props[prop_id] = float(value)
+        return True
+
+    def read(self, image=None):
+        if not self._opened:
+            return False, None
+        width, height = int(self._props[3]), int(self._props[4])
+        time.sleep(width * height / (self.w * self.h) / self.fps)
+        # 露出の変更はexposure_delay回読み込んだ後から反映される
+        if self._exposure_countdown > 0:
+            self._exposure_countdown -= 1
+        else:
+            self._exposure = self._props[cv2.CAP_PROP_EXPOSURE]
+        self.read_num += 1
+        key = (width, height, self._exposure)
+        if key not in self._frames:
+            frame = cv2.resize(self._source, (width, height), interpolation=cv2.INTER_AREA)
+            gain = 2.0 ** (self._exposure + 4)  # 露出-4で元の明るさ、1段階ごとに2倍
+            self._frames[key] = cv2.convertScaleAbs(frame, alpha=gain)
+        return True, self._frames[key].copy()
+
+
+def open_camera(d=0):
+    """
+    カメラを開く。環境変数COUNT_FAKE_CAMERAが設定されている場合は偽のカメラを返す
+    :param d: デバイス番号
+    :return: VideoCapture4DFK or FakeVideoCapture4DFK
+    """
+    if fake_camera_env in os.environ:
+        return FakeVideoCapture4DFK(d, image_path=os.environ[fake_camera_env] or None)
+    return VideoCapture4DFK(d)
 
 
 def main():
@@ -0,0 +1,108 @@
+"""
+Tkに表示する画像を作る処理
+結果画像・参照画像は反転・RGB変換済みの縮小画像(ピラミッド)を1度だけ作り、
+拡大・ドラッグ・ウィンドウサイズの変更では表示範囲だけを作り直す。
+映像は表示サイズのバッファとPhotoImageを使い回す。
+"""
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+
+
+pyramid_min_size = 256  # ピラミッドの最も小さい段の短辺がこれより小さくならないようにする
+
+
+class DisplayImage:
+    def __init__(self, img, flip=None):
+        """
+        1枚の画像を表示するための縮小画像を保持するクラス
+
+        Args:
+            img (img_bgr): 表示する画像(update_size_imgで余白を付けたもの)
+            flip (int or None): cv2.flipの反転方向。Noneのとき反転しない
+        """
+        rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if flip is not None:
+            rgb = cv2.flip(rgb, flip)
+        self.height, self.width = img.shape[:2]
+        self.levels = [rgb]  # 1/2ずつ縮小した画像
+        while min(self.levels[-1].shape[:2]) // 2 >= pyramid_min_size:
+            self.levels.append(cv2.pyrDown(self.levels[-1]))
+        self._cache_key = None
+        self._cache = None
+
+    def render(self, width, height, zoom_magnif=1.0, x=0, y=0):
+        """
+        画像を(width * zoom_magnif, height * zoom_magnif)に拡大し、(x, y)を左上としてwidth x heightで切り取った画像
+        cv2.resizeで拡大してから切り取った場合と同じ範囲になるが、計算するのは切り取る範囲だけ
+
+        Args:
+            width (int): 表示する幅
+            height (int): 表示する高さ
+            zoom_magnif (float): 拡大倍率
+            x (int): 拡大後の画像上で切り取る範囲の左上のx座標
+            y (int): 拡大後の画像上で切り取る範囲の左上のy座標
+
+        Returns:
+            img_rgb: 表示する画像。次に同じ引数で呼ばれたときも同じ配列を返すので、書き換えないこと
+        """
+        key = (width, height, zoom_magnif, x, y)
+        if key == self._cache_key:
+            return self._cache
+        new_x = int(width * zoom_magnif)
+        new_y = int(height * zoom_magnif)
+        scale_x = self.width / new_x  # 元画像の何ピクセルが表示の1ピクセルになるか
+        scale_y = self.height / new_y
+        # 縮小率が2倍未満になる、最も小さい段を使う
+        level = 0
+        while level + 1 < len(self.levels) and min(scale_x, scale_y) >= 2 ** (level + 1):
+            level += 1
+        scale_x /= 2 ** level
+        scale_y /= 2 ** level
+        # 表示の画素(u, v)に対応する段の座標。cv2.resizeと同じく画素の中心を合わせる
+        matrix = np.float32([[scale_x, 0, (x + 0.5) * scale_x - 0.5],
+                             [0, scale_y, (y + 0.5) * scale_y - 0.5]])
+        img = cv2.warpAffine(self.levels[level], matrix, (width, height),
+                             flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        self._cache_key = key
+        self._cache = img
+        return img
+
+
+class PreviewRenderer:
+    def __init__(self, flip=-1):
+        """
+        映像の1フレームを反転・RGB変換してPhotoImageにするクラス
+        表示サイズが変わらない間は、バッファとPhotoImageを作り直さずに上書きする
+
+        Args:
+            flip (int or None): cv2.flipの反転方向。Noneのとき反転しない
+        """
+        self.flip = flip
+        self.photo = None
+        self._flipped = None
+        self._rgb = None
+
+    def render(self, img):
+        """
+        Args:
+            img (img_bgr): 表示サイズにリサイズした映像
+
+        Returns:
+            ImageTk.PhotoImage: 前回と同じサイズであれば前回と同じオブジェクト
+        """
+        if self._rgb is None or self._rgb.shape != img.shape:
+            self._flipped = np.empty_like(img)
+            self._rgb = np.empty_like(img)
+            self.photo = None
+        if self.flip is not None:
+            cv2.flip(img, self.flip, dst=self._flipped)
+            cv2.cvtColor(self._flipped, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        else:
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        img_array = Image.fromarray(self._rgb)
+        if self.photo is None:
+            self.photo = ImageTk.PhotoImage(image=img_array)
+        else:
+            self.photo.paste(img_array)
+        return self.photo
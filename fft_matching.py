@@ -0,0 +1,90 @@
+"""
+周波数領域でのテンプレートマッチング(cv2.TM_CCOEFF_NORMEDと同じ値を計算する)
+
+cv2.matchTemplateはパターン画像ごとに全体画像のフーリエ変換と局所的な輝度の和・二乗和を計算しなおすが、
+FFTCorrelatorは全体画像のフーリエ変換を1回だけ計算して4枚のパターン画像で共有する。
+輝度の和・二乗和から求める分母はパターン画像の大きさだけで決まるので、同じ大きさのパターン画像(0°と180°など)で共有する。
+
+    correlator = FFTCorrelator(img_rot_gray)
+    res = correlator.match(pattern)  # cv2.matchTemplate(img_rot_gray, pattern.gray, cv2.TM_CCOEFF_NORMED)とほぼ同じ
+
+R(x, y) = Σ(T' * I) / sqrt(ΣT'^2 * (ΣI^2 - (ΣI)^2 / N))
+    T'はパターン画像から平均を引いたもの、Iは全体画像の(x, y)からパターン画像の大きさの範囲、Nはパターン画像の画素数
+    分子はフーリエ変換の積から、分母の全体画像の部分は範囲内の和(cv2.boxFilter, cv2.sqrBoxFilter)から求める
+"""
+import cv2
+import numpy as np
+
+
+min_variance = 1e-3  # 範囲内のΣI^2 - (ΣI)^2 / Nがこれ以下の平坦な範囲は、マッチング結果を0にする
+
+
+class FFTCorrelator:
+    def __init__(self, img_gray):
+        """
+        全体画像のフーリエ変換を計算して保持する
+        matchは複数のスレッドから同時に呼び出してよい
+
+        Args:
+            img_gray (img_gray): 全体画像(8bitグレースケール)
+        """
+        self.h, self.w = img_gray.shape[:2]
+        # 循環相関の折り返しが有効な範囲に入らないように、全体画像以上の高速に変換できるサイズにする
+        self.dft_h = cv2.getOptimalDFTSize(self.h)
+        self.dft_w = cv2.getOptimalDFTSize(self.w)
+        padded = np.zeros((self.dft_h, self.dft_w), np.float32)
+        padded[:self.h, :self.w] = img_gray
+        self._spectrum = cv2.dft(padded, nonzeroRows=self.h)
+        self._img_f64 = img_gray.astype(np.float64)  # 8bitのままだとsqrBoxFilterの途中の和が大きいパターン画像で桁あふれする
+        self._inv_std = {}  # {(パターン画像の高さ, 幅): 1 / sqrt(範囲内のΣI^2 - (ΣI)^2 / N)}
+
+    def match(self, pattern, check=None):
+        """
+        パターン画像とのcv2.TM_CCOEFF_NORMEDのマッチング結果を返す
+
+        Args:
+            pattern (Pattern): パターン画像(pattern_store.Pattern)
+            check (function or None): フーリエ変換などの段階の間に引数なしで呼び出す関数。中止するときは例外を送出する
+
+        Returns:
+            img_th: マッチング結果画像(float32, 全体画像の高さ - パターン画像の高さ + 1, 幅 - 幅 + 1)
+        """
+        ph, pw = pattern.h, pattern.w
+        res_h, res_w = self.h - ph + 1, self.w - pw + 1
+        # 分子: 平均を引いたパターン画像と全体画像の相関
+        template = np.zeros((self.dft_h, self.dft_w), np.float32)
+        template[:ph, :pw] = pattern.gray
+        template[:ph, :pw] -= pattern.mean
+        template_spectrum = cv2.dft(template, nonzeroRows=ph)
+        if check is not None:
+            check()
+        product = cv2.mulSpectrums(self._spectrum, template_spectrum, 0, conjB=True)
+        if check is not None:
+            check()
+        numerator = cv2.idft(product, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT, nonzeroRows=res_h)[:res_h, :res_w]
+        if check is not None:
+            check()
+
+        res = cv2.multiply(numerator, self._get_inv_std(ph, pw), scale=1 / pattern.norm)
+        return np.clip(res, -1, 1, out=res)
+
+    def _get_inv_std(self, ph, pw):
+        """
+        各位置を左上とするph x pwの範囲の 1 / sqrt(ΣI^2 - (ΣI)^2 / N)。平坦な範囲は0
+        同じ大きさのパターン画像で使い回す。別のスレッドが同時に計算した場合は、後から計算した方が残るだけ
+        """
+        key = (ph, pw)
+        inv_std = self._inv_std.get(key)
+        if inv_std is not None:
+            return inv_std
+        res_h, res_w = self.h - ph + 1, self.w - pw + 1
+        window_sum = cv2.boxFilter(self._img_f64, cv2.CV_64F, (pw, ph), anchor=(0, 0), normalize=False,
+                                   borderType=cv2.BORDER_CONSTANT)[:res_h, :res_w]
+        window_sqsum = cv2.sqrBoxFilter(self._img_f64, cv2.CV_64F, (pw, ph), anchor=(0, 0), normalize=False,
+                                        borderType=cv2.BORDER_CONSTANT)[:res_h, :res_w]
+        variance = cv2.subtract(window_sqsum, cv2.multiply(window_sum, window_sum, scale=1 / (ph * pw)))
+        variance = variance.astype(np.float32)
+        variance[variance <= min_variance] = np.inf  # 1 / inf = 0
+        inv_std = cv2.divide(1.0, cv2.sqrt(variance))
+        self._inv_std[key] = inv_std
+        return inv_std
@@ -0,0 +1,69 @@
+"""
+撮影画像(3856x2764で約32MB)を複製せずに受け渡すための補助
+
+複数の場所から参照される画像はshareで書き換え不可にしてから渡す。
+書き換える側はwritableで受け取る。書き換え可能な画像はそのまま、共有中の画像は複製して返す(コピーオンライト)。
+マウスのドラッグなど、同じ大きさの画像を何度も作る処理はScratchBufferのバッファを使い回す。
+
+    frame = share(frame)  # 以降、frameを書き換えようとするとValueError
+    writer.write_image(path, frame)
+    result, count = count_contours(writable(frame))  # 描画するので、ここで初めて複製する
+"""
+import numpy as np
+
+
+def share(img):
+    """
+    画像を書き換え不可の状態で共有する。元の配列は複製しない
+
+    Args:
+        img (np.ndarray): 共有する画像
+
+    Returns:
+        np.ndarray: 書き換え不可のビュー
+    """
+    view = img.view()
+    view.flags.writeable = False
+    return view
+
+
+def writable(img):
+    """
+    書き換えてよい画像を返す。共有中(書き換え不可)の画像のときだけ複製する
+
+    Args:
+        img (np.ndarray): 書き換えたい画像
+
+    Returns:
+        np.ndarray: imgそのもの、またはimgの複製
+    """
+    if img.flags.writeable:
+        return img
+    return img.copy()
+
+
+class ScratchBuffer:
+    def __init__(self):
+        """
+        描画用の作業領域を使い回すクラス
+        前回と同じ大きさ・型の画像であれば、新しく確保せずに前回のバッファに書き込む
+        返したバッファは次の呼び出しで上書きされるので、保持する場合は複製すること
+        """
+        self._buffer = None
+        self.alloc_num = 0  # バッファを確保し直した回数
+
+    def copy_from(self, img):
+        """
+        imgをバッファに複製する
+
+        Args:
+            img (np.ndarray): 複製する画像
+
+        Returns:
+            np.ndarray: imgと同じ内容のバッファ
+        """
+        if self._buffer is None or self._buffer.shape != img.shape or self._buffer.dtype != img.dtype:
+            self._buffer = np.empty_like(img)
+            self.alloc_num += 1
+        np.copyto(self._buffer, img)
+        return self._buffer
@@ -1,9 +1,10 @@
 from datetime import datetime
 import multiprocessing
 from pathlib import Path
-import pickle
+import queue
 import subprocess
 import sys
+import threading
 import tkinter as tk
 import tkinter.font as font
 import tkinter.ttk as ttk
@@ -14,7 +15,8 @@ from PIL import Image, ImageTk
 
 import dfk4tk
 
-from control import Control
+from control import Control, CountCancelled
+from display_pipeline import DisplayImage, PreviewRenderer
 from error_window_create import ErrorMessage
 from translate_word import translate_word
 
@@ -25,6 +27,7 @@ import settings_window
 
 class MainWindow(tk.Tk):
     def __init__(self, window_title=u"個数カウントシステム", icon_file="icon.ico"):
+        self.window_title = window_title
         self.control = Control()  # コントロールオブジェクトの作成
         self.control.main_window = self
         now = datetime.now()  # 現在の時刻を取得
@@ -38,13 +41,18 @@ class MainWindow(tk.Tk):
         self.method_num = 0
 
         self.cam_num = 0
-        self.cap = dfk4tk.VideoCapture4DFK(self.cam_num)   # カメラを呼び出す
+        self.cap = dfk4tk.open_camera(self.cam_num)   # カメラを呼び出す
         self.cam_flag = True  # 動画を動かすかどうかの設定
         self.dialog = False  # ファイルダイアログを使用しているかどうかの設定
         self.count_flag = False  # 表示画像がカウント結果になっているかどうかの設定
         self.setting_flag = False  # 設定ウィンドウを開いているかどうかの設定
+        self.counting = False  # 別スレッドでカウント中かどうかの設定
+        self.count_cancel = threading.Event()  # setするとカウントを中止する
+        self.count_queue = queue.Queue()  # カウント用のスレッドから進み具合と結果を受け取る
         self.is_count = 0
         self.prev_zoom_magnif = 1
+        self.display_img = None  # 表示中の結果画像・参照画像の縮小画像
+        self.preview = PreviewRenderer(flip=-1)  # 映像の表示用
         self.min_get = False
 
         super(MainWindow, self).__init__()  # self = tk.tk()
@@ -81,8 +89,15 @@ class MainWindow(tk.Tk):
 
         self.delay = 15  # カメラを更新する頻度(ms)
         self.update_cam()  # カメラを更新する関数
+        self.write_check_delay = 1000  # 結果の保存に失敗していないか確認する頻度(ms)
+        self.check_write_errors()
+        self.count_check_delay = 50  # カウント用のスレッドの進み具合を確認する頻度(ms)
 
         self.protocol("WM_DELETE_WINDOW", self.on_close)  # ウィンドウを閉じるときに関数を設定
+        self.bind("<Escape>", self.cancel_count)  # Escキーでカウントを中止する
+        self.show_fps = False  # タイトルにカメラの読み込みFPSと表示FPSを表示するかどうかの設定
+        self.fps_delay = 1000  # FPSの表示を更新する頻度(ms)
+        self.bind("<F12>", self.toggle_fps)  # F12キーでFPSの表示を切り替える
 
         if self.cap.isOpened() is False:  # カメラが接続できなかった場合
             sub_win = tk.Toplevel()  # エラー表示用のウィンドウを作成
@@ -105,7 +120,13 @@ class MainWindow(tk.Tk):
             error_window = ErrorMessage(sub_win)
             error_window.set_message("結果が保存されていません。\n製品情報の下にある\n"
                                      "確認ボタンを押してから\nウィンドウを閉じてください。")
+        elif self.counting is True:
+            sub_win = tk.Toplevel()  # エラー表示用のウィンドウを作成
+            error_window = ErrorMessage(sub_win)
+            error_window.set_message("カウント中です。\nカウントが終わるか、Escキーで\n"
+                                     "中止してからウィンドウを閉じてください。")
         else:
+            self.control.shutdown()  # 結果の保存が終わるのを待ってから、計数処理のスレッドプールを終了する
             self.destroy()
             self.quit()
 
@@ -240,6 +261,7 @@ class MainWindow(tk.Tk):
         check2_product = ttk.Radiobutton(product_f, text="開く", variable=self.var_product, value=1,
                                          command=self.start_or_open)
         check2_product.place(x=175, y=5)
+        self.product_radios = [check1_product, check2_product]  # カウント中に無効にする
         # エンター選択の関数をバインド
         check2_product.bind("<Return>", lambda event, product_num=1: self.radiobutton_enter(product_num))
 
@@ -387,6 +409,7 @@ class MainWindow(tk.Tk):
         check2_product_cnt = ttk.Radiobutton(product_f_cnt, text="開く", variable=self.var_product_cnt, value=1,
                                              command=self.start_or_open)
         check2_product_cnt.place(x=175, y=5)
+        self.product_radios += [check1_product_cnt, check2_product_cnt]
         # エンター選択の関数をバインド
         check2_product_cnt.bind("<Return>",
                                 lambda event, product_num=1: self.radiobutton_enter(product_num))
@@ -591,7 +614,7 @@ class MainWindow(tk.Tk):
         :return:
         """
         # マウスホイールイベントを取得する
-        if event.delta:
+        if event.delta and self.display_img is not None:
             x = event.x
             y = event.y
             # マウスホイールは120ごとに数字が区切られているので、回転した量を数値化する
@@ -601,12 +624,9 @@ class MainWindow(tk.Tk):
                 zoom_magnif = (self.wheel_num * 0.1 + 1)  # 画像の拡大倍率
                 new_x = int(self.width * zoom_magnif)  # 画像の幅
                 new_y = int(self.height * zoom_magnif)  # 画像の高さ
-                img_zoom = cv2.resize(self.white_img, (new_x, new_y))  # 画像のリサイズ
                 # もともと表示されていた画像のトリミング枠のズレとイベントが発生した位置から画像のトリミング枠のズレを算出
                 zoom_error_x = int(x * (zoom_magnif-self.prev_zoom_magnif) + self.margin_x)  # ズレの分だけ画像のトリミング枠が右にズレる
                 zoom_error_y = int(y * (zoom_magnif-self.prev_zoom_magnif) + self.margin_y)  # ズレの分だけ画像がトリミング枠が下にズレる
-                if self.dialog is False:
-                    img_zoom = cv2.flip(img_zoom, -1)  # 画像を切り取る前に反転する
                 # トリミング枠が画像の外になった場合、補正する
                 if zoom_error_x < 0:
                     zoom_error_x = 0
@@ -616,12 +636,11 @@ class MainWindow(tk.Tk):
                     zoom_error_y = 0
                 elif zoom_error_y + self.height > new_y:
                     zoom_error_y = new_y - self.height
-                # 画像のトリミング
-                img = img_zoom[zoom_error_y:zoom_error_y + self.height, zoom_error_x:zoom_error_x + self.width]
+                # 拡大した画像のトリミング枠の範囲だけを作る(反転・色変換済み)
+                img = self.display_img.render(self.width, self.height, zoom_magnif, zoom_error_x, zoom_error_y)
                 # 今回の枠のズレを保存する
                 self.margin_y = zoom_error_y
                 self.margin_x = zoom_error_x
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # pillowオブジェクトに変換するため色変換
                 img_array = Image.fromarray(img)  # pillowオブジェクトに変換
                 imgtk = ImageTk.PhotoImage(image=img_array)  # imgtkオブジェクトに変換
                 # 画像の貼り付け
@@ -635,15 +654,9 @@ class MainWindow(tk.Tk):
                 # self.wheel_num=0のとき必ず枠と画像サイズは一致する
                 self.wheel_num = 0
                 zoom_magnif = (self.wheel_num * 0.1 + 1)
-                new_x = int(self.width * zoom_magnif)
-                new_y = int(self.height * zoom_magnif)
-                img_zoom = cv2.resize(self.white_img, (new_x, new_y))
-                if self.dialog is False:
-                    img_zoom = cv2.flip(img_zoom, -1)
-                img = img_zoom
+                img = self.display_img.render(self.width, self.height)
                 self.margin_x = 0
                 self.margin_y = 0
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # pillowオブジェクトに変換するため色変換
                 img_array = Image.fromarray(img)  # pillowオブジェクトに変換
                 imgtk = ImageTk.PhotoImage(image=img_array)  # imgtkオブジェクトに変換
                 # 画像の貼り付け
@@ -672,7 +685,7 @@ class MainWindow(tk.Tk):
         :return:
         """
         # マウスが左クリックされているとき
-        if self.min_get is True:
+        if self.min_get is True and self.display_img is not None:
             # 座標の取得
             xmax = event.x
             ymax = event.y
@@ -682,9 +695,6 @@ class MainWindow(tk.Tk):
             zoom_magnif = (self.wheel_num * 0.1 + 1)  # 現在の画像の拡大倍率を計算
             new_x = int(self.width * zoom_magnif)
             new_y = int(self.height * zoom_magnif)
-            img_zoom = cv2.resize(self.white_img, (new_x, new_y))
-            if self.dialog is False:
-                img_zoom = cv2.flip(img_zoom, -1)
             #  トリミング枠が画像の外になった場合補正する
             if drag_error_x < 0:
                 drag_error_x = 0
@@ -694,11 +704,10 @@ class MainWindow(tk.Tk):
                 drag_error_y = 0
             elif drag_error_y + self.height > new_y:
                 drag_error_y = new_y - self.height
-            # 画像をトリミングする
-            img = img_zoom[drag_error_y:drag_error_y + self.height, drag_error_x:drag_error_x + self.width]
+            # 拡大した画像のトリミング枠の範囲だけを作る(反転・色変換済み)
+            img = self.display_img.render(self.width, self.height, zoom_magnif, drag_error_x, drag_error_y)
             self.margin_y = drag_error_y
             self.margin_x = drag_error_x
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # pillowオブジェクトに変換するため色変換
             img_array = Image.fromarray(img)  # pillowオブジェクトに変換
             imgtk = ImageTk.PhotoImage(image=img_array)  # imgtkオブジェクトに変換
             # 画像の貼り付け
@@ -781,15 +790,16 @@ class MainWindow(tk.Tk):
                 self.worker_frame.grid_configure(pady=30)
 
             # 画像が表示されている場合、画像のリサイズを行う
-            if self.count_flag is True:  # 表示画像がカウント後の画像の場合
-                self.x_resize, self.y_resize, img = self.update_size_img(self.img_draw, self.width, self.height)
-                img = cv2.flip(img, -1)
-            elif self.dialog is True:
-                self.x_resize, self.y_resize, img = self.update_size_img(self.frame, self.width, self.height)
+            # 表示中の画像の縮小画像から作り直す(反転・色変換済み)
+            if self.count_flag is True or self.dialog is True:  # 表示画像がカウント後の画像・参照画像の場合
+                self.margin_x = 0
+                self.margin_y = 0
+                self.wheel_num = 0
+                img = self.display_img.render(self.width, self.height)
             else:  # それ以外の場合
                 img = cv2.resize(self.pickle_copy, (self.width, self.height))
                 img = cv2.flip(img, -1)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # pillowオブジェクトに変換するため色変換
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # pillowオブジェクトに変換するため色変換
             img_array = Image.fromarray(img)  # pillowオブジェクトに変換
             imgtk = ImageTk.PhotoImage(image=img_array)  # imgtkオブジェクトに変換
             # 画像の貼り付け
@@ -868,18 +878,51 @@ class MainWindow(tk.Tk):
         try:
             if self.cam_flag is True:
                 # first_width, first_height, magnifを渡して画像をリサイズしたもの(pickle_copy)を返す
-                self.pickle_copy, self.frame = self.cap.get_frame_for_tk(self.first_width, self.first_height, self.magnif)
-                # カメラの映像の関係上、上下左右反転
-                pickle_copy = cv2.flip(self.pickle_copy, -1)
-                pickle_copy = cv2.cvtColor(pickle_copy, cv2.COLOR_BGR2RGB)
-                self.photo = ImageTk.PhotoImage(image=Image.fromarray(pickle_copy))
-                self.video_img.imgtk = self.photo
-                self.video_img.configure(image=self.photo)
+                pickle_copy, frame = self.cap.get_frame_for_tk(self.first_width, self.first_height, self.magnif)
+                # 新しいフレームが届いていない場合(カウント用の撮影中など)は前の映像のままにする
+                if frame is not None:
+                    self.pickle_copy, self.frame = pickle_copy, frame
+                    # カメラの映像の関係上、上下左右反転。表示サイズが同じ間はPhotoImageを使い回す
+                    self.photo = self.preview.render(self.pickle_copy)
+                    self.video_img.imgtk = self.photo
+                    self.video_img.configure(image=self.photo)
                 # delayミリ秒後に関数を繰り返す
                 self._camera_loop_id = self.after(self.delay, self.update_cam)
         except TypeError:
             pass
 
+    def toggle_fps(self, event=None):
+        """
+        F12キーにバインドされた関数
+        タイトルにカメラから読み込めたFPSと映像に表示できたFPSを表示する・元に戻す
+        """
+        self.show_fps = not self.show_fps
+        if self.show_fps is True:
+            self.update_fps()
+        else:
+            self.title(self.window_title)
+
+    def update_fps(self):
+        """fps_delayごとにループしてタイトルのFPSを更新する。show_fps=Falseになるとループが止まる"""
+        if self.show_fps is True:
+            capture_fps, display_fps = self.cap.get_fps()
+            self.title("{}  撮影 {:.1f}fps / 表示 {:.1f}fps".format(self.window_title, capture_fps, display_fps))
+            self.after(self.fps_delay, self.update_fps)
+
+    def check_write_errors(self):
+        """
+        write_check_delayごとにループして、バックグラウンドでの結果の保存に失敗していないか確認する
+        失敗していた場合はエラーメッセージを表示する
+        """
+        errors = self.control.writer.pop_errors()
+        if errors:
+            sub_win = tk.Toplevel()  # エラー表示用のウィンドウを作成
+            error_window = ErrorMessage(sub_win)
+            paths = "\n".join(path for path, _ in errors[:3])
+            error_window.set_message("結果の保存に失敗しました。({}件)\n{}\n"
+                                     "詳細はcount/log/write_error.txtを確認してください。".format(len(errors), paths))
+        self.after(self.write_check_delay, self.check_write_errors)
+
     def cam_stop(self, event):
         if self.dialog is False:
             if self.count_flag is False:
@@ -1027,18 +1070,18 @@ class MainWindow(tk.Tk):
         elif self.method_num == 1:
             self.count_button_cnt.lower(self.count_check_frame_cnt)
 
-    def update_size_img(self, frame, width, height):
+    def update_size_img(self, frame, width, height, flip=None):
         """
         frameを(width, height)にリサイズする関数。
         このときframeの縦横比が(width, height)と違った場合、周囲に余白ができるようにリサイズする。
+        拡大・ウィンドウサイズの変更で使う縮小画像(display_img)もここで作る
         :param frame: リサイズしたい画像
         :param width: リサイズ後の幅
         :param height: リサイズ後の高さ
-        :return: x:リサイズ後の幅 y:リサイズ後の高さ white:リサイズした画像
+        :param flip: 反転するかどうか None: 反転しない -1:上下左右反転
+        :return: x:リサイズ後の幅 y:リサイズ後の高さ img:リサイズ・反転したRGB画像
         """
         y, x = frame.shape[:2]
-        binary = pickle.dumps(frame)
-        pickle_copy = pickle.loads(binary)
         # 画像サイズがフレームサイズよりも大きい場合リサイズする
         if x > width:
             new_width = x
@@ -1049,15 +1092,15 @@ class MainWindow(tk.Tk):
         if y > new_height:
             new_width = int(width * y / height)
             new_height = y
-        white = np.ones((new_height, new_width, 3), np.uint8) * 255  # 画像のサイズとフレームのサイズが合わない部分を埋める白画像を作成
+        white = np.full((new_height, new_width, 3), 255, np.uint8)  # 画像のサイズとフレームのサイズが合わない部分を埋める白画像を作成
         margin_x = int((new_width - x) / 2)
         margin_y = int((new_height - y) / 2)
-        white[margin_y:margin_y + y, margin_x:margin_x + x] = pickle_copy  # 白画像中央にフレームを配置
+        white[margin_y:margin_y + y, margin_x:margin_x + x] = frame  # 白画像中央にフレームを配置
         self.margin_x = 0
         self.margin_y = 0
         self.wheel_num = 0
-        self.white_img = white
-        img = cv2.resize(white, (width, height))  # 画像をリサイズする
+        self.display_img = DisplayImage(white, flip)
+        img = self.display_img.render(width, height)  # 画像をリサイズする
         return x, y, img
 
     def update_result_img(self, img, flip=100):
@@ -1069,10 +1112,8 @@ class MainWindow(tk.Tk):
         # 結果画像の表示サイズ取得
         width = int(self.first_width * self.magnif)
         height = int(self.first_height * self.magnif)
-        self.x_resize, self.y_resize, white = self.update_size_img(img, width, height)  # 画像のリサイズ
-        if flip is not 100:
-            white = cv2.flip(white, flip)  # 画像の回転
-        img = cv2.cvtColor(white, cv2.COLOR_BGR2RGB)  # pillowオブジェクトに変換
+        # 画像のリサイズ・回転・pillowオブジェクトに変換するための色変換
+        self.x_resize, self.y_resize, img = self.update_size_img(img, width, height, None if flip == 100 else flip)
         img_array = Image.fromarray(img)
         # 結果画像の反映
         imgtk = ImageTk.PhotoImage(image=img_array)
@@ -1243,13 +1284,168 @@ class MainWindow(tk.Tk):
                 self.count_button_cnt.configure(style="TButton")
                 self.count_button_cnt.update()
 
+    def count_button_progress(self, text):
+        """カウント中のボタンに進み具合を表示する"""
+        if self.method_num == 0:
+            self.count_button_text.set("カウント中... " + text)
+        else:
+            self.count_button_text_cnt.set("カウント中... " + text)
+
+    def count_worker(self, num, product_name, control_no, sheet_no, dir_name, pattern_dir, dialog, frame):
+        """
+        カウント用のスレッドで実行する。進み具合と結果はcount_queueでTkのスレッドに渡す
+        Tkのウィジェットはこのスレッドから操作しないこと
+        """
+        def progress(step, step_num, text):
+            self.count_queue.put(("progress", "{} ({}/{})".format(text, step, step_num)))
+
+        try:
+            result = self.control.run_count(num, product_name, control_no, sheet_no, dir_name, pattern_dir,
+                                            dialog, self.cap, frame,
+                                            progress=progress, cancel_event=self.count_cancel)
+        except CountCancelled:
+            result = "cancel"
+        except:
+            self.write_count_error()
+            result = 100
+        self.count_queue.put(("done", result))
+
+    def check_count(self, product_name, control_no, sheet_no):
+        """
+        count_check_delayごとにループして、カウント用のスレッドの進み具合をボタンに表示する
+        カウントが終わったら結果を表示する
+        """
+        while True:
+            try:
+                kind, value = self.count_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.count_button_progress(value)
+            else:
+                self.counting = False
+                self.lock_count_widgets(False)  # 結果を表示する場合はcount_finishedで改めて無効にする
+                self.count_finished(value, product_name, control_no, sheet_no)
+                return
+        self.after(self.count_check_delay, self.check_count, product_name, control_no, sheet_no)
+
+    def lock_count_widgets(self, locked):
+        """
+        バックグラウンドでカウントしている間、手法・製品・新規/開く・ファイルを切り替えられないようにする
+        count_finishedで結果を表示するときと同じウィジェットを無効にする。カメラを使うので製品名登録も開かない
+        :param locked: True: 無効にする False: 動画(もしくはファイル参照した画像)の表示中の状態に戻す
+        """
+        if locked:
+            self.filedialog.entryconfig(u"ファイル参照", state="disabled")
+            self.filedialog.entryconfig(u"動画に戻る", state="disabled")
+            self.menubar.entryconfig(u"製品名登録", state="disabled")
+            self.product_box.configure(state="disabled")
+            self.product_box_cnt.configure(state="disabled")
+            if self.method_num == 0:
+                self.method_note.tab(1, state="disabled")
+            else:
+                self.method_note.tab(0, state="disabled")
+            for radio in self.product_radios:
+                radio.state(["disabled"])
+        else:
+            # ファイル参照した画像をカウントしていた場合は、ファイル参照後と同じ状態に戻す
+            self.filedialog.entryconfig(u"ファイル参照", state="disabled" if self.dialog else "normal")
+            self.filedialog.entryconfig(u"動画に戻る", state="normal" if self.dialog else "disabled")
+            self.menubar.entryconfig(u"製品名登録", state="normal")
+            self.product_box.configure(state="readonly")
+            self.product_box_cnt.configure(state="readonly")
+            self.method_note.tab(0, state="normal")
+            self.method_note.tab(1, state="normal")
+            for radio in self.product_radios:
+                radio.state(["!disabled"])
+
+    def cancel_count(self, event=None):
+        """
+        Escキーにバインドされた関数
+        カウント中の場合、次の段階に進む前(マッチング中はパターン画像ごと)に中止する
+        """
+        if self.counting is True:
+            self.count_cancel.set()
+            self.count_button_progress("中止しています")
+
+    @staticmethod
+    def write_count_error():
+        """カウント中に起きたエラーをpreprocessing_errorに書き出す"""
+        import traceback
+        import os
+        error_dir = "./preprocessing_error/"
+        os.makedirs(error_dir, exist_ok=True)
+        now = datetime.now()
+        str_now = "{0:%m%d_%H%M}".format(now)
+        file_name = error_dir + str_now + ".txt"
+        with open(file_name, "w") as f:
+            pass
+        traceback.print_exc(file=open(file_name, "a"))
+
+    def count_finished(self, result, product_name, control_no, sheet_no):
+        """
+        カウントの結果を受け取り、表示する
+        :param result: Control.run_countの結果 または None, False, 100(エラー), "cancel"(中止)
+        """
+        if result is None:
+            self.count_stop()
+        # 既に存在するNoを指定した場合
+        elif result is False:
+            sub_win = tk.Toplevel()
+            error_window = ErrorMessage(sub_win)
+            error_window.set_message("この番号のファイルは既に\n存在しています。\n"
+                                     "別の番号を指定してください。")
+            self.count_stop()
+        elif result == "cancel":  # Escキーで中止した場合
+            self.control.delete_dir(product_name, control_no, sheet_no)
+            self.count_stop()
+        elif result == 100:  # マッチング中にエラーが起きた場合
+            sub_win = tk.Toplevel()
+            error_window = ErrorMessage(sub_win)
+            error_window.set_message("カウント中にエラーが発生しました。\nやり直してください。")
+            self.control.delete_dir(product_name, control_no, sheet_no)
+            self.count_stop()
+        else:  # カウントできた場合
+            self.cam_flag = False  # 結果を表示している間は映像を止める
+            self.is_count = result[7]
+            self.new_count = self.is_count
+            self.img_draw = result[8]
+            self.result_count = result
+            theoretical_amount = result[5]
+            self.display_result(self.is_count, self.img_draw)
+            yield_rate_limit = result[6]
+            # カウント数より理論数量が小さければ良品数を赤色で表示する
+            if self.is_count > theoretical_amount:
+                self.count_result.configure(foreground="#8b0000")
+            # 歩留が設定した下限を下回った場合メッセージを表示する
+            if self.is_count/theoretical_amount * 100 < yield_rate_limit:
+                error_win = tk.Toplevel()
+                error_window = ErrorMessage(error_win)
+                error_window.set_message("歩留率が設定値を下回りました")
+            self.count_flag = True
+            self.filedialog.entryconfig(u"ファイル参照", state="disabled")
+            self.filedialog.entryconfig(u"動画に戻る", state="disabled")
+            self.menubar.entryconfig(u"製品名登録", state="disabled")
+            self.dialog = False
+            self.f_detection_str.set("0")
+            self.n_detection_str.set("0")
+            self.product_box.configure(state="disabled")
+            self.product_box_cnt.configure(state="disabled")
+            if self.method_num == 0:
+                self.method_note.tab(1, state="disabled")
+            else:
+                self.method_note.tab(0, state="disabled")
+        self.count_button_text_change(False)
+
     def count(self):
         """
         count_buttonにバインドされた関数
         新規：frameをカウントして結果を受け取り、表示
         開く：既にカウントされた結果を呼び出して表示
         """
-        self.cam_flag = False
+        # カウント中は受け付けない(ボタンのcommandとbindの両方から呼ばれる)
+        if self.counting is True:
+            return
         # 入力された情報を取得する
         if self.method_num == 0:
             product_name = self.product.get()
@@ -1293,68 +1489,27 @@ class MainWindow(tk.Tk):
             # 2つとも入力されている場合
             else:
                 try:
-                    # カウントスタート
-                    result = self.control.count(self.method_num, product_name, control_no, sheet_no,
-                                                self.dialog, self.cap, self.frame)
+                    # 製品情報の取得と結果のディレクトリの作成(データベースを使うのでこのスレッドで行う)
+                    prepared = self.control.prepare_count(product_name, control_no, sheet_no)
                 except:
-                    import traceback
-                    import os
-                    error_dir = "./preprocessing_error/"
-                    os.makedirs(error_dir, exist_ok=True)
-                    now = datetime.now()
-                    str_now = "{0:%m%d_%H%M}".format(now)
-                    file_name = error_dir + str_now + ".txt"
-                    with open(file_name, "w") as f:
-                        pass
-                    traceback.print_exc(file=open(file_name, "a"))
-                    result = 100
-                if result is None:
-                    self.count_stop()
-                # 既に存在するNoを指定した場合
-                elif result is False:
-                    sub_win = tk.Toplevel()
-                    error_window = ErrorMessage(sub_win)
-                    error_window.set_message("この番号のファイルは既に\n存在しています。\n"
-                                             "別の番号を指定してください。")
-                    self.count_stop()
-                elif result == 100:  # マッチング中にエラーが起きた場合
-                    sub_win = tk.Toplevel()
-                    error_window = ErrorMessage(sub_win)
-                    error_window.set_message("カウント中にエラーが発生しました。\nやり直してください。")
-                    self.control.delete_dir(product_name, control_no, sheet_no)
-                    self.count_stop()
-                else:  # カウントできた場合
-                    self.is_count = result[7]
-                    self.new_count = self.is_count
-                    self.img_draw = result[8]
-                    self.result_count = result
-                    theoretical_amount = result[5]
-                    self.display_result(self.is_count, self.img_draw)
-                    yield_rate_limit = result[6]
-                    # カウント数より理論数量が小さければ良品数を赤色で表示する
-                    if self.is_count > theoretical_amount:
-                        self.count_result.configure(foreground="#8b0000")
-                    # 歩留が設定した下限を下回った場合メッセージを表示する
-                    if self.is_count/theoretical_amount * 100 < yield_rate_limit:
-                        error_win = tk.Toplevel()
-                        error_window = ErrorMessage(error_win)
-                        error_window.set_message("歩留率が設定値を下回りました")
-                    self.count_flag = True
-                    self.filedialog.entryconfig(u"ファイル参照", state="disabled")
-                    self.filedialog.entryconfig(u"動画に戻る", state="disabled")
-                    self.menubar.entryconfig(u"製品名登録", state="disabled")
-                    self.dialog = False
-                    self.f_detection_str.set("0")
-                    self.n_detection_str.set("0")
-                    self.product_box.configure(state="disabled")
-                    self.product_box_cnt.configure(state="disabled")
-                    if self.method_num == 0:
-                        self.method_note.tab(1, state="disabled")
-                    else:
-                        self.method_note.tab(0, state="disabled")
-                self.count_button_text_change(False)
+                    self.write_count_error()
+                    prepared = 100
+                if prepared is None or prepared is False or prepared == 100:
+                    self.count_finished(prepared, product_name, control_no, sheet_no)
+                else:
+                    # 撮影からカウントまでは別スレッドで行い、その間も映像の更新を続ける
+                    dir_name, pattern_dir = prepared
+                    self.counting = True
+                    self.count_cancel.clear()
+                    self.lock_count_widgets(True)
+                    thread = threading.Thread(target=self.count_worker, name="count", daemon=True,
+                                              args=(self.method_num, product_name, control_no, sheet_no,
+                                                    dir_name, pattern_dir, self.dialog, self.frame))
+                    thread.start()
+                    self.after(self.count_check_delay, self.check_count, product_name, control_no, sheet_no)
         # 開く
         else:
+            self.cam_flag = False
             result = self.control.open_result(control_no, sheet_no, product_name)
             # ファイルが存在しなかった場合(result = False)
             if result is False:
@@ -0,0 +1,85 @@
+"""
+露出を変えて撮影した画像からHDR画像(露出合成画像)を作成する
+
+full: cv2.MergeMertensで合成する。MergeMertensは使い回す
+fast: 縮小画像をMergeMertensで合成して2枚を混ぜる割合を求め、拡大した割合で元の解像度の画像を混ぜる
+      元の解像度ではラプラシアンピラミッドを作らない分速いが、細かい部分の局所的なコントラストはfullより弱くなる
+"""
+import cv2
+import numpy as np
+
+
+hdr_modes = ["full", "fast"]
+fast_scale = 4  # fastで重みを計算するときの縮小率
+min_weight_denominator = 1e-4  # 2枚の差(0~1の二乗和)がこれ以下の画素は重みを0.5にする
+
+
+class HDRMerger:
+    def __init__(self, mode="full", scale=fast_scale):
+        """
+        Args:
+            mode (str): "full" or "fast"
+            scale (int): fastで重みを計算するときの縮小率
+        """
+        if mode not in hdr_modes:
+            raise ValueError("mode must be one of {}: {}".format(hdr_modes, mode))
+        self.mode = mode
+        self.scale = scale
+        self._merge_mertens = cv2.createMergeMertens()
+        self._buffers = {}  # {名前: 配列}。計算途中の重みなど、同じ解像度の間は使い回す
+
+    def process(self, imgs):
+        """
+        Args:
+            imgs (list[img_bgr]): 露出を変えて撮影した同じサイズの画像
+
+        Returns:
+            img_bgr: 合成した画像。保存待ちの間も使われるので、毎回新しい配列を返す
+        """
+        if self.mode == "fast":
+            return self._process_fast(imgs)
+        return self._process_full(imgs)
+
+    def _process_full(self, imgs):
+        """MergeMertensで合成し、0~255に収めて8bitにする"""
+        res = self._merge_mertens.process(imgs)
+        np.multiply(res, 255, out=res)
+        np.clip(res, 0, 255, out=res)
+        out = np.empty(imgs[0].shape, np.uint8)
+        np.copyto(out, res, casting="unsafe")  # astype("uint8")と同じく小数は切り捨て
+        return out
+
+    def _process_fast(self, imgs):
+        """
+        縮小画像をMergeMertensで合成し、合成結果が元の2枚をどの割合で混ぜたものになっているか(重み)を画素ごとに求める
+        その重みを元の解像度に拡大して、cv2.blendLinearで8bitのまま2枚を混ぜる
+        3枚以上の場合はfullで合成する
+        """
+        if len(imgs) != 2:
+            return self._process_full(imgs)
+        height, width = imgs[0].shape[:2]
+        small_size = (max(1, width // self.scale), max(1, height // self.scale))
+        small_imgs = [cv2.resize(img, small_size, interpolation=cv2.INTER_AREA) for img in imgs]
+        fused = self._merge_mertens.process(small_imgs)  # 0~1
+        small1, small2 = [img.astype(np.float32) / 255 for img in small_imgs]
+        # fused = w * small1 + (1 - w) * small2 となるwを、3チャンネルの最小二乗で求める
+        diff = small1 - small2
+        numerator = ((fused - small2) * diff).sum(axis=2)
+        denominator = (diff * diff).sum(axis=2)
+        small_weight = np.full(denominator.shape, 0.5, np.float32)  # 2枚の差がない部分はどちらでもよい
+        valid = denominator > min_weight_denominator
+        small_weight[valid] = np.clip(numerator[valid] / denominator[valid], 0, 1)
+        weight1 = self._buffer("weight1", (height, width), np.float32)
+        weight2 = self._buffer("weight2", (height, width), np.float32)
+        cv2.resize(small_weight, (width, height), dst=weight1, interpolation=cv2.INTER_LINEAR)
+        cv2.subtract(1.0, weight1, dst=weight2)
+        out = np.empty(imgs[0].shape, np.uint8)
+        return cv2.blendLinear(imgs[0], imgs[1], weight1, weight2, dst=out)
+
+    def _buffer(self, name, shape, dtype):
+        """nameのバッファを返す。サイズが変わった場合は確保し直す"""
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self._buffers[name] = buffer
+        return buffer
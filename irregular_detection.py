@@ -9,6 +9,8 @@
 import cv2
 import numpy as np
 
+from worker_pool import get_default_pool
+
 
 def color_thresh(img):
     b, g, r = cv2.split(img)   # チャンネル分解
@@ -105,6 +107,19 @@ def preprocessing(img_rot, pattern):
 
 
 def mill_ends(img, black,  result):
+    return _draw_mill_ends(result, _mill_ends_contours(img, black))
+
+
+def _draw_mill_ends(result, contours):
+    """端材の残りを水色の矩形で描画する"""
+    for cnt in contours:
+        x, y, w, h = cv2.boundingRect(cnt)
+        cv2.rectangle(result, (x - 5, y - 5), (x + w + 5, y + h + 5), (255, 255, 0), 2)
+    return result
+
+
+def _mill_ends_contours(img, black):
+    """端材の残りの輪郭を抽出する"""
     img_dst = morphology(img, 5, "open")
     img_dst = morphology(img_dst, 9, "dilate")
     img_nega = cv2.bitwise_not(img_dst)
@@ -114,13 +129,21 @@ def mill_ends(img, black,  result):
     img_mask = morphology(img_mask, 5, "open")
 
     contours, hierarchy = cv2.findContours(img_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)  # 輪郭を抽出する
-    for cnt in contours:
-        x, y, w, h = cv2.boundingRect(cnt)
-        cv2.rectangle(result, (x - 5, y - 5), (x + w + 5, y + h + 5), (255, 255, 0), 2)
-    return result
+    return contours
 
 
 def out_of_position(img, black, result):
+    return _draw_out_of_position(result, _out_of_position_contours(img, black))
+
+
+def _draw_out_of_position(result, contours):
+    """位置ズレした製品を赤い輪郭で描画する"""
+    cv2.drawContours(result, contours, -1, (0, 0, 255), 2)
+    return result
+
+
+def _out_of_position_contours(img, black):
+    """位置ズレした製品の輪郭を抽出する"""
     dst = morphology(black, 7, "dilate")  # 製品と製品の間の溝を無くす
     dst = morphology(dst, 3, "erode")  # 面積が広くなりすぎないように元に戻す
     dst_nega = cv2.bitwise_not(dst)
@@ -130,11 +153,10 @@ def out_of_position(img, black, result):
     img_mask = morphology(img_mask, 5, "open")
 
     contours, hierarchy = cv2.findContours(img_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)  # 輪郭を抽出する
-    cv2.drawContours(result, contours, -1, (0, 0, 255), 2)
-    return result
+    return contours
 
 
-def irregular_detection(img, black, pattern, result, me=True, oop=True):
+def irregular_detection(img, black, pattern, result, me=True, oop=True, pool=None):
     """
     イレギュラー検知を行う関数
     me = mill ends 端材の検出
@@ -145,13 +167,19 @@ def irregular_detection(img, black, pattern, result, me=True, oop=True):
     :param result: カウント結果描画後の画像
     :param me: True or False　検出を行うかどうか
     :param oop: True or False　検出を行うかどうか
+    :param pool: WorkerPool 2つとも行う場合に並列に検出するスレッドプール。Noneのとき共有のプール
     :return:　検出した結果
     """
     img_preprocess = preprocessing(img, pattern)
     # イレギュラー検知を2つとも行う場合
     if me is True and oop is True:
-        result = mill_ends(img_preprocess, black, result)
-        result = out_of_position(img_preprocess, black, result)
+        if pool is None:
+            pool = get_default_pool()
+        # 輪郭の抽出は互いに依存しないので並列に行い、描画は元と同じ順番で行う
+        me_future = pool.submit(_mill_ends_contours, img_preprocess, black)
+        oop_contours = _out_of_position_contours(img_preprocess, black)
+        result = _draw_mill_ends(result, me_future.result())
+        result = _draw_out_of_position(result, oop_contours)
     # 端材の残りの検出のみする場合
     elif me is True:
         result = mill_ends(img_preprocess, black, result)
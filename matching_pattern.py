@@ -2,25 +2,71 @@
 """
 製品検出のみを行う
 """
-from multiprocessing.pool import ThreadPool as Pool
+import os
 
 import cv2
 import numpy as np
 
+from fft_matching import FFTCorrelator
+from pattern_store import PatternStore
+from stage_timer import stage_timer
+from tray_roi import find_tray_roi, skipped_fraction
+from worker_pool import get_default_pool
+
+
+# full: 原寸でマッチング pyramid: 縮小画像で候補を探してから原寸で絞り込む
+# fft: 原寸でマッチング。全体画像のフーリエ変換を4枚のパターン画像で共有する(fft_matching.py)
+matching_modes = ["full", "pyramid", "fft"]
+pyramid_threshold_margin = 0.15  # 縮小画像で候補を探すときは、閾値をこの値だけ下げる
+pyramid_min_pattern_size = 16  # 縮小後のパターン画像の短辺がこの値を下回らないように縮小回数を減らす
+# 中止を確認しながら原寸でマッチングするとき、結果画像のこの行数ずつに分けてマッチングし、その間に中止を確認する
+cancel_check_rows = 512
+nms_ratio = 0.5  # 検出位置の間隔がパターン画像の幅・高さのこの割合未満のときは、同じ製品として低い方を除く
+# 採用回数の多いパターン画像だけで確認するのに必要な、そのパターン画像の採用回数(ウォームアップ)
+# 製品ごとに最初のこの枚数は4枚でマッチングする。確認できなかった場合は4枚でマッチングしなおすので、
+# 少なくしても結果は変わらず、4枚でのマッチングが無駄になる回数が増えるだけ
+history_min_wins = 3
+history_min_ratio = 0.9  # 採用回数の多いパターン画像だけで確認するのに必要な、そのパターン画像の採用回数の割合
+# 縮小画像での候補の数が、採用履歴のパターン画像以外で最も多いパターン画像のこの倍数以上のときだけ、採用履歴のパターン画像を使う
+# (トレーが回転した場合やパターン画像が変わった場合に、違う向きのパターン画像で数えないようにする)
+history_min_margin = 1.5
+
+
+class MatchingCancelled(Exception):
+    """get_result_and_countのshould_cancelがTrueを返したときに送出する"""
+
 
 class PatternImage:
-    def __init__(self, k_size, threshold):
+    def __init__(self, k_size, threshold, pattern_store=None, matching_mode="full", pyramid_levels=2, pool=None,
+                 history=None, tray_roi=False):
         """
         回転した画像をパターン画像でテンプレートマッチングするクラス、検出場所に色を付けて返す
 
         Args:
             k_size (int): 二値化画像をモルフォロジー変換するときのカーネル値
             threshold (float): 製品を検出するときの閾値
+            pattern_store (PatternStore or None): パターン画像の保持先。Noneのときこのインスタンス専用に作成
+            matching_mode (str): "full", "pyramid" or "fft"
+            pyramid_levels (int): pyramidのときの縮小回数(1回で1/2)
+            pool (WorkerPool or None): 4枚のパターン画像のマッチングを並列に行うスレッドプール。Noneのとき共有のプール
+            history (dict or None): 製品のパターン画像の採用履歴(setting_count.new_pattern_historyの形式)。
+                                    指定した場合、いつも採用されるパターン画像があれば縮小画像で他の3枚より十分多く
+                                    マッチすることを確かめ、確かめられたときは原寸の4枚のマッチングを省く。マッチングの結果で履歴を更新する
+            tray_roi (bool): Trueのとき、縮小画像で製品が並んでいる範囲を求め、その範囲だけでマッチング・計数を行う
         """
         self.kernel = np.ones((k_size, k_size), np.uint8)
         self.threshold = threshold
-
-    def get_result_and_count(self, img_rot, dir_path, _matching_threshold, _hls_range):
+        self.pattern_store = pattern_store if pattern_store is not None else PatternStore()
+        self.matching_mode = matching_mode
+        self.pyramid_levels = pyramid_levels
+        self.pool = pool if pool is not None else get_default_pool()
+        self.history = history
+        self.tray_roi = tray_roi
+        self.roi_skipped = 0.0  # 直前のget_result_and_countで、製品の範囲の外側として省いた画素の割合
+        self.history_fast = False  # 直前のget_result_and_countで、採用履歴のパターン画像だけで確かめられたかどうか
+        self._should_cancel = None  # 実行中のget_result_and_countのshould_cancel
+
+    def get_result_and_count(self, img_rot, dir_path, _matching_threshold, _hls_range, should_cancel=None):
         """
         回転画像にテンプレートマッチングをかけて、マッチした製品を緑で描画した画像とその製品数を返す
 
@@ -29,69 +75,312 @@ class PatternImage:
             dir_path (string): ファイルパス(ベースネーム前まで)
             _matching_threshold (float): パターンマッチングの閾値
             _hls_range ([int, int, int]): HLSRange
+            should_cancel (function or None): 引数なしでTrueを返すと、パターン画像ごと(候補領域ごと)のマッチングの
+                                              前に中止してMatchingCancelledを送出する
 
         Returns:
             img_bgr, int, img_bgr, int, int, img_bgr, img_th: 結果描画後の画像、計数結果、結果描画前の画像、パターン画像の幅、パターン画像の高さ、パターン画像、白矩形付き黒画像
         """
-        p = Pool(4)
-        args = [(img_rot, dir_path, "pattern1.jpg"), (img_rot, dir_path, "pattern2.jpg"),
-                (img_rot, dir_path, "pattern3.jpg"), (img_rot, dir_path, "pattern4.jpg")]
-        count_and_pattern_path_list = p.map(self._get_correct_pattern, args)
+        self._should_cancel = should_cancel
+        if self.tray_roi:
+            with stage_timer.stage("tray_roi"):
+                roi = find_tray_roi(img_rot)
+            self.roi_skipped = skipped_fraction(roi, img_rot.shape)
+            img_rot = img_rot[roi[2]:roi[3], roi[0]:roi[1]]
+        with stage_timer.stage("matching"):
+            img_rot_gray = cv2.cvtColor(img_rot, cv2.COLOR_BGR2GRAY)  # グレースケール化は1回だけ行い、4枚のパターンで共有する
+            patterns = self.pattern_store.get(dir_path)
+            pattern, res = None, None
+            if self.history is not None:
+                pattern, res = self._match_history(img_rot_gray, patterns)
+            fast = pattern is not None
+            if not fast:
+                if self.matching_mode == "pyramid":
+                    pattern, res = self._match_pyramid(img_rot_gray, patterns)
+                elif self.matching_mode == "fft":
+                    pattern, res = self._match_fft(img_rot_gray, patterns)
+                else:
+                    pattern, res = self._match_full(img_rot_gray, patterns)
+            self._check_cancel()  # 中止された場合は採用履歴に加えない
+            self.history_fast = fast
+            if self.history is not None:
+                self._update_history(pattern, fast)
+
+        pattern_img = pattern.img
+        h, w = pattern_img.shape[:2]
+
+        with stage_timer.stage("nms_count"):
+            black_back = self._get_black_back(img_rot)
+            black_back = black_back.astype(np.uint8)
+
+            black_and_white_rect = self._get_black_and_white_rect(res, black_back, w, h)
+
+            x_min, x_max, y_min, y_max = self._trim(black_and_white_rect)
+            img_rot = img_rot[y_min:y_max, x_min:x_max]
+            black_and_white_rect = black_and_white_rect[y_min:y_max, x_min:x_max]
+
+            result_img, count_result = self._count(img_rot, black_and_white_rect)
+        return result_img, count_result, img_rot, w, h, pattern_img, black_and_white_rect
+
+    def _check_cancel(self):
+        """get_result_and_countのshould_cancelがTrueを返したらMatchingCancelledを送出する"""
+        if self._should_cancel is not None and self._should_cancel():
+            raise MatchingCancelled()
+
+    def _match_full(self, img_rot_gray, patterns):
+        """
+        4枚のパターン画像を原寸でマッチングし、最もマッチしたパターン画像とそのマッチング結果を返す
+
+        Args:
+            img_rot_gray (img_gray): グレースケールの回転画像
+            patterns (list[Pattern]): パターン画像4枚
+
+        Returns:
+            Pattern or None, img_th or None: 最もマッチしたパターン画像、マッチング結果画像
+        """
+        args = [(img_rot_gray, pattern) for pattern in patterns]
+        return self._select_pattern(self.pool.map(self._get_correct_pattern, args))
+
+    def _match_history(self, img_rot_gray, patterns):
+        """
+        採用履歴でいつも採用されているパターン画像が、縮小画像で4枚の中で十分多く候補を持つことを確かめ、
+        その1枚だけを原寸でマッチングする
+        縮小画像での候補の数が他のパターン画像の最大のhistory_min_margin倍に満たない、もしくは原寸で閾値以上の点が
+        無い場合は確かめられなかったとしてNone, Noneを返す。このときは4枚のパターン画像でマッチングしなおす
+        パターン画像が小さく縮小できない場合は、確かめるのに4枚の原寸のマッチングがかかるので確かめない
+
+        Args:
+            img_rot_gray (img_gray): グレースケールの回転画像
+            patterns (list[Pattern]): パターン画像4枚
+
+        Returns:
+            Pattern or None, img_th or None: 採用履歴のパターン画像、そのマッチング結果画像
+        """
+        pattern = self._get_history_winner(patterns)
+        if pattern is None:
+            return None, None
+        level = self._get_pyramid_level(patterns)
+        if level == 0:
+            return None, None
+        with stage_timer.stage("matching_history"):
+            img_small = img_rot_gray
+            for _ in range(level):
+                img_small = cv2.pyrDown(img_small)
+            args = [(img_small, candidate, level) for candidate in patterns]
+            winner_count, coarse_res, other_count = 0, None, 0
+            for count, candidate, candidate_res in self.pool.map(self._get_coarse_pattern, args):
+                if candidate is pattern:
+                    winner_count, coarse_res = count, candidate_res
+                else:
+                    other_count = max(other_count, count)
+            if winner_count == 0 or winner_count < other_count * history_min_margin:
+                return None, None
+            self._check_cancel()
+            if self.matching_mode == "pyramid":
+                res = self._refine_match(img_rot_gray, pattern, coarse_res, level)
+            elif self.matching_mode == "fft":
+                res = FFTCorrelator(img_rot_gray).match(pattern, self._check_cancel)
+            else:
+                res = self._template_match_cancellable(img_rot_gray, pattern.gray)
+            if not np.any(res >= self.threshold):
+                return None, None
+        return pattern, res
+
+    def _get_history_winner(self, patterns):
+        """採用回数がhistory_min_wins以上、かつ割合がhistory_min_ratio以上のパターン画像。無ければNone"""
+        wins = self.history["wins"]
+        total = sum(wins.values())
+        for pattern in patterns:
+            win = wins.get(os.path.basename(pattern.file_name), 0)
+            if win >= history_min_wins and win >= total * history_min_ratio:
+                return pattern
+        return None
+
+    def _update_history(self, pattern, fast):
+        """マッチングの結果を採用履歴に加える"""
+        self.history["count_num"] += 1
+        if fast:
+            self.history["fast_num"] += 1
+        if pattern is not None:
+            name = os.path.basename(pattern.file_name)
+            self.history["wins"][name] = self.history["wins"].get(name, 0) + 1
+
+    def _match_fft(self, img_rot_gray, patterns):
+        """
+        全体画像のフーリエ変換を1回だけ計算し、4枚のパターン画像を原寸でマッチングする
+        マッチング結果はcv2.TM_CCOEFF_NORMEDとほぼ同じ(差はbenchmark.py matchingで確認する)
 
-        provisional_count, provisional_pattern_path = 0, None
-        for count, pattern_path in count_and_pattern_path_list:
+        Args:
+            img_rot_gray (img_gray): グレースケールの回転画像
+            patterns (list[Pattern]): パターン画像4枚
+
+        Returns:
+            Pattern or None, img_th or None: 最もマッチしたパターン画像、マッチング結果画像
+        """
+        correlator = FFTCorrelator(img_rot_gray)
+        self._check_cancel()
+        args = [(correlator, pattern) for pattern in patterns]
+        return self._select_pattern(self.pool.map(self._get_fft_pattern, args))
+
+    @staticmethod
+    def _select_pattern(count_pattern_and_res_list):
+        """最もマッチしたパターン画像と、そのマッチング結果をそのまま返す"""
+        provisional_count, provisional_pattern, res = 0, None, None
+        for count, pattern, pattern_res in count_pattern_and_res_list:
             if count > provisional_count:
-                provisional_count, provisional_pattern_path = count, pattern_path
+                provisional_count, provisional_pattern, res = count, pattern, pattern_res
+        return provisional_pattern, res
 
-        pattern_img = cv2.imread(provisional_pattern_path)
-        h, w = pattern_img.shape[:2]
-        res = self._template_match(img_rot, pattern_img)
+    def _match_pyramid(self, img_rot_gray, patterns):
+        """
+        縮小画像で4枚のパターン画像をマッチングして最もマッチしたパターン画像を選び、
+        縮小画像で見つかった候補の周辺だけを原寸でマッチングしなおす
+        候補以外の位置のマッチング結果は-1になる
+
+        Args:
+            img_rot_gray (img_gray): グレースケールの回転画像
+            patterns (list[Pattern]): パターン画像4枚
 
-        black_back = self._get_black_back(img_rot)
-        black_back = black_back.astype(np.uint8)
+        Returns:
+            Pattern or None, img_th or None: 最もマッチしたパターン画像、マッチング結果画像
+        """
+        level = self._get_pyramid_level(patterns)
+        if level == 0:  # パターン画像が小さく縮小できない場合
+            return self._match_full(img_rot_gray, patterns)
 
-        black_and_white_rect = self._get_black_and_white_rect(res, black_back, w, h)
+        img_small = img_rot_gray
+        for _ in range(level):
+            img_small = cv2.pyrDown(img_small)
 
-        x_min, x_max, y_min, y_max = self._trim(black_and_white_rect)
-        img_rot = img_rot[y_min:y_max, x_min:x_max]
-        black_and_white_rect = black_and_white_rect[y_min:y_max, x_min:x_max]
+        args = [(img_small, pattern, level) for pattern in patterns]
+        count_pattern_and_res_list = self.pool.map(self._get_coarse_pattern, args)
 
-        result_img, count_result = self._count(img_rot, black_and_white_rect)
-        return result_img, count_result, img_rot, w, h, pattern_img, black_and_white_rect
+        provisional_count, provisional_pattern, coarse_res = 0, None, None
+        for count, pattern, pattern_res in count_pattern_and_res_list:
+            if count > provisional_count:
+                provisional_count, provisional_pattern, coarse_res = count, pattern, pattern_res
+        if provisional_pattern is None:
+            return None, None
+        return provisional_pattern, self._refine_match(img_rot_gray, provisional_pattern, coarse_res, level)
+
+    def _get_pyramid_level(self, patterns):
+        """パターン画像が小さくなりすぎない縮小回数を返す"""
+        min_side = min(min(pattern.w, pattern.h) for pattern in patterns)
+        level = self.pyramid_levels
+        while level > 0 and min_side / 2 ** level < pyramid_min_pattern_size:
+            level -= 1
+        return level
+
+    def _get_coarse_pattern(self, arg):
+        """
+        縮小画像と縮小したパターン画像のテンプレートマッチングの計数結果、パターン画像、マッチング結果を返す
+        並列処理により4回処理される
+
+        Args:
+            arg ((img_gray, Pattern, int)): 縮小したグレースケールの回転画像、パターン画像、縮小回数
+
+        Returns:
+            int, Pattern, img_th: 候補の数、パターン画像、縮小画像でのマッチング結果画像
+        """
+        img_small, pattern, level = arg
+        self._check_cancel()
+        result = self._template_match(img_small, pattern.get_pyramid_gray(level))
+        match_count = np.count_nonzero(result >= self.threshold - pyramid_threshold_margin)
+        return match_count, pattern, result
+
+    def _refine_match(self, img_rot_gray, pattern, coarse_res, level):
+        """
+        縮小画像でのマッチング結果から候補領域を求め、その周辺だけ原寸でマッチングする
+
+        Args:
+            img_rot_gray (img_gray): グレースケールの回転画像
+            pattern (Pattern): パターン画像
+            coarse_res (img_th): 縮小画像でのマッチング結果画像
+            level (int): 縮小回数
+
+        Returns:
+            img_th: 原寸のマッチング結果画像(候補以外は-1)
+        """
+        scale = 2 ** level
+        pad = 2 * scale  # 縮小による位置のズレを吸収する余白
+        img_h, img_w = img_rot_gray.shape[:2]
+        res = np.full((img_h - pattern.h + 1, img_w - pattern.w + 1), -1, np.float32)
+
+        candidate = (coarse_res >= self.threshold - pyramid_threshold_margin).astype(np.uint8)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(candidate)
+        for x, y, w, h, _ in stats[1:]:  # 0番目は背景
+            x_min = max(x * scale - pad, 0)
+            y_min = max(y * scale - pad, 0)
+            x_max = min((x + w) * scale + pad, res.shape[1])
+            y_max = min((y + h) * scale + pad, res.shape[0])
+            if x_min >= x_max or y_min >= y_max:
+                continue
+            self._check_cancel()
+            img_roi = img_rot_gray[y_min:y_max + pattern.h - 1, x_min:x_max + pattern.w - 1]
+            res[y_min:y_max, x_min:x_max] = self._template_match(img_roi, pattern.gray)
+        return res
 
     def _get_correct_pattern(self, arg):
         """
-        img_rotとdir_pathとtemplate_nameからできるパターン画像のテンプレートマッチングの計数結果とファイル名を返す
+        グレースケールの回転画像とパターン画像のテンプレートマッチングの計数結果、パターン画像、マッチング結果を返す
         並列処理により4回処理される
 
         Args:
-            arg ([(img_bgr, string, string),]): 回転画像、ファイルパス、ファイル名
+            arg ((img_gray, Pattern)): グレースケールの回転画像、パターン画像
+
+        Returns:
+            int, Pattern, img_th: カウント数(1つのパターン画像にいくつも矩形が表示されるので実際の製品数ではない)、パターン画像、
+                                  マッチング結果画像
+        """
+        img_rot_gray, pattern = arg
+        self._check_cancel()
+        result = self._template_match_cancellable(img_rot_gray, pattern.gray)
+        match_count = np.count_nonzero(result >= self.threshold)
+        return match_count, pattern, result
+
+    def _get_fft_pattern(self, arg):
+        """
+        _get_correct_patternのFFTCorrelator版。並列処理により4回処理される
+
+        Args:
+            arg ((FFTCorrelator, Pattern)): 回転画像のFFTCorrelator、パターン画像
 
         Returns:
-            int, string: カウント数(1つのパターン画像にいくつも矩形が表示されるので実際の製品数ではない)、各パターン画像のファイル名
+            int, Pattern, img_th: 閾値以上の点の数、パターン画像、マッチング結果画像
         """
-        img_rot, dir_path, template_name = arg
-        file_name = dir_path + template_name
-        img_rot_gray = cv2.cvtColor(img_rot, cv2.COLOR_BGR2GRAY)
-        template_gray = cv2.imread(file_name, 0)
-        result = cv2.matchTemplate(img_rot_gray, template_gray, cv2.TM_CCOEFF_NORMED)
-        match_count = np.where(result >= self.threshold)[0].size
-        return match_count, file_name
+        correlator, pattern = arg
+        self._check_cancel()
+        result = correlator.match(pattern, self._check_cancel)
+        match_count = np.count_nonzero(result >= self.threshold)
+        return match_count, pattern, result
+
+    def _template_match_cancellable(self, img_rot_gray, pattern_gray):
+        """
+        _template_matchと同じマッチング結果を、should_cancelがある場合は結果画像のcancel_check_rows行ずつ求め、
+        その間に中止を確認する(原寸のマッチングは1回が長く、4枚を並列に行うのでパターン画像ごとの確認では遅い)
+        """
+        if self._should_cancel is None:
+            return self._template_match(img_rot_gray, pattern_gray)
+        res_h = img_rot_gray.shape[0] - pattern_gray.shape[0] + 1
+        bands = []
+        for y_min in range(0, res_h, cancel_check_rows):
+            self._check_cancel()
+            y_max = min(y_min + cancel_check_rows, res_h)
+            bands.append(self._template_match(img_rot_gray[y_min:y_max + pattern_gray.shape[0] - 1], pattern_gray))
+        return np.vstack(bands)
 
     @staticmethod
-    def _template_match(img_rot, pattern):
+    def _template_match(img_rot_gray, pattern_gray):
         """
-        BGR画像2枚を使ってテンプレートマッチング
+        グレースケール画像2枚を使ってテンプレートマッチング
 
         Args:
-            img_rot (img_bgr): 全体画像
-            pattern (img_bgr): パターン画像
+            img_rot_gray (img_gray): 全体画像
+            pattern_gray (img_gray): パターン画像
 
         Returns:
             img_th: マッチング結果画像
         """
-        img_rot_gray = cv2.cvtColor(img_rot, cv2.COLOR_BGR2GRAY)
-        pattern_gray = cv2.cvtColor(pattern, cv2.COLOR_BGR2GRAY)
         return cv2.matchTemplate(img_rot_gray, pattern_gray, cv2.TM_CCOEFF_NORMED)
 
     @staticmethod
@@ -121,12 +410,69 @@ class PatternImage:
         Returns:
             img_th: マッチング範囲を白い矩形に変えた黒画像
         """
-        loc = np.where(res >= self.threshold)
-        for pt in zip(*loc[::-1]):
+        for x, y in self._get_peaks(res, w, h):
+            pt = (int(x), int(y))
             cv2.rectangle(black, pt, (pt[0] + w, pt[1] + h), 255, -1)
             black = self._add_gap(black, pt, (pt[0] + w, pt[1] + h))
         return black
 
+    def _get_peaks(self, res, w, h):
+        """
+        resの閾値以上の点から、製品1つにつき1点だけ残す(Non-Maximum Suppression)
+        閾値以上の点のまとまりごとにスコアが最大の点を候補とし、スコアの高い順に近すぎる候補を除いていく
+
+        Args:
+            res (img_th): cv2.matchTemplateの出力結果
+            w (int): パターン画像の幅
+            h (int): パターン画像の高さ
+
+        Returns:
+            np.ndarray: 製品の左上座標(x, y)の配列、スコアの高い順
+        """
+        gap_x = max(int(w * nms_ratio), 1)
+        gap_y = max(int(h * nms_ratio), 1)
+        mask = (res >= self.threshold).astype(np.uint8)
+        label_num, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if label_num <= 1:
+            return np.empty((0, 2), np.int64)
+
+        # まとまりごとのスコア最大の点
+        points = cv2.findNonZero(mask)[:, 0]  # np.nonzeroより速い
+        xs, ys = points[:, 0], points[:, 1]
+        label = labels[ys, xs]
+        order = np.lexsort((-res[ys, xs], label))
+        _, first = np.unique(label[order], return_index=True)
+        xs, ys = xs[order[first]], ys[order[first]]
+
+        # 隣の製品とつながってしまった大きいまとまりは、その範囲内の局所最大値をすべて候補にする
+        large = np.nonzero((stats[1:, cv2.CC_STAT_WIDTH] > gap_x) | (stats[1:, cv2.CC_STAT_HEIGHT] > gap_y))[0] + 1
+        if len(large) != 0:
+            kernel = np.ones((2 * gap_y + 1, 2 * gap_x + 1), np.uint8)
+            extra_xs, extra_ys = [xs], [ys]
+            for i in large:
+                x, y, bw, bh = stats[i, :4]
+                roi = res[y:y + bh, x:x + bw]
+                local_max = cv2.dilate(roi, kernel)
+                roi_ys, roi_xs = np.nonzero((labels[y:y + bh, x:x + bw] == i) & (roi >= local_max))
+                extra_xs.append(roi_xs + x)
+                extra_ys.append(roi_ys + y)
+            xs, ys = np.concatenate(extra_xs), np.concatenate(extra_ys)
+
+        order = np.argsort(-res[ys, xs], kind="stable")
+        xs, ys = xs[order], ys[order]
+        # 残した候補をgap_x×gap_yのマスに分けて持ち、周りの9マスの候補とだけ距離を比べる(候補の数の2乗にならない)
+        cells = {}
+        keep = np.zeros(len(xs), bool)
+        for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+            cell_x, cell_y = x // gap_x, y // gap_y
+            if any(abs(x - kept_x) < gap_x and abs(y - kept_y) < gap_y
+                   for near_x in (cell_x - 1, cell_x, cell_x + 1) for near_y in (cell_y - 1, cell_y, cell_y + 1)
+                   for kept_x, kept_y in cells.get((near_x, near_y), ())):
+                continue
+            cells.setdefault((cell_x, cell_y), []).append((x, y))
+            keep[i] = True
+        return np.stack([xs[keep], ys[keep]], axis=1)
+
     def _trim(self, img_th):
         """
         白矩形付き黒画像から白矩形全体を囲うような範囲を取得し、そこから前後左右200pxずつ広げた点を取得する
@@ -0,0 +1,103 @@
+"""
+製品ごとのパターン画像(pattern1.jpg~pattern4.jpg)をメモリ上に保持する
+"""
+import os
+import threading
+
+import cv2
+import numpy as np
+
+
+pattern_names = ["pattern1.jpg", "pattern2.jpg", "pattern3.jpg", "pattern4.jpg"]  # 90°ずつ回転した4枚で1セット
+
+
+class Pattern:
+    def __init__(self, file_name, img):
+        """
+        パターン画像1枚分と、マッチングで使う統計値
+
+        Args:
+            file_name (str): パターン画像のファイルパス
+            img (img_bgr): パターン画像
+        """
+        self.file_name = file_name
+        self.img = img
+        self.gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        self.h, self.w = self.gray.shape[:2]
+        mean, std = cv2.meanStdDev(self.gray)
+        self.mean = float(mean[0, 0])  # 輝度の平均
+        self.std = float(std[0, 0])  # 輝度の標準偏差
+        self.norm = self.std * np.sqrt(self.w * self.h)  # 平均を引いたパターンのノルム
+        self._pyramid = {0: self.gray}  # {縮小回数: 縮小したグレースケール画像}
+
+    def get_pyramid_gray(self, level):
+        """
+        cv2.pyrDownでlevel回縮小したグレースケールのパターン画像を返す
+
+        Args:
+            level (int): 縮小回数
+
+        Returns:
+            img_gray: 縮小したパターン画像
+        """
+        if level not in self._pyramid:
+            self._pyramid[level] = cv2.pyrDown(self.get_pyramid_gray(level - 1))
+        return self._pyramid[level]
+
+
+class PatternStore:
+    def __init__(self):
+        """
+        パターン画像のディレクトリ名をキーとして、読み込み・グレースケール化したパターン画像を保持するクラス
+        パターン画像が書き換えられたらinvalidateで破棄する。ファイルの更新日時が変わっていた場合も読み込みなおす
+        """
+        self._patterns = {}  # {dir_name: (更新日時のリスト, Patternのリスト)}
+        self._lock = threading.Lock()
+
+    def get(self, dir_name):
+        """
+        パターン画像4枚を返す。保持していない場合は読み込む
+
+        Args:
+            dir_name (str): パターン画像を保存しているディレクトリ(末尾に/を含む)
+
+        Returns:
+            list[Pattern]: pattern1.jpg~pattern4.jpgの順
+        """
+        file_names = [dir_name + name for name in pattern_names]
+        mtimes = [self._get_mtime(file_name) for file_name in file_names]
+        with self._lock:
+            cached = self._patterns.get(dir_name)
+            if cached is not None and cached[0] == mtimes:
+                return cached[1]
+        patterns = [Pattern(file_name, self._imread(file_name)) for file_name in file_names]
+        with self._lock:
+            self._patterns[dir_name] = (mtimes, patterns)
+        return patterns
+
+    def invalidate(self, dir_name=None):
+        """
+        保持しているパターン画像を破棄する
+
+        Args:
+            dir_name (str or None): 破棄するディレクトリ。Noneのときすべて破棄
+        """
+        with self._lock:
+            if dir_name is None:
+                self._patterns.clear()
+            else:
+                self._patterns.pop(dir_name, None)
+
+    @staticmethod
+    def _get_mtime(file_name):
+        """ファイルの更新日時。ファイルが無い場合はNone"""
+        try:
+            return os.stat(file_name).st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _imread(file_name):
+        """ファイル名に日本語が含まれている場合を考慮して、デコードして画像を読み込む"""
+        n = np.fromfile(file_name, dtype=np.uint8)
+        return cv2.imdecode(n, cv2.IMREAD_COLOR)
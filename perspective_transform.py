@@ -1,6 +1,15 @@
+import hashlib
+import math
+import os
+
 import numpy as np
 import cv2
 
+from stage_timer import stage_timer
+
+
+remap_cache_dir = "./count/cache/"  # 事前計算したremapの表を保存するディレクトリ
+
 
 class PerspectiveTransformer:
     def __init__(self, cam_width, cam_height, points, box_width=4, box_height=3, dx=320):
@@ -48,10 +57,105 @@ class PerspectiveTransformer:
         # 変換後の画像サイズ
         self.width, self.height = PerspectiveTransformer._transformed_image_size(corners_transformed)
 
+        self._cam_size = (cam_width, cam_height)
+        self._cache_key = PerspectiveTransformer._key(points, cam_width, cam_height, box_width, box_height, dx)
+        self._maps = None  # enable_remapで作成する(map1, map2)
+
+    def enable_remap(self, cache_dir=remap_cache_dir):
+        """
+        transformで使う、変換後の各画素がカメラ画像のどこから来るかの表(cv2.remap用、固定小数点のCV_16SC2)を用意する
+        カメラの位置と画像サイズは変わらないので、一度計算した表はcache_dirに保存し、次回の起動時は読み込むだけにする
+        :param cache_dir: 表を保存するディレクトリ。Noneのときは保存せずに毎回計算する
+        :return: True: 保存した表を読み込んだ False: 計算した
+        """
+        path = None if cache_dir is None else os.path.join(cache_dir, "perspective_{}.npz".format(self._cache_key))
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    self._maps = (data["map1"], data["map2"])
+                return True
+            except (OSError, KeyError, ValueError):  # 壊れている場合は計算し直す
+                pass
+        self._maps = self._compute_maps()
+        if path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_path = path + ".tmp.npz"
+                np.savez(temp_path, map1=self._maps[0], map2=self._maps[1])
+                os.replace(temp_path, path)  # 書き込み途中のファイルを読み込まないように、書き終わってから置き換える
+            except OSError:
+                pass
+        return False
+
+    @stage_timer.timed("perspective_transform")
     def transform(self, img, border_value=(0, 0, 0)):
-        """射影変換。変換後、画像が切れないように平行移動も合成ずみ。"""
+        """射影変換。変換後、画像が切れないように平行移動も合成ずみ。enable_remapの後は事前計算した表を使う。"""
+        if self._maps is not None:
+            return cv2.remap(img, self._maps[0], self._maps[1], cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
         return cv2.warpPerspective(img, self._matrix, (self.width, self.height), borderValue=border_value)
 
+    @stage_timer.timed("perspective_rotation")
+    def transform_rotated(self, img, deg, dst=None, border_value=(0, 0, 0)):
+        """
+        射影変換と、その結果をPIL.Image.rotate(deg, expand=True)で回転する処理を1回のwarpPerspectiveで行う
+        補間が1回になるので、2回に分けた場合より速く、ぼやけも少ない
+        :param img: カメラ画像
+        :param deg: 反時計回りの回転角[°]
+        :param dst: 書き込み先の配列。Noneもしくはサイズが合わない(書き換え不可の)場合は新しく確保する
+        :param border_value: 画像の外側の色
+        :return: 射影変換・回転後の画像
+        """
+        matrix, size = self._rotated_matrix(deg)
+        if dst is not None and (dst.shape != (size[1], size[0]) + img.shape[2:] or not dst.flags.writeable):
+            dst = None
+        return cv2.warpPerspective(img, matrix, size, dst=dst, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                   borderValue=border_value)
+
+    def _rotated_matrix(self, deg):
+        """
+        回転後の画像の座標からカメラ画像の座標への射影変換行列と、回転後の画像サイズ
+        回転の行列・サイズはPIL.Image.rotate(expand=True)と同じ計算をする
+        """
+        w, h = self.width, self.height
+        rad = -math.radians(deg % 360.0)
+        a, b = round(math.cos(rad), 15), round(math.sin(rad), 15)
+        d, e = round(-math.sin(rad), 15), round(math.cos(rad), 15)
+        c = a * (-w / 2) + b * (-h / 2) + w / 2
+        f = d * (-w / 2) + e * (-h / 2) + h / 2
+        xs = [a * x + b * y + c for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+        ys = [d * x + e * y + f for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+        new_w = math.ceil(max(xs)) - math.floor(min(xs))
+        new_h = math.ceil(max(ys)) - math.floor(min(ys))
+        shift_x, shift_y = -(new_w - w) / 2, -(new_h - h) / 2  # 拡大した分だけ中心をずらす
+        c, f = a * shift_x + b * shift_y + c, d * shift_x + e * shift_y + f
+        # PILは画素の左上を、OpenCVは画素の中心を整数座標とするので0.5ずらす
+        rotation = np.array([[1, 0, -0.5], [0, 1, -0.5], [0, 0, 1]]) @ np.array([[a, b, c], [d, e, f], [0, 0, 1]]) \
+            @ np.array([[1, 0, 0.5], [0, 1, 0.5], [0, 0, 1]])
+        # 回転後の座標 -> 射影変換後の座標 -> カメラ画像の座標
+        return np.linalg.inv(self._matrix) @ rotation, (new_w, new_h)
+
+    def inverse_transform(self, img, cam_width, cam_height, border_value=(0, 0, 0)):
+        """射影変換後の画像を、カメラで撮影した画像の見え方に戻す。合成画像の作成用。"""
+        return cv2.warpPerspective(img, self._matrix, (cam_width, cam_height),
+                                   flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderValue=border_value)
+
+    def _compute_maps(self):
+        """変換後の各画素に対応するカメラ画像の座標を計算し、cv2.remap用の固定小数点の表にする"""
+        inverse = np.linalg.inv(self._matrix)
+        xs, ys = np.meshgrid(np.arange(self.width, dtype=np.float64), np.arange(self.height, dtype=np.float64))
+        w = inverse[2, 0] * xs + inverse[2, 1] * ys + inverse[2, 2]
+        map_x = ((inverse[0, 0] * xs + inverse[0, 1] * ys + inverse[0, 2]) / w).astype(np.float32)
+        map_y = ((inverse[1, 0] * xs + inverse[1, 1] * ys + inverse[1, 2]) / w).astype(np.float32)
+        return cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+    @staticmethod
+    def _key(points, cam_width, cam_height, box_width, box_height, dx):
+        """変換を決める値(頂点の座標・画像サイズなど)から、保存する表のファイル名に使うハッシュ値を作る"""
+        h = hashlib.sha1(np.float32(points).tobytes())
+        h.update(repr((cam_width, cam_height, box_width, box_height, dx)).encode())
+        return h.hexdigest()[:16]
+
     @staticmethod
     def _dy(cam_width, cam_height, box_aspect_ratio, dx):
         dy = (dx / box_aspect_ratio) + (cam_height - cam_width / box_aspect_ratio) / 2
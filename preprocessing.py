@@ -1,55 +1,106 @@
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 import math
+import time
 
 import cv2
 import numpy as np
 from PIL import Image
 
 from perspective_transform import PerspectiveTransformer
+from stage_timer import stage_timer
 
 
 pers_num_path = "pers_num.npy"
 pts = np.load(pers_num_path)[0]
+perspective_remap = True  # Canny画像の射影変換に、事前計算してディスクに保存したcv2.remapの表を使う
+# 回転角を求める処理(エッジ検出・射影変換・直線検出など)を行う画像の縮小率。1のとき元の解像度
+# HoughLinesPの閾値・最小直線距離・最大間隔もこの割合で小さくする。射影変換・回転は元の解像度の画像に行う
+deskew_analysis_scale = 1.0
+
+# 回転角の求め方 hough: HoughLinesPの閾値を下げながら直線を探し、候補の角度ごとに回転して確かめる
+#                profile: エッジ画素を各角度に投影したヒストグラムが最も鋭くなる角度を1回で求める
+deskew_modes = ["hough", "profile"]
+profile_coarse_step = 0.5  # profileで-45~45°を粗く探すときの角度の間隔[°]
+profile_fine_step = 0.05  # 粗く求めた角度の前後を細かく探すときの角度の間隔[°]
+profile_coarse_points = 20000  # 粗く探すときに使うエッジ画素の最大数(間引く)
+# 回転角のキャッシュ: 前回の回転角で回転した画像から検出した直線のうち、水平からdeg_cache_tolerance[°]以内の直線が
+#                    長さの合計でdeg_cache_min_ratio以上を占めれば、前回の回転角をそのまま使う
+#                    (トレーの外形など、製品の並びと平行でない直線も検出されるので、すべてが水平であることは求めない)
+deg_cache_tolerance = 0.5
+deg_cache_min_ratio = 0.8
+# 前回の回転角を確かめる直線検出は、元の解像度に対してこの縮小率の画像で行う(確かめるだけなので粗くてよい)
+deg_cache_check_scale = 0.25
+deg_cache_max_misses = 3  # 続けてこの回数確かめて使えなかったキーは、しばらく確かめずに探索する
+deg_cache_retry_searches = 3  # 確かめるのをやめてからこの回数探索したら、新しい回転角でまた確かめる
 
 
 class Preprocess:
-    def __init__(self, width, height):
+    def __init__(self, width, height, analysis_scale=None):
         """
         画像を射影変換、画像内の製品が水平になるように回転するクラス
 
         Args:
             width (int): オリジナル画像の幅
             height (int): オリジナル画像の高さ
+            analysis_scale (float or None): 回転角を求める画像の縮小率(0~1)。Noneのときdeskew_analysis_scale
         """
+        self.analysis_scale = deskew_analysis_scale if analysis_scale is None else analysis_scale
+        if not 0 < self.analysis_scale <= 1:
+            raise ValueError("analysis_scale must be in (0, 1]: {}".format(self.analysis_scale))
         self.perspective = PerspectiveTransformer(width, height, pts)
+        if self.analysis_scale == 1:
+            self._analysis_size = None
+            self.analysis_perspective = self.perspective
+        else:
+            # 縮小画像用の射影変換。頂点の座標・余白を縮小率に合わせると、元の解像度の射影変換を縮小したものになる
+            analysis_width = max(1, round(width * self.analysis_scale))
+            analysis_height = max(1, round(height * self.analysis_scale))
+            self._analysis_size = (analysis_width, analysis_height)
+            analysis_pts = pts * np.float32([analysis_width / width, analysis_height / height])
+            self.analysis_perspective = PerspectiveTransformer(analysis_width, analysis_height, analysis_pts,
+                                                               dx=320 * self.analysis_scale)
+        if perspective_remap:
+            self.analysis_perspective.enable_remap()
         self.kernel = np.ones((3, 3), np.uint8)
-        self.max_gap = 30
-
-    def preprocessing(self, img, first_min_length, first_threshold):
+        self.max_gap = max(1, round(30 * self.analysis_scale))
+        self.hough_step = max(1, round(50 * self.analysis_scale))  # 直線が検出できないときに閾値・最小直線距離を下げる幅
+        self._out = None  # reuse_outputのときに使い回す、射影変換・回転後の画像
+        # houghで求めた回転角のキャッシュ {キー(製品名など): {deg, min_length, threshold, search_seconds, misses, skipped}}
+        # search_secondsは回転角を探すのにかかった時間。キャッシュで省けた時間の見積もりに使う
+        # missesは続けて確かめて使えなかった回数、skippedはmissesがdeg_cache_max_missesに達してから確かめずに探索した回数
+        self.deg_cache = {}
+        self.deg_cache_stats = {"hit_num": 0, "miss_num": 0, "saved_seconds": 0.0}
+
+    def preprocessing(self, img, first_min_length, first_threshold, cancel_event=None, deskew_mode="hough",
+                      reuse_output=False, cache_key=None):
         """
         画像を射影変換、画像内の製品が水平になるように回転する
         Args:
             img (img_bgr): オリジナル画像
-            first_min_length (int): 二値化画像から直線をハフ検出するときの初めの最小直線距離
-            first_threshold (int): 二値化画像から直線をハフ検出するときの初めの閾値
+            first_min_length (int): 二値化画像から直線をハフ検出するときの初めの最小直線距離(元の解像度での値)
+            first_threshold (int): 二値化画像から直線をハフ検出するときの初めの閾値(元の解像度での値)
+            cancel_event (threading.Event or None): setされた場合は回転を行わずにオリジナル画像を返す
+            deskew_mode (str): 回転角の求め方 "hough" or "profile"
+            reuse_output (bool): Trueのとき前回返した画像の配列に上書きする。前回の画像を使い終わっている場合だけ指定する
+            cache_key (str or None): 指定した場合、同じキーで前回求めた回転角を1回の直線検出で確かめ、
+                                     正しければ回転角の探索を省く(houghのときだけ)
 
         Returns:
             img_bgr: 射影変換・回転後の画像
         """
         img_canny = self._image_pre_process(img)
         try:
-            # 直線を検出、そのときの閾値・最小直線距離を取得
-            lines, min_length, threshold = self._detect_line(img_canny, first_min_length, first_threshold)
-            if lines is None:
+            result_deg = self._estimate_deg(img_canny, first_min_length, first_threshold, deskew_mode, cache_key)
+            if result_deg is None:  # 直線が検出できなかった場合
                 img_trans_rot = img
                 return img_trans_rot
-                # print("break")
-                # exit()
-            deg_list = self._list_of_degree(lines)
-
-            result_deg = self._get_result_deg(deg_list, img_canny, min_length, threshold)
-            img_trans = self.perspective.transform(img)
-            img_trans_rot = self._rotation(img_trans, result_deg)
+            if cancel_event is not None and cancel_event.is_set():  # 中止された場合は回転しない
+                img_trans_rot = img
+                return img_trans_rot
+            # 射影変換と回転を1回の変換で行う
+            img_trans_rot = self.perspective.transform_rotated(img, result_deg, self._out if reuse_output else None)
+            if reuse_output:
+                self._out = img_trans_rot
             # return img_trans_rot
 
         except Exception as err:
@@ -69,9 +120,139 @@ class Preprocess:
             result = img_trans_rot
         return result
 
+    def get_deg(self, img, first_min_length, first_threshold, deskew_mode="hough", cache_key=None):
+        """
+        射影変換後の画像を水平にするための回転角を求める(回転はしない)
+
+        Args:
+            img (img_bgr): オリジナル画像
+            first_min_length (int): 二値化画像から直線をハフ検出するときの初めの最小直線距離(元の解像度での値)
+            first_threshold (int): 二値化画像から直線をハフ検出するときの初めの閾値(元の解像度での値)
+            deskew_mode (str): 回転角の求め方 "hough" or "profile"
+            cache_key (str or None): 前回求めた回転角のキャッシュのキー(preprocessingと同じ)
+
+        Returns:
+            float or None: 回転角[°]。直線が検出できなかった場合はNone
+        """
+        return self._estimate_deg(self._image_pre_process(img), first_min_length, first_threshold, deskew_mode,
+                                  cache_key)
+
+    def get_horizontal_ratio(self, img, deg, min_length, threshold, check_scale=deg_cache_check_scale):
+        """
+        回転角のキャッシュを確かめるときと同じ方法で、degで回転したときに水平に近い直線の長さの割合を求める
+
+        Args:
+            img (img_bgr): オリジナル画像
+            deg (float): 回転角[°]
+            min_length (int): 直線の最小直線距離(元の解像度での値)
+            threshold (int): 直線検出の閾値(元の解像度での値)
+            check_scale (float): 直線検出を行う画像の縮小率(元の解像度に対する割合)
+
+        Returns:
+            float or None: 0~1。直線が検出できなかった場合はNone
+        """
+        return self._horizontal_ratio_at(self._image_pre_process(img), deg,
+                                         max(1, round(min_length * self.analysis_scale)),
+                                         max(1, round(threshold * self.analysis_scale)), check_scale)
+
+    def get_deg_cache_stats(self):
+        """
+        回転角のキャッシュの使用状況
+
+        Returns:
+            dict: hit_num(確かめて使えた回数), miss_num(探索した回数), hit_rate(hit_numとmiss_numが0のときNone),
+                  saved_seconds(省けた時間の見積もり[s]。使えたときの探索にかかった時間 - 確かめるのにかかった時間の合計)
+        """
+        stats = dict(self.deg_cache_stats)
+        total = stats["hit_num"] + stats["miss_num"]
+        stats["hit_rate"] = stats["hit_num"] / total if total else None
+        return stats
+
+    def _estimate_deg(self, img_canny, first_min_length, first_threshold, deskew_mode, cache_key=None):
+        """エッジ画像からdeskew_modeの方法で回転角を求める。直線が検出できなかった場合はNone"""
+        if deskew_mode not in deskew_modes:
+            raise ValueError("deskew_mode must be one of {}: {}".format(deskew_modes, deskew_mode))
+        if deskew_mode == "profile":  # 1回で求まるので、キャッシュは使わない
+            return self._get_profile_deg(img_canny)
+        # 閾値・最小直線距離は元の解像度での値なので、縮小率に合わせる
+        first_min_length = max(1, round(first_min_length * self.analysis_scale))
+        first_threshold = max(1, round(first_threshold * self.analysis_scale))
+        if cache_key is not None:
+            result_deg = self._check_cached_deg(img_canny, cache_key)
+            if result_deg is not None:
+                return result_deg
+        start = time.perf_counter()
+        # 直線を検出、そのときの閾値・最小直線距離を取得
+        lines, min_length, threshold = self._detect_line(img_canny, first_min_length, first_threshold)
+        if lines is None:
+            return None
+        deg_list = self._list_of_degree(lines)
+        result_deg = self._get_result_deg(deg_list, img_canny, min_length, threshold)
+        if cache_key is not None:
+            prev_cache = self.deg_cache.get(cache_key, {"misses": 0, "skipped": 0})
+            self.deg_cache[cache_key] = {"deg": result_deg, "min_length": min_length, "threshold": threshold,
+                                         "search_seconds": time.perf_counter() - start,
+                                         "misses": prev_cache["misses"], "skipped": prev_cache["skipped"]}
+        return result_deg
+
+    @stage_timer.timed("check_cached_deg")
+    def _check_cached_deg(self, img_canny, cache_key):
+        """
+        cache_keyで前回求めた回転角で回転し、その回転角を求めたときの閾値・最小直線距離で1回だけ直線を検出する
+        検出した直線がほぼ水平であれば前回の回転角を返し、そうでなければ(キャッシュが無い場合、
+        続けてdeg_cache_max_misses回使えなかった後のdeg_cache_retry_searches回の探索の間も)Noneを返す
+        シートごとの使えたかどうか(deg_cache_hit)と省けた時間の見積もり(deg_cache_saved[s])をstage_timerに記録する
+        """
+        cache = self.deg_cache.get(cache_key)
+        if cache is None:
+            self._record_deg_cache(False, 0.0)
+            return None
+        if cache["misses"] >= deg_cache_max_misses:
+            if cache["skipped"] < deg_cache_retry_searches:
+                cache["skipped"] += 1
+                self._record_deg_cache(False, 0.0)
+                return None
+            # 確かめずに探索した回数がdeg_cache_retry_searchesになったので、探索し直した回転角でまた確かめる
+            cache["misses"] = 0
+            cache["skipped"] = 0
+        start = time.perf_counter()
+        ratio = self._horizontal_ratio_at(img_canny, cache["deg"], cache["min_length"], cache["threshold"])
+        elapsed = time.perf_counter() - start
+        if ratio is None or ratio < deg_cache_min_ratio:
+            cache["misses"] += 1
+            self._record_deg_cache(False, -elapsed)  # 確かめた分だけ余計にかかった
+            return None
+        cache["misses"] = 0
+        self._record_deg_cache(True, cache["search_seconds"] - elapsed)
+        return cache["deg"]
+
+    def _horizontal_ratio_at(self, img_canny, deg, min_length, threshold, check_scale=deg_cache_check_scale):
+        """
+        エッジ画像をdegで回転し、1回だけ検出した直線のうち水平に近い直線の長さの割合を求める
+        直線検出はcheck_scale(元の解像度に対する縮小率)まで縮小した画像で行う。直線が無い場合はNone
+        min_length, thresholdはanalysis_scaleでの値
+        """
+        check_scale = min(1.0, check_scale / self.analysis_scale)
+        img_check = img_canny
+        if check_scale < 1:
+            img_check = cv2.resize(img_canny, None, fx=check_scale, fy=check_scale, interpolation=cv2.INTER_AREA)
+        img_check_rot = self._rotation(img_check, deg)
+        lines = cv2.HoughLinesP(img_check_rot, 1, np.pi / 720, threshold=max(1, round(threshold * check_scale)),
+                                minLineLength=max(1, round(min_length * check_scale)),
+                                maxLineGap=max(1, round(self.max_gap * check_scale)))
+        return None if lines is None else self._horizontal_ratio(lines)
+
+    def _record_deg_cache(self, hit, saved_seconds):
+        """回転角のキャッシュを使えたかどうかと省けた時間の見積もり[s]を、合計とstage_timerのシートごとの値に記録する"""
+        self.deg_cache_stats["hit_num" if hit else "miss_num"] += 1
+        self.deg_cache_stats["saved_seconds"] += saved_seconds
+        stage_timer.set_value("deg_cache_hit", int(hit))
+        stage_timer.set_value("deg_cache_saved", round(saved_seconds, 4))
+
+    @stage_timer.timed("image_pre_process")
     def _image_pre_process(self, image):
         """
-        直線検出前の事前処理
+        直線検出前の事前処理。analysis_scaleが1未満のときは縮小した画像で行う
         Args:
             image (img_bgr): オリジナル画像
 
@@ -80,8 +261,10 @@ class Preprocess:
         """
         # 画像を2値化してエッジ検出する
         img_gray = self._gray_scale(image)
+        if self._analysis_size is not None:
+            img_gray = cv2.resize(img_gray, self._analysis_size, interpolation=cv2.INTER_AREA)
         img_canny = self._canny_edge_detect(img_gray)  # エッジ検出
-        img_pers = self.perspective.transform(img_canny)  # 射影変換
+        img_pers = self.analysis_perspective.transform(img_canny)  # 射影変換
         img_close = self._morphology_close(img_pers)
         # エッジの穴の部分を埋めるための輪郭検出
         img_close = self._draw_contours(img_close)
@@ -91,6 +274,7 @@ class Preprocess:
         # 余白のエッジを抽出
         return self._canny_edge_detect(img_canny_inv)
 
+    @stage_timer.timed("detect_line")
     def _detect_line(self, img_th, _min_length, _threshold):
         """
         二値化画像から直線を検出
@@ -113,9 +297,9 @@ class Preprocess:
                 if lines is not None:
                     return lines, min_length, threshold
                 else:
-                    threshold -= 50
+                    threshold -= self.hough_step
             if lines is None:
-                min_length -= 50
+                min_length -= self.hough_step
         return None, min_length, threshold
 
     def _list_of_degree(self, lines):
@@ -132,6 +316,7 @@ class Preprocess:
                 deg_list_2.append(deg)
         return deg_list
 
+    @stage_timer.timed("get_result_deg")
     def _get_result_deg(self, deg_list, img_canny, min_length, threshold):
         """角度のリストから条件に合う角度を取得"""
         result_deg = None
@@ -151,7 +336,60 @@ class Preprocess:
             result_deg = self._get_median(deg_list)
         return result_deg
 
+    def _horizontal_ratio(self, lines):
+        """検出した直線の長さの合計のうち、水平からdeg_cache_toleranceの範囲に収まる直線の長さの割合"""
+        lengths = []
+        horizontal = []
+        for line in lines:
+            x1, y1, x2, y2 = line[0]
+            lengths.append(math.hypot(int(x2) - int(x1), int(y2) - int(y1)))
+            horizontal.append(abs(self._degree(x1, y1, x2, y2)) <= deg_cache_tolerance)
+        lengths = np.array(lengths)
+        return float(lengths[np.array(horizontal)].sum() / lengths.sum()) if lengths.sum() > 0 else 0.0
+
+    @stage_timer.timed("get_profile_deg")
+    def _get_profile_deg(self, img_canny):
+        """
+        エッジ画素を角度degの直線とその垂線の方向に投影し、ヒストグラムが最も鋭くなる(二乗和が最大になる)角度を求める
+        製品の輪郭の直線が揃う角度でヒストグラムが尖るので、HoughLinesPを繰り返さずに1回で求まる
+        角度の向きは_degreeと同じで、-45~45°の範囲
+        """
+        ys, xs = np.nonzero(img_canny)
+        if len(xs) == 0:
+            return None
+        xs = xs.astype(np.float32)
+        ys = ys.astype(np.float32)
+        step = max(1, len(xs) // profile_coarse_points)
+        coarse_degs = np.arange(-45, 45, profile_coarse_step)
+        deg = self._best_profile_deg(xs[::step], ys[::step], coarse_degs)
+        fine_degs = np.arange(deg - profile_coarse_step, deg + profile_coarse_step + profile_fine_step / 2,
+                              profile_fine_step)
+        deg = self._best_profile_deg(xs, ys, fine_degs)
+        # _degreeと同じく-45~45°に収める
+        if deg < -45:
+            deg += 90
+        if deg > 45:
+            deg -= 90
+        return float(deg)
+
+    @staticmethod
+    def _best_profile_deg(xs, ys, degs):
+        """degsのうち、投影したヒストグラムの二乗和が最大になる角度"""
+        offset = float(np.hypot(xs.max(), ys.max()))  # 投影した座標が負にならないようにずらす
+        scores = []
+        for deg in degs:
+            rad = math.radians(deg)
+            cos, sin = math.cos(rad), math.sin(rad)
+            score = 0.0
+            # 角度degの直線上の画素は ys*cos - xs*sin が、その垂線上の画素は xs*cos + ys*sin が一定になる
+            for projected in (ys * cos - xs * sin, xs * cos + ys * sin):
+                hist = np.bincount((projected + offset).astype(np.int32))
+                score += float(np.dot(hist, hist))
+            scores.append(score)
+        return float(degs[int(np.argmax(scores))])
+
     @staticmethod
+    @stage_timer.timed("rotation")
     def _rotation(img, deg):
         """画像の回転"""
         img_pil = Image.fromarray(img)
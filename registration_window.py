@@ -1,4 +1,3 @@
-import pickle
 import tkinter as tk
 import tkinter.font as font
 import tkinter.ttk as ttk
@@ -10,7 +9,9 @@ from PIL import Image, ImageTk
 from control import Control
 from setting_count import create_setting_file
 from db_manage import DatabaseManage
+from display_pipeline import PreviewRenderer
 from error_window_create import ErrorMessage
+from frame_buffer import ScratchBuffer, share
 from translate_word import translate_word
 
 
@@ -32,6 +33,8 @@ class Registration(tk.Frame):
         self.frame = None
         self.frame2 = None
         self.frame_pattern = None
+        self.drag_buffer = ScratchBuffer()  # ドラッグ中に矩形を描く画像のバッファ
+        self.preview = PreviewRenderer(flip=-1)  # 映像の表示用
         self.pattern = None
         self.pattern_back = None
         self.x_down = None
@@ -244,13 +247,14 @@ class Registration(tk.Frame):
         try:
             if self.cam_flag is True:
                 # first_width, first_height, magnifを渡して画像をリサイズしたもの(pickle_copy)を返す
-                pickle_copy, self.frame = self.cap.get_frame_for_tk(self.first_width, self.first_height, 1)
-                # カメラの映像の関係上、上下左右反転
-                pickle_copy = cv2.flip(pickle_copy, -1)
-                pickle_copy = cv2.cvtColor(pickle_copy, cv2.COLOR_BGR2RGB)
-                self.photo = ImageTk.PhotoImage(image=Image.fromarray(pickle_copy))
-                self.video_img.imgtk = self.photo
-                self.video_img.configure(image=self.photo)
+                pickle_copy, frame = self.cap.get_frame_for_tk(self.first_width, self.first_height, 1)
+                # 新しいフレームが届いていない場合は前の映像のままにする
+                if frame is not None:
+                    self.frame = frame
+                    # カメラの映像の関係上、上下左右反転。PhotoImageは使い回す
+                    self.photo = self.preview.render(pickle_copy)
+                    self.video_img.imgtk = self.photo
+                    self.video_img.configure(image=self.photo)
                 # delayミリ秒後に関数を繰り返す
                 self._camera_loop_id = self.after(self.delay, self.update_cam)
         except TypeError:
@@ -278,8 +282,8 @@ class Registration(tk.Frame):
 
             self.cam_flag = False
             self.dialog = True
-            # 前処理をした画像を表示
-            self.frame = self.control.file_open(self.master, 1)
+            # 前処理をした画像を表示。回転角は登録する製品のカウントと同じ求め方で求める
+            self.frame = self.control.file_open(self.master, 1, self.product.get())
             self.frame2 = self.frame
             self.update_result_img(self.frame)
             self.shutter_button.lower(self.video_return_button)
@@ -327,8 +331,6 @@ class Registration(tk.Frame):
         :return: x:リサイズ後の幅 y:リサイズ後の高さ white:リサイズした画像
         """
         y, x = frame.shape[:2]
-        binary = pickle.dumps(frame)
-        pickle_copy = pickle.loads(binary)
         # 画像サイズがフレームサイズよりも大きい場合リサイズする
         if x > width:
             new_width = x
@@ -339,10 +341,10 @@ class Registration(tk.Frame):
         if y > new_height:
             new_width = int(width * y / height)
             new_height = y
-        white = np.ones((new_height, new_width, 3), np.uint8) * 255  # 画像のサイズとフレームのサイズが合わない部分を埋める白画像を作成
+        white = np.full((new_height, new_width, 3), 255, np.uint8)  # 画像のサイズとフレームのサイズが合わない部分を埋める白画像を作成
         margin_x = int((new_width - x) / 2)
         margin_y = int((new_height - y) / 2)
-        white[margin_y:margin_y + y, margin_x:margin_x + x] = pickle_copy  # 白画像中央にフレームを配置
+        white[margin_y:margin_y + y, margin_x:margin_x + x] = frame  # 白画像中央にフレームを配置
         self.margin_x = 0
         self.margin_y = 0
         self.wheel_num = 0
@@ -363,7 +365,7 @@ class Registration(tk.Frame):
         self.shutter_button.configure(style="Count.TButton")
         self.shutter_button.update()
         self.cam_flag = False
-        self.frame2 = self.control.shutter(self.cap, self.frame, self.dialog)
+        self.frame2 = self.control.shutter(self.cap, self.frame, self.dialog, self.product.get())
         self.update_result_img(self.frame2)
         self.shutter_button.lower(self.video_return_button)
         self.shutter_text.set("撮影")
@@ -395,9 +397,7 @@ class Registration(tk.Frame):
                 x, y, white = self.update_size_img(self.frame2, self.first_width, self.first_height)
                 self.frame1 = white
                 self.enlarge = "on"
-            binary = pickle.dumps(self.frame1)
-            pickle_copy = pickle.loads(binary)
-            img = cv2.cvtColor(pickle_copy, cv2.COLOR_BGR2RGB)
+            img = cv2.cvtColor(self.frame1, cv2.COLOR_BGR2RGB)
             img = Image.fromarray(img)
             imgtk = ImageTk.PhotoImage(image=img)
             self.result_p_img.imgtk = imgtk
@@ -422,14 +422,12 @@ class Registration(tk.Frame):
             x1 = self.x_down
             y1 = self.y_down
             try:
-                binary = pickle.dumps(self.frame1)
-                pickle_copy = pickle.loads(binary)
+                frame1 = self.frame1
             except Exception:
-                x, y, white = self.update_size_img(self.frame2, self.first_width, self.first_height)
-                binary = pickle.dumps(white)
-                pickle_copy = pickle.loads(binary)
+                x, y, frame1 = self.update_size_img(self.frame2, self.first_width, self.first_height)
             finally:
-                frame_enlarge_c = pickle_copy[0:self.first_height, 0:self.first_width]
+                # 矩形を描くので、表示範囲だけを使い回しのバッファに複製する
+                frame_enlarge_c = self.drag_buffer.copy_from(frame1[0:self.first_height, 0:self.first_width])
                 img = cv2.rectangle(frame_enlarge_c, (x1, y1), (x2, y2), (255, 255, 0), 1)
                 img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
                 img = Image.fromarray(img)
@@ -506,8 +504,7 @@ class Registration(tk.Frame):
                     if self.y_down > self.y_up:
                         self.y_down, self.y_up = self.y_up, self.y_down
 
-                    binary = pickle.dumps(self.frame2)
-                    self.frame_pattern = pickle.loads(binary)
+                    self.frame_pattern = share(self.frame2)  # 複製せずに、書き換え不可にして参照する
                     # 拡大されていないとき
                     if self.enlarge == "on":
                         result = self.control.select_img(self.first_width, self.first_height,
@@ -568,9 +565,7 @@ class Registration(tk.Frame):
                 self.cx = int(size_magnif * (x + moved_x) + 100 - x)
                 self.cy = int(size_magnif * (y + moved_y) + 100 - y)
                 # 画像の更新
-                binary = pickle.dumps(self.frame_pattern)
-                pattern_back2 = pickle.loads(binary)
-                self.cut_pattern(pattern_back2, self.x_down, self.x_up, self.y_down, self.y_up, self.cx, self.cy,
+                self.cut_pattern(self.frame_pattern, self.x_down, self.x_up, self.y_down, self.y_up, self.cx, self.cy,
                                  self.pattern_magnif)
 
     def get_xy(self, event):
@@ -601,9 +596,7 @@ class Registration(tk.Frame):
             self.cx -= x_gap
             self.cy -= y_gap
             # 画像の更新
-            binary = pickle.dumps(self.frame_pattern)
-            pattern_back2 = pickle.loads(binary)
-            self.cut_pattern(pattern_back2, self.x_down, self.x_up, self.y_down, self.y_up, self.cx, self.cy,
+            self.cut_pattern(self.frame_pattern, self.x_down, self.x_up, self.y_down, self.y_up, self.cx, self.cy,
                              self.pattern_magnif)
             # マウスの移動前の値に現在位置を設定
             self.pattern_x_down = pattern_x_up
@@ -667,9 +660,7 @@ class Registration(tk.Frame):
         except NameError:
             pass
         else:
-            binary = pickle.dumps(self.frame_pattern)
-            pattern_back2 = pickle.loads(binary)
-            self.cut_pattern(pattern_back2, self.x_down, self.x_up, self.y_down, self.y_up, self.cx, self.cy,
+            self.cut_pattern(self.frame_pattern, self.x_down, self.x_up, self.y_down, self.y_up, self.cx, self.cy,
                              self.pattern_magnif)
 
     def get_info(self, event):
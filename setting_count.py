@@ -1,11 +1,25 @@
+import os
 import pickle
+import threading
+
+
+# 後から追加した設定項目の初期値。古い設定ファイルにはこれらの項目が無いので、読み込み時に補う
+matching_setting_defaults = {"matching_mode": "full",  # パターンマッチングの方法 "full", "pyramid" or "fft"
+                             "pyramid_levels": 2,  # pyramidのときの縮小回数
+                             "deskew_mode": "hough",  # 前処理の回転角の求め方 "hough" or "profile"
+                             "pattern_history": None}  # パターン画像ごとの採用回数など。今はpattern_history_extのファイルに保存する
+pattern_history_ext = ".history"  # パターン画像の採用履歴のファイルの拡張子。設定ファイルと同じディレクトリに製品名で保存する
+# 設定ファイルの読み込みから書き込みまでを1つずつ行う(設定画面と、バックグラウンドでの採用履歴の保存が同じファイルに書くため)
+_file_lock = threading.RLock()
 
 
 def create_setting_file(directory, product_name,
                         matching_threshold=None, erode_size=None, dilate_size=None, thresh_area=None,
-                        h_range=None, l_range=None, s_range=None):
+                        h_range=None, l_range=None, s_range=None,
+                        matching_mode=None, pyramid_levels=None, deskew_mode=None):
     """
     設定ファイルを作成する関数
+    matching_mode, pyramid_levels, deskew_modeがNoneの場合は、既存の設定ファイルの値を引き継ぐ
     :param directory:
     :param product_name:
     :param matching_threshold:
@@ -15,6 +29,9 @@ def create_setting_file(directory, product_name,
     :param h_range:
     :param l_range:
     :param s_range:
+    :param matching_mode:
+    :param pyramid_levels:
+    :param deskew_mode:
     :return:
     """
     if matching_threshold is None:
@@ -32,15 +49,27 @@ def create_setting_file(directory, product_name,
     if s_range is None:
         s_range = 255
     filename = directory + product_name + ".pkl"
-    data = {"matching_threshold": matching_threshold,
-            "erode_size": erode_size,
-            "dilate_size": dilate_size,
-            "thresh_area": thresh_area,
-            "h_range": h_range,
-            "l_range": l_range,
-            "s_range": s_range}
-    with open(filename, "wb") as f:
-        pickle.dump(data, f)
+    with _file_lock:
+        prev_data = _load_data(filename)
+        if matching_mode is None:
+            matching_mode = prev_data["matching_mode"]
+        if pyramid_levels is None:
+            pyramid_levels = prev_data["pyramid_levels"]
+        if deskew_mode is None:
+            deskew_mode = prev_data["deskew_mode"]
+        pattern_history = prev_data["pattern_history"]  # 設定の変更では採用回数を消さない
+        data = {"matching_threshold": matching_threshold,
+                "erode_size": erode_size,
+                "dilate_size": dilate_size,
+                "thresh_area": thresh_area,
+                "h_range": h_range,
+                "l_range": l_range,
+                "s_range": s_range,
+                "matching_mode": matching_mode,
+                "pyramid_levels": pyramid_levels,
+                "deskew_mode": deskew_mode,
+                "pattern_history": pattern_history}
+        _dump_data(filename, data)
 
 
 def load_setting_file(directory, product_name):
@@ -51,8 +80,9 @@ def load_setting_file(directory, product_name):
     :return:
     """
     filename = directory + product_name + ".pkl"
-    with open(filename, "rb") as f:
-        data = pickle.load(f)
+    with _file_lock:
+        with open(filename, "rb") as f:
+            data = pickle.load(f)
 
     matching_threshold = data["matching_threshold"]
     erode_size = data["erode_size"]
@@ -62,3 +92,103 @@ def load_setting_file(directory, product_name):
     l_range = data["l_range"]
     s_range = data["s_range"]
     return matching_threshold, erode_size, dilate_size, thresh_area, h_range, l_range, s_range
+
+
+def load_matching_setting(directory, product_name):
+    """
+    設定ファイルからパターンマッチングの方法を読み込む
+    設定ファイルが無い、もしくは項目が無い場合は初期値を返す
+    :param directory:
+    :param product_name:
+    :return: matching_mode, pyramid_levels
+    """
+    data = _load_data(directory + product_name + ".pkl")
+    return data["matching_mode"], data["pyramid_levels"]
+
+
+def load_deskew_setting(directory, product_name):
+    """
+    設定ファイルから前処理の回転角の求め方を読み込む
+    設定ファイルが無い、もしくは項目が無い場合は初期値を返す
+    :param directory:
+    :param product_name:
+    :return: deskew_mode
+    """
+    return _load_data(directory + product_name + ".pkl")["deskew_mode"]
+
+
+def new_pattern_history():
+    """
+    空のパターン画像の採用履歴
+    :return: dict wins: {パターン画像名: 採用された回数}, fast_num: 採用回数の多いパターン画像だけで確認できた回数,
+             count_num: パターンマッチングの回数
+    """
+    return {"wins": {}, "fast_num": 0, "count_num": 0}
+
+
+def pattern_history_filename(directory, product_name):
+    """
+    パターン画像の採用履歴のファイル名
+    :param directory:
+    :param product_name:
+    :return: str
+    """
+    return directory + product_name + pattern_history_ext
+
+
+def load_pattern_history(directory, product_name):
+    """
+    パターン画像の採用履歴を読み込む。無い場合は空の履歴を返す
+    採用履歴のファイルが無い場合は、設定ファイルに保存していたころの採用履歴を読み込む
+    :param directory:
+    :param product_name:
+    :return: dict new_pattern_historyの形式
+    """
+    filename = pattern_history_filename(directory, product_name)
+    with _file_lock:
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                history = pickle.load(f)
+        else:
+            history = _load_data(directory + product_name + ".pkl")["pattern_history"]
+    return history if history is not None else new_pattern_history()
+
+
+def save_pattern_history(directory, product_name, history):
+    """
+    パターン画像の採用履歴を保存する
+    設定ファイルとは別のファイルに保存するので、設定ファイルが無い製品(初期値で動いている製品)の採用履歴も残る
+    ArtifactWriterのスレッドから呼び出してもよい(create_setting_fileと同じロックで読み書きする)
+    :param directory:
+    :param product_name:
+    :param history: new_pattern_historyの形式、Noneのとき履歴を消す
+    """
+    with _file_lock:
+        # Noneも保存して、設定ファイルに残っている古い採用履歴を読み込まないようにする
+        _dump_data(pattern_history_filename(directory, product_name), history)
+
+
+def _load_data(filename):
+    """
+    設定ファイルの中身を読み込み、後から追加した項目が無ければ初期値で補う
+    :param filename:
+    :return: dict
+    """
+    data = dict(matching_setting_defaults)
+    with _file_lock:
+        if os.path.exists(filename):
+            with open(filename, "rb") as f:
+                data.update(pickle.load(f))
+    return data
+
+
+def _dump_data(filename, data):
+    """
+    設定ファイルに書き込む。書き込み途中のファイルを読み込まないように、一時ファイルに書いてから置き換える
+    :param filename:
+    :param data: dict
+    """
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        pickle.dump(data, f)
+    os.replace(temp_filename, filename)
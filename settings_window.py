@@ -368,6 +368,7 @@ class SettingsWindow(tk.Frame):
         dirs_name = product_dir_name + control_no + "/"
         dir_name = dirs_name + sheet_no + "/"
         path = dir_name + "frame.jpg"
+        self.control.writer.flush(dir_name)  # バックグラウンドでの保存が終わるのを待つ
         n = np.fromfile(path, dtype=np.uint8)
         frame = cv2.imdecode(n, cv2.IMREAD_COLOR)
 
@@ -0,0 +1,177 @@
+"""
+計数処理の段階(撮影・HDR・前処理・マッチングなど)ごとの処理時間を記録する
+初期状態では記録しない。enableで有効にする
+
+    stage_timer.begin("製品名/管理No/シートNo")
+    with stage_timer.stage("jpeg_write"):
+        ...
+    stage_timer.end("./count/result/20220906/")  # 日付ディレクトリのstage_time.csvに追記する
+
+段階は入れ子にできる(preprocessingの中のdetect_lineなど)。同じ段階を複数回通った場合は合計する
+処理時間以外の1シートごとの値(スレッドプールの待ち行列の長さなど)はset_valueで記録し、value列に書き出す
+"""
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import os
+import threading
+import time
+
+
+stage_time_file_name = "stage_time.csv"  # 日付ディレクトリに作成する、処理時間を追記していくファイル
+stage_time_header = "datetime,label,stage,seconds,calls,value\n"
+
+
+class StageTimer:
+    def __init__(self, buffer_size=200):
+        """
+        段階ごとの処理時間を1シート分ずつまとめて保持するクラス
+        スレッドプールで実行された段階も、実行中のシートの記録に加える
+
+        Args:
+            buffer_size (int): 保持するシートの数。古いものから破棄する
+        """
+        self.enabled = False
+        self.records = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        # 記録中のシート {"datetime", "label", "start", "stages": {段階名: [秒, 回数]}, "values": {名前: 値}}
+        self._current = None
+
+    def enable(self, enabled=True):
+        """記録の有効・無効を切り替える"""
+        self.enabled = enabled
+
+    def begin(self, label):
+        """
+        1シート分の記録を始める。前のシートがendされていない場合は破棄する
+
+        Args:
+            label (str): 記録の名前(製品名/管理No/シートNoなど)
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._current = {"datetime": datetime.now(), "label": label, "start": time.perf_counter(),
+                             "stages": {}, "values": {}}
+
+    def add(self, name, seconds):
+        """
+        記録中のシートに処理時間を加える
+
+        Args:
+            name (str): 段階名
+            seconds (float): 処理時間
+        """
+        with self._lock:
+            if self._current is None:
+                return
+            stage = self._current["stages"].setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += 1
+
+    def set_value(self, name, value):
+        """
+        記録中のシートに処理時間以外の値を記録する。同じ名前の場合は上書きする
+
+        Args:
+            name (str): 値の名前
+            value (int or float): 値
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._current is not None:
+                self._current["values"][name] = value
+
+    @contextmanager
+    def stage(self, name):
+        """
+        withで囲んだ範囲の処理時間を記録する
+
+        Args:
+            name (str): 段階名
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """
+        関数全体の処理時間を記録するデコレータ
+
+        Args:
+            name (str): 段階名
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def end(self, log_dir=None):
+        """
+        1シート分の記録を終えてバッファに追加し、log_dirを指定した場合はファイルに追記する
+
+        Args:
+            log_dir (str or None): stage_time.csvを作成するディレクトリ(末尾に/を含む)
+
+        Returns:
+            dict or None: datetime, label, total(全体の処理時間), stages({段階名: (秒, 回数)}), values({名前: 値})
+        """
+        with self._lock:
+            current, self._current = self._current, None
+        if current is None:
+            return None
+        record = {"datetime": current["datetime"],
+                  "label": current["label"],
+                  "total": time.perf_counter() - current["start"],
+                  "stages": {name: tuple(stage) for name, stage in current["stages"].items()},
+                  "values": dict(current["values"])}
+        self.records.append(record)
+        if log_dir is not None:
+            self._write(log_dir, record)
+        return record
+
+    def get_summary(self):
+        """
+        バッファ内のシートについて、段階ごとの平均と最大の処理時間を返す
+
+        Returns:
+            dict[str, (float, float, int)]: {段階名: (平均[s], 最大[s], シート数)}。全体はtotal
+        """
+        times = {}
+        for record in list(self.records):
+            times.setdefault("total", []).append(record["total"])
+            for name, (seconds, _) in record["stages"].items():
+                times.setdefault(name, []).append(seconds)
+        return {name: (sum(values) / len(values), max(values), len(values)) for name, values in times.items()}
+
+    @staticmethod
+    def _write(log_dir, record):
+        """stage_time.csvに1シート分を追記する。ファイルが無い場合はヘッダーも書く"""
+        path = log_dir + stage_time_file_name
+        str_datetime = record["datetime"].strftime("%Y/%m/%d %H:%M:%S")
+        label = record["label"].replace(",", " ")
+        lines = ["{},{},total,{:.4f},1,\n".format(str_datetime, label, record["total"])]
+        for name, (seconds, calls) in record["stages"].items():
+            lines.append("{},{},{},{:.4f},{},\n".format(str_datetime, label, name, seconds, calls))
+        for name, value in record.get("values", {}).items():
+            lines.append("{},{},{},,,{}\n".format(str_datetime, label, name, value))
+        write_header = not os.path.exists(path)
+        with open(path, "a", encoding="utf-8") as f:
+            if write_header:
+                f.write(stage_time_header)
+            f.writelines(lines)
+
+
+stage_timer = StageTimer()  # アプリケーション全体で共有する
@@ -0,0 +1,75 @@
+"""
+回転画像から製品が並んでいる範囲(トレー・シート上の製品の範囲)を縮小画像で求める
+
+パターンマッチングなどを製品の範囲だけで行い、トレーの外側や回転で生じた黒い余白の計算を省く。
+製品の見分け方はcount_contours.remove_backgroundと同じ(背景より彩度が低い部分を製品とする)
+
+    roi = find_tray_roi(img_rot)  # (左上x, 右下x, 左上y, 右下y)
+    img_roi = img_rot[roi[2]:roi[3], roi[0]:roi[1]]
+"""
+import cv2
+import numpy as np
+
+from count_contours import remove_background
+
+
+roi_scale = 8  # 製品の範囲を探すときの縮小率
+roi_margin = 240  # 製品の範囲から前後左右に広げる幅[px]。PatternImage._trimの200pxより広くして、トリミング結果を変えない
+roi_fill_value = 8  # 明度がこれ以下の画素は回転・射影変換で生じた余白として、背景と同じ扱いにする
+roi_min_area = 4  # 縮小画像で面積がこれ以下のまとまりはノイズとして除く
+roi_min_fraction = 0.01  # 製品部分が余白以外の画素のこの割合未満のときは、見分けられなかったとして画像全体を返す
+
+
+def find_tray_roi(img, scale=roi_scale, margin=roi_margin):
+    """
+    製品が写っている範囲を、縮小画像の彩度から求める
+
+    Args:
+        img (img_bgr): 回転画像
+        scale (int): 縮小率
+        margin (int): 製品の範囲から前後左右に広げる幅[px]
+
+    Returns:
+        (int, int, int, int): 範囲(左上x, 右下x, 左上y, 右下y)。製品を見分けられなかったときは画像全体
+    """
+    img_h, img_w = img.shape[:2]
+    full = (0, img_w, 0, img_h)
+    small_size = (max(1, img_w // scale), max(1, img_h // scale))
+    small = cv2.resize(img, small_size, interpolation=cv2.INTER_AREA)
+    img_hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    # 余白は彩度0なので、そのままでは製品と同じ側になる。彩度を最大にして背景側に入れる
+    fill = img_hsv[:, :, 2] <= roi_fill_value
+    img_hsv[:, :, 1][fill] = 255
+    product = remove_background(img_hsv)
+    product = cv2.morphologyEx(product, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+
+    label_num, _, stats, _ = cv2.connectedComponentsWithStats(product, connectivity=8)
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] > roi_min_area]
+    valid_num = fill.size - np.count_nonzero(fill)
+    if len(stats) == 0 or stats[:, cv2.CC_STAT_AREA].sum() < valid_num * roi_min_fraction:
+        return full
+
+    # 面積がroi_min_areaより大きいまとまりが、全て範囲内に収まるようにする
+    x_left = stats[:, cv2.CC_STAT_LEFT].min() * scale
+    y_top = stats[:, cv2.CC_STAT_TOP].min() * scale
+    x_right = (stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]).max() * scale
+    y_bottom = (stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT]).max() * scale
+    return (int(max(x_left - margin, 0)), int(min(x_right + margin, img_w)),
+            int(max(y_top - margin, 0)), int(min(y_bottom + margin, img_h)))
+
+
+def skipped_fraction(roi, img_shape):
+    """
+    範囲の外側として計算を省いた画素の割合
+
+    Args:
+        roi ((int, int, int, int)): 範囲(左上x, 右下x, 左上y, 右下y)
+        img_shape (tuple): 元の画像のshape
+
+    Returns:
+        float: 0~1
+    """
+    x_min, x_max, y_min, y_max = roi
+    img_h, img_w = img_shape[:2]
+    return 1 - (x_max - x_min) * (y_max - y_min) / (img_w * img_h)
@@ -0,0 +1,124 @@
+"""
+計数処理(パターンマッチング・イレギュラー検知)で共有するスレッドプール
+OpenCVの処理はGILを解放するので、スレッドで並列に実行できる
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+
+default_worker_num = 4  # スレッド数
+
+
+class WorkerPool:
+    def __init__(self, worker_num=default_worker_num):
+        """
+        スレッドを起動したまま使い回すプール。待ち行列の長さと処理時間の合計を記録する
+
+        Args:
+            worker_num (int): スレッド数
+        """
+        self.worker_num = worker_num
+        self._executor = ThreadPoolExecutor(max_workers=worker_num, thread_name_prefix="count_worker")
+        self._lock = threading.Lock()
+        self._queued = 0  # 投入されてまだ実行が始まっていない処理の数
+        self._running = 0  # 実行中の処理の数
+        self._max_queued = 0  # 待ち行列の長さの最大値
+        self._task_num = 0  # 完了した処理の数
+        self._busy_time = 0.0  # 各スレッドが処理を実行していた時間の合計
+        self._start_time = time.perf_counter()
+
+    def submit(self, fn, *args):
+        """
+        処理を投入する
+
+        Args:
+            fn (function): 実行する関数
+            *args: fnの引数
+
+        Returns:
+            concurrent.futures.Future: 実行結果
+        """
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        return self._executor.submit(self._run, fn, args)
+
+    def map(self, fn, iterable):
+        """
+        iterableの要素ごとにfnを並列に実行し、結果を順番通りのリストで返す
+
+        Args:
+            fn (function): 実行する関数
+            iterable: fnに渡す引数
+
+        Returns:
+            list: fnの返り値
+        """
+        futures = [self.submit(fn, arg) for arg in iterable]
+        return [future.result() for future in futures]
+
+    def get_stats(self, reset_max_queued=False):
+        """
+        プールの状態を返す
+
+        Args:
+            reset_max_queued (bool): Trueのとき、返した後に待ち行列の長さの最大値を今の長さに戻す(シートごとの最大値を取る場合)
+
+        Returns:
+            dict: worker_num, queued(待ち行列の長さ), running(実行中の数), max_queued(待ち行列の長さの最大値),
+                  task_num(完了した数), busy_time(処理時間の合計[s]), utilization(起動してからの稼働率)
+        """
+        with self._lock:
+            elapsed = time.perf_counter() - self._start_time
+            stats = {"worker_num": self.worker_num,
+                     "queued": self._queued,
+                     "running": self._running,
+                     "max_queued": self._max_queued,
+                     "task_num": self._task_num,
+                     "busy_time": self._busy_time,
+                     "utilization": self._busy_time / (elapsed * self.worker_num) if elapsed > 0 else 0.0}
+            if reset_max_queued:
+                self._max_queued = self._queued
+            return stats
+
+    def shutdown(self, wait=True):
+        """
+        スレッドを終了する。投入済みの処理は終わるまで待つ
+
+        Args:
+            wait (bool): Trueのとき、スレッドが終了するまで待つ
+        """
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, fn, args):
+        """スレッド上で実行され、処理時間を記録する"""
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._task_num += 1
+                self._busy_time += time.perf_counter() - start
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """
+    プールを指定されなかったときに使う、プロセスで1つのプールを返す
+
+    Returns:
+        WorkerPool: 共有のプール
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = WorkerPool()
+        return _default_pool